@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Delivers a DM broadcast through a local fake Discord HTTP server that enforces
+# a global rate limit (answering 429 like Discord does) and refuses DMs to some
+# users. Compares the old serial approach (fetch user, open DM, send) with
+# orisa.broadcast, and checks that an interrupted broadcast resumes without
+# losing or (apart from the last unsaved results) repeating messages.
+#
+# usage: benchmarks/broadcast.py [recipients] [latency in ms]
+
+import json
+import re
+import sys
+import time
+
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import asks
+import trio
+
+from orisa import broadcast
+from orisa.models import BROADCAST_FAILED, BROADCAST_PENDING, BROADCAST_SENT
+
+RECIPIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+LATENCY = (int(sys.argv[2]) if len(sys.argv) > 2 else 100) / 1000
+
+# Discord's global limit
+GLOBAL_RATE = 50
+
+# every nth user has DMs disabled
+CLOSED_DMS_EVERY = 20
+
+
+class FakeDiscord:
+    def __init__(self):
+        self.messages = Counter()
+        self.requests = 0
+        self.rate_limited = 0
+        self._window = (0, 0)
+
+    async def handle(self, stream):
+        buf = b""
+        try:
+            while True:
+                while b"\r\n\r\n" not in buf:
+                    data = await stream.receive_some(65536)
+                    if not data:
+                        return
+                    buf += data
+                head, buf = buf.split(b"\r\n\r\n", 1)
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path = request_line.split(" ")[:2]
+                headers = dict(
+                    (key.strip().lower(), value.strip())
+                    for key, value in (line.split(":", 1) for line in header_lines)
+                )
+                length = int(headers.get("content-length", 0))
+                while len(buf) < length:
+                    buf += await stream.receive_some(65536)
+                body, buf = buf[:length], buf[length:]
+
+                await trio.sleep(LATENCY)
+                status, response = self.respond(method, path, body)
+                response = json.dumps(response).encode()
+                await stream.send_all(
+                    b"HTTP/1.1 %d X\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (status, len(response), response)
+                )
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+
+    def respond(self, method, path, body):
+        self.requests += 1
+
+        second = int(trio.current_time())
+        window_second, count = self._window
+        count = count + 1 if window_second == second else 1
+        self._window = second, count
+        if count > GLOBAL_RATE:
+            self.rate_limited += 1
+            retry_after = (second + 1 - trio.current_time()) * 1000
+            return 429, {"message": "You are being rate limited.", "retry_after": retry_after, "global": True}
+
+        if method == "GET" and path.startswith("/users/"):
+            return 200, {"id": path.rsplit("/", 1)[1], "username": "user"}
+        elif path == "/users/@me/channels":
+            recipient_id = json.loads(body)["recipient_id"]
+            return 200, {"id": str(recipient_id * 10), "type": 1}
+        else:
+            channel_id = int(re.match(r"/channels/(\d+)/messages", path).group(1))
+            if channel_id // 10 % CLOSED_DMS_EVERY == 0:
+                return 403, {"message": "Cannot send messages to this user", "code": 50007}
+            self.messages[channel_id] += 1
+            return 200, {"id": "1"}
+
+
+class Forbidden(Exception):
+    pass
+
+
+class FakeHTTPClient:
+    "the relevant parts of curious' HTTPClient, including its handling of 429"
+
+    def __init__(self, port):
+        self.base = f"http://127.0.0.1:{port}"
+        self.session = asks.Session(headers={"Connection": "keep-alive"}, connections=broadcast.BROADCAST_CONCURRENCY)
+
+    async def request(self, method, path, body=None):
+        while True:
+            response = await self.session.request(method, self.base + path, json=body)
+            if response.status_code == 429:
+                await trio.sleep(response.json()["retry_after"] / 1000)
+                continue
+            if response.status_code == 403:
+                raise Forbidden(response.json()["message"])
+            return response.json()
+
+    async def get_user(self, user_id):
+        return await self.request("GET", f"/users/{user_id}")
+
+    async def create_private_channel(self, user_id):
+        return await self.request("POST", "/users/@me/channels", {"recipient_id": user_id})
+
+    async def send_message(self, channel_id, content):
+        return await self.request("POST", f"/channels/{channel_id}/messages", {"content": content})
+
+
+class FakeDatabase:
+    "in memory version of the broadcast methods of orisa.models.Database"
+
+    def __init__(self, target_ids):
+        self.status = {target_id: BROADCAST_PENDING for target_id in target_ids}
+        self.finished = False
+
+    @asynccontextmanager
+    async def session(self):
+        yield None
+
+    async def broadcast_recipients(self, session, job_id):
+        recipients = {BROADCAST_PENDING: [], BROADCAST_SENT: [], BROADCAST_FAILED: []}
+        for target_id, status in self.status.items():
+            recipients[status].append(target_id)
+        return recipients
+
+    async def save_broadcast_results(self, session, job_id, results):
+        for target_id, (status, error) in results.items():
+            self.status[target_id] = status
+        return False
+
+    async def finish_broadcast(self, session, job_id, *, cancelled=False):
+        self.finished = True
+
+
+async def deliver_dm(http, target_id):
+    channel = await http.create_private_channel(target_id)
+    await http.send_message(int(channel["id"]), "Hello")
+
+
+async def serial(http, target_ids):
+    for target_id in target_ids:
+        try:
+            await http.get_user(target_id)
+            await deliver_dm(http, target_id)
+        except Forbidden:
+            pass
+
+
+async def engine(http, database):
+    async def report(progress):
+        pass
+
+    return await broadcast.run_broadcast(
+        database,
+        1,
+        lambda target_id: deliver_dm(http, target_id),
+        report,
+        permanent_errors=(Forbidden,),
+        requests_per_delivery=2,
+    )
+
+
+async def measure(fake, coro):
+    fake.messages.clear()
+    fake.requests = fake.rate_limited = 0
+    started = time.monotonic()
+    await coro
+    took = time.monotonic() - started
+    return {
+        "seconds": took,
+        "deliveries_per_second": RECIPIENTS / took,
+        "messages": sum(fake.messages.values()),
+        "requests": fake.requests,
+        "rate_limited": fake.rate_limited,
+    }
+
+
+async def interrupted_and_resumed(fake, http, target_ids):
+    fake.messages.clear()
+    database = FakeDatabase(target_ids)
+    # a DM takes two requests
+    expected = RECIPIENTS * 2 / broadcast.BROADCAST_RATE
+    with trio.move_on_after(max(broadcast.RESULT_FLUSH_INTERVAL + 1, expected / 2)):
+        await engine(http, database)
+    # simulate dying: whatever wasn't flushed is lost
+    done_before = sum(1 for status in database.status.values() if status != BROADCAST_PENDING)
+    progress = await engine(http, database)
+    return {
+        "saved_before_interruption": done_before,
+        "sent": progress.sent,
+        "failed": progress.failed,
+        "users_without_message": sum(
+            1
+            for target_id in target_ids
+            if target_id % CLOSED_DMS_EVERY and not fake.messages[target_id * 10]
+        ),
+        "duplicate_messages": sum(count - 1 for count in fake.messages.values() if count > 1),
+    }
+
+
+async def main():
+    target_ids = list(range(1, RECIPIENTS + 1))
+    fake = FakeDiscord()
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(trio.serve_tcp, fake.handle, 0)
+        port = listeners[0].socket.getsockname()[1]
+        http = FakeHTTPClient(port)
+
+        results = {
+            "serial": await measure(fake, serial(http, target_ids)),
+            "broadcast": await measure(fake, engine(http, FakeDatabase(target_ids))),
+            "resume": await interrupted_and_resumed(fake, http, target_ids),
+        }
+        nursery.cancel_scope.cancel()
+
+    print(json.dumps(
+        {
+            "benchmark": "broadcast",
+            "recipients": RECIPIENTS,
+            "latency_ms": LATENCY * 1000,
+            "broadcast_rate": broadcast.BROADCAST_RATE,
+            "broadcast_concurrency": broadcast.BROADCAST_CONCURRENCY,
+            "results": results,
+        },
+        indent=2,
+    ))
+
+
+trio.run(main)
@@ -0,0 +1,442 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Local stand-ins for Discord and playoverwatch.com used by suite.py.
+#
+# FakeDiscordAPI and FakeBlizzard are real HTTP servers on localhost with a
+# configurable latency, so the bot pays for every request like in production.
+# The Discord objects (FakeGuild, FakeMember, FakeChannel, ...) implement the
+# parts of curious' dataclasses Orisa uses; their mutating methods go through
+# the fake REST API and then dispatch the gateway event Discord would send
+# (which is what client.events.wait_for_manager waits for).
+
+import hashlib
+import itertools
+import json
+
+from collections import Counter
+from contextlib import asynccontextmanager
+from pathlib import Path
+from string import Template
+
+import asks
+import trio
+
+from curious.dataclasses.channel import ChannelType
+
+from orisa import metrics
+
+CAREER_TEMPLATE = Template((Path(__file__).parent / "fixtures" / "career.html").read_text())
+
+ROLE_TEMPLATE = Template(
+    '<div class="competitive-rank-role">'
+    '<div class="competitive-rank-role-icon"></div>'
+    '<div class="competitive-rank-tier competitive-rank-tier-tooltip" data-ow-tooltip-text="$role Skill Rating">'
+    '<img class="competitive-rank-tier-icon" src="https://example.invalid/rank-$rank.png"></div>'
+    '<div class="competitive-rank-level">$sr</div>'
+    "</div>"
+)
+
+NOT_FOUND_PAGE = "<html><body><h1>Profile Not Found</h1></body></html>"
+
+# every nth profile is private (no SR) or doesn't exist
+PRIVATE_EVERY = 10
+NOT_FOUND_EVERY = 50
+
+
+async def serve_http(stream, respond, latency):
+    "a minimal HTTP/1.1 keep-alive server, respond(method, path, body) returns (status, content type, body)"
+    buf = b""
+    try:
+        while True:
+            while b"\r\n\r\n" not in buf:
+                data = await stream.receive_some(65536)
+                if not data:
+                    return
+                buf += data
+            head, buf = buf.split(b"\r\n\r\n", 1)
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, path = request_line.split(" ")[:2]
+            headers = dict(
+                (key.strip().lower(), value.strip())
+                for key, value in (line.split(":", 1) for line in header_lines)
+            )
+            length = int(headers.get("content-length", 0))
+            while len(buf) < length:
+                buf += await stream.receive_some(65536)
+            body, buf = buf[:length], buf[length:]
+
+            await trio.sleep(latency)
+            status, content_type, response = respond(method, path, body)
+            await stream.send_all(
+                b"HTTP/1.1 %d X\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n%s"
+                % (status, content_type.encode(), len(response), response)
+            )
+    except (trio.BrokenResourceError, trio.ClosedResourceError):
+        pass
+
+
+async def start_server(nursery, handler):
+    "serves handler on a free local port and returns the port"
+    listeners = await nursery.start(trio.serve_tcp, handler, 0)
+    return listeners[0].socket.getsockname()[1]
+
+
+def _number(text):
+    return int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+
+
+class FakeBlizzard:
+    "serves career pages with SRs derived from the handle, so every run sees the same data"
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.season = 0
+
+    async def handle(self, stream):
+        await serve_http(stream, self.respond, self.latency)
+
+    def srs(self, handle):
+        "the SRs the page of handle currently shows, None for private profiles"
+        number = _number(handle)
+        if number % PRIVATE_EVERY == 0:
+            return None
+        # SRs drift a bit every season, so syncs find changes
+        return tuple(
+            None if (number >> shift) % 7 == 0 else 1000 + (number >> shift) % 3000 + self.season * 25
+            for shift in (0, 4, 8)
+        )
+
+    def respond(self, method, path, body):
+        self.requests += 1
+        handle = path.rstrip("/").rsplit("/", 1)[1]
+        if _number(handle) % NOT_FOUND_EVERY == 0:
+            return 200, "text/html; charset=utf-8", NOT_FOUND_PAGE.encode()
+        srs = self.srs(handle)
+        roles = "".join(
+            ROLE_TEMPLATE.substitute(role=role, sr=sr, rank=sr // 500)
+            for role, sr in zip(("Tank", "Damage", "Support"), srs or (None, None, None))
+            if sr is not None
+        )
+        permission = "Public Profile" if srs else "Private Profile"
+        return (
+            200,
+            "text/html; charset=utf-8",
+            CAREER_TEMPLATE.substitute(name=handle, roles=roles, permission=permission).encode(),
+        )
+
+
+class FakeDiscordAPI:
+    "accepts every REST request and counts them per route"
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = Counter()
+        self._ids = itertools.count(900_000_000_000_000_000)
+
+    async def handle(self, stream):
+        await serve_http(stream, self.respond, self.latency)
+
+    def respond(self, method, path, body):
+        self.requests[f"{method} {metrics.route_label(path)}"] += 1
+        if method == "DELETE":
+            return 204, "application/json", b""
+        return 200, "application/json", json.dumps({"id": str(next(self._ids))}).encode()
+
+
+class FakeREST:
+    def __init__(self, port, connections=20):
+        self.base = f"http://127.0.0.1:{port}"
+        self.session = asks.Session(headers={"Connection": "keep-alive"}, connections=connections)
+
+    async def request(self, method, path, body=None):
+        response = await self.session.request(method, self.base + path, json=body)
+        return response.json() if response.content else None
+
+
+class FakeEvents:
+    "the wait_for_manager part of curious' event manager"
+
+    def __init__(self):
+        self._waiters = []
+
+    @asynccontextmanager
+    async def wait_for_manager(self, name, predicate):
+        waiter = (name, predicate, trio.Event())
+        self._waiters.append(waiter)
+        try:
+            yield
+            await waiter[2].wait()
+        finally:
+            self._waiters.remove(waiter)
+
+    def dispatch(self, name, *args):
+        for waiting_for, predicate, event in self._waiters:
+            if waiting_for == name and predicate(*args):
+                event.set()
+
+
+class AllPermissions:
+    def __getattr__(self, name):
+        return True
+
+
+class FakeUser:
+    def __init__(self, client, id, username, discriminator="0001"):
+        self.client = client
+        self.id = id
+        self.username = username
+        self.name = username
+        self.discriminator = discriminator
+
+    async def send(self, content=None, *, embed=None):
+        channel = await self.client.rest.request("POST", "/users/@me/channels", {"recipient_id": self.id})
+        await self.client.rest.request(
+            "POST", f"/channels/{channel['id']}/messages", _message_body(content, embed)
+        )
+
+    def __str__(self):
+        return f"{self.username}#{self.discriminator}"
+
+
+class FakeNickname:
+    def __init__(self, member):
+        self.member = member
+
+    async def set(self, nick):
+        member = self.member
+        await member.guild.client.rest.request(
+            "PATCH", f"/guilds/{member.guild_id}/members/{member.id}", {"nick": nick}
+        )
+        member.nick = nick
+        member.guild.client.events.dispatch("member_update", member)
+
+
+class FakeRole:
+    def __init__(self, name, position):
+        self.name = name
+        self.position = position
+
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeMember:
+    def __init__(self, guild, user, nick=None):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.id = user.id
+        self.nick = nick
+        self.nickname = FakeNickname(self)
+        self.voice = None
+        self.top_role = guild.roles["@everyone"]
+
+    @property
+    def name(self):
+        return self.nick or self.user.username
+
+    async def send(self, content=None, *, embed=None):
+        await self.user.send(content, embed=embed)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeMember) and (self.id, self.guild_id) == (other.id, other.guild_id)
+
+    def __hash__(self):
+        return hash((self.id, self.guild_id))
+
+    def __str__(self):
+        return self.name
+
+
+def _message_body(content, embed):
+    return {"content": content, "embed": embed.to_dict() if embed is not None else None}
+
+
+class FakeMessages:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, *, embed=None):
+        await self.channel.guild.client.rest.request(
+            "POST", f"/channels/{self.channel.id}/messages", _message_body(content, embed)
+        )
+
+    async def upload(self, fp, *, filename=None, message_embed=None):
+        data = fp.read()
+        await self.channel.guild.client.rest.request(
+            "POST",
+            f"/channels/{self.channel.id}/messages",
+            {"filename": filename, "size": len(data), **_message_body(None, message_embed)},
+        )
+
+
+class FakeTyping:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def __aenter__(self):
+        await self.channel.guild.client.rest.request("POST", f"/channels/{self.channel.id}/typing")
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class FakeChannel:
+    private = False
+
+    def __init__(self, guild, id, name, type, *, parent_id=None, position=0, user_limit=0):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.id = id
+        self.name = name
+        self.type = type
+        self.parent_id = parent_id
+        self.position = position
+        self.user_limit = user_limit
+        self.messages = FakeMessages(self)
+        self.typing = FakeTyping(self)
+        self._voice_members = []
+
+    @property
+    def parent(self):
+        return self.guild.channels.get(self.parent_id)
+
+    @property
+    def children(self):
+        return [chan for chan in self.guild.channels.values() if chan.parent_id == self.id]
+
+    @property
+    def voice_members(self):
+        return list(self._voice_members)
+
+    def effective_permissions(self, member):
+        return AllPermissions()
+
+    async def edit(self, **kwargs):
+        await self.guild.client.rest.request("PATCH", f"/channels/{self.id}", kwargs)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self.guild.client.events.dispatch("channel_update", self)
+
+    async def delete(self):
+        await self.guild.client.rest.request("DELETE", f"/channels/{self.id}")
+        del self.guild.channels[self.id]
+        self.guild.client.events.dispatch("channel_delete", self)
+
+    def __repr__(self):
+        return f"<FakeChannel {self.id} {self.name!r}>"
+
+
+class FakeChannels(dict):
+    def __init__(self, guild):
+        super().__init__()
+        self.guild = guild
+
+    async def create(self, type_, name, *, parent=None, user_limit=0):
+        guild = self.guild
+        data = await guild.client.rest.request(
+            "POST",
+            f"/guilds/{guild.id}/channels",
+            {"type": int(type_), "name": name, "parent_id": parent and parent.id, "user_limit": user_limit},
+        )
+        position = max((chan.position for chan in self.values()), default=0) + 1
+        chan = self[int(data["id"])] = FakeChannel(
+            guild, int(data["id"]), name, type_, parent_id=parent and parent.id, position=position, user_limit=user_limit
+        )
+        guild.client.events.dispatch("channel_create", chan)
+        return chan
+
+
+class FakeGuild:
+    def __init__(self, client, id, name, owner_id):
+        self.client = client
+        self.id = id
+        self.name = name
+        self.owner_id = owner_id
+        self.roles = {"@everyone": FakeRole("@everyone", 0), "Orisa": FakeRole("Orisa", 1)}
+        self.members = {}
+        self.channels = FakeChannels(self)
+        self.me = None
+
+    def add_channel(self, id, name, type, **kwargs):
+        chan = self.channels[id] = FakeChannel(self, id, name, type, **kwargs)
+        return chan
+
+    def add_member(self, user, nick=None):
+        member = self.members[user.id] = FakeMember(self, user, nick)
+        return member
+
+    def __repr__(self):
+        return f"<FakeGuild {self.id} {self.name!r}>"
+
+
+class FakeApplicationInfo:
+    def __init__(self, owner):
+        self.owner = owner
+
+
+class FakeClient:
+    "the parts of curious' Client Orisa uses, guilds are populated by the benchmark"
+
+    def __init__(self, rest, shards):
+        self.rest = rest
+        self.shards = shards
+        self.events = FakeEvents()
+        self.guilds = {}
+        self.users = {}
+        self.application_info = None
+
+    def find_channel(self, channel_id):
+        for guild in self.guilds.values():
+            try:
+                return guild.channels[channel_id]
+            except KeyError:
+                continue
+        return None
+
+    async def get_user(self, user_id):
+        await self.rest.request("GET", f"/users/{user_id}")
+        return self.users[user_id]
+
+
+class FakeContext:
+    def __init__(self, client, author, channel):
+        self.bot = client
+        self.author = author
+        self.channel = channel
+
+
+class FakeGateway:
+    "dispatches gateway events to the plugin like curious would after updating its state"
+
+    def __init__(self, client, plugin):
+        self.client = client
+        self.plugin = plugin
+
+    async def move_voice(self, member, channel):
+        "member joins channel, or leaves voice if channel is None"
+        old = member.voice
+        if old is not None:
+            old.channel._voice_members.remove(member)
+        if channel is not None:
+            channel._voice_members.append(member)
+            member.voice = FakeVoiceState(channel)
+        else:
+            member.voice = None
+        await self.plugin._voice_state_update(None, member, old, member.voice)
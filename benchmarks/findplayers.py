@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the SR range queries of findplayers on the per guild SRIndex with
+# the old approach (all handles in range, then a scan over every member of the
+# guild), and measures index updates when SRs change.
+#
+# usage: benchmarks/findplayers.py [members] [registered members]
+
+import json
+import random
+import sys
+import time
+
+from orisa.sr_index import SRIndex
+from orisa.utils import TDS
+
+MEMBERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+REGISTERED = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+
+random.seed(42)
+
+
+def random_srs():
+    return TDS(*[random.randint(500, 4500) if random.random() < 0.8 else None for _ in range(3)])
+
+
+member_ids = list(range(MEMBERS))
+primary_srs = {member_id: random_srs() for member_id in random.sample(member_ids, REGISTERED)}
+queries = [(role_ix, sr - 250, sr + 250) for role_ix, sr in ((random.randrange(3), random.randint(1000, 4000)) for _ in range(200))]
+
+
+def old_search(role_ix, min_sr, max_sr):
+    in_range = {
+        discord_id
+        for discord_id, srs in primary_srs.items()
+        if srs[role_ix] is not None and min_sr <= srs[role_ix] <= max_sr
+    }
+    return [member_id for member_id in member_ids if member_id in in_range]
+
+
+def timed(func, calls):
+    started = time.perf_counter()
+    results = [func(*args) for args in calls]
+    return (time.perf_counter() - started) / len(calls) * 1000, results
+
+
+started = time.perf_counter()
+index = SRIndex((member_id, primary_srs[member_id]) for member_id in member_ids if member_id in primary_srs)
+build_ms = (time.perf_counter() - started) * 1000
+
+new_ms, new_results = timed(index.range, queries)
+old_ms, old_results = timed(old_search, queries[::10])
+
+same = sum(
+    sorted(discord_id for sr, discord_id in new) == sorted(old)
+    for new, old in zip(new_results[::10], old_results)
+)
+
+updates = [(discord_id, random_srs()) for discord_id in random.sample(list(primary_srs), 1000)]
+update_ms, _ = timed(index.set, updates)
+
+print(json.dumps(
+    {
+        "benchmark": "findplayers",
+        "members": MEMBERS,
+        "registered": REGISTERED,
+        "index_build_ms": build_ms,
+        "indexed_ms_per_query": new_ms,
+        "full_scan_ms_per_query": old_ms,
+        "mean_results": sum(len(result) for result in new_results) / len(new_results),
+        "ms_per_sr_update": update_ms,
+        "same_results": f"{same}/{len(old_results)}",
+    },
+    indent=2,
+))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Measures how long rendering the `!ow help` embeds takes in every locale.
+# Run from the repository root (it needs orisa/config.py), and compare the
+# output between commits.
+
+import json
+import sys
+import timeit
+
+from types import SimpleNamespace
+
+from orisa.i18n import CurrentLocale, get_all_locales
+from orisa.orisa import Orisa
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+fake_orisa = SimpleNamespace(
+    client=SimpleNamespace(
+        application_info=SimpleNamespace(owner=SimpleNamespace(id=3)),
+    ),
+    SYMBOL_DPS=Orisa.SYMBOL_DPS,
+    SYMBOL_TANK=Orisa.SYMBOL_TANK,
+    SYMBOL_SUPPORT=Orisa.SYMBOL_SUPPORT,
+)
+
+
+def render():
+    # bypasses the render cache of the help command on purpose
+    return Orisa._create_help(fake_orisa, 1234)
+
+
+results = {}
+for locale in sorted(get_all_locales()):
+    CurrentLocale.set(locale)
+    seconds = min(timeit.repeat(render, number=ROUNDS, repeat=5))
+    results[locale] = {"us_per_render": seconds / ROUNDS * 1e6}
+
+print(json.dumps({"benchmark": "help_rendering", "rounds": ROUNDS, "results": results}, indent=2))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the member name search of the Member converter with the old
+# approach (strip tags of every member and fuzzy score all of them) on a
+# guild with synthetic members. Also builds the index like the bot does, in
+# chunks on the event loop, and measures the longest time the loop was blocked.
+#
+# usage: benchmarks/member_search.py [members]
+
+import json
+import random
+import string
+import sys
+import time
+
+from types import SimpleNamespace
+
+import trio
+
+from fuzzywuzzy import fuzz, process
+
+from orisa import member_index
+from orisa.member_index import MemberIndex, search, strip_tags, tier_hit_rates
+
+MEMBERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+random.seed(42)
+
+SYLLABLES = ["or", "is", "a", "rein", "har", "dt", "gen", "ji", "mer", "cy", "ana", "zen", "ya", "tta", "lu", "cio", "win", "ston", "dva", "bri", "gi", "tte"]
+
+
+def random_name():
+    name = "".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 4))).capitalize()
+    if random.random() < 0.3:
+        name += str(random.randint(1, 999))
+    if random.random() < 0.2:
+        name = random.choice(string.ascii_uppercase) * 2 + " | " + name
+    if random.random() < 0.5:
+        name += f" [{random.randint(10, 45)}-{random.randint(10, 45)}-{random.randint(10, 45)}]"
+    return name
+
+
+members = [
+    SimpleNamespace(
+        id=i,
+        name=random_name(),
+        user=SimpleNamespace(username=f"user{i}", discriminator=f"{i % 10000:04}"),
+    )
+    for i in range(MEMBERS)
+]
+queries = [strip_tags(random.choice(members).name) for _ in range(20)]
+# some with typos and some prefixes
+queries += [q[:-1] + "x" for q in queries[:10]] + [q[:4] for q in queries[:10]]
+
+
+def old_search(query):
+    def scorer(s1, s2, force_ascii=True, full_process=True):
+        if s1.lower() == s2.lower():
+            return 200
+        else:
+            score = fuzz.WRatio(s1, s2, force_ascii, full_process)
+            if s2.startswith(s1):
+                score *= 2
+            return score
+
+    return process.extractBests(
+        query, {mem.id: strip_tags(mem.name) for mem in members}, scorer=scorer
+    )
+
+
+def timed(func, queries):
+    started = time.perf_counter()
+    results = [func(q) for q in queries]
+    return (time.perf_counter() - started) / len(queries) * 1000, results
+
+
+started = time.perf_counter()
+index = MemberIndex(members)
+build_ms = (time.perf_counter() - started) * 1000
+
+
+async def build_in_background():
+    "the time add_members takes, and the longest another task had to wait meanwhile"
+    background_index = MemberIndex()
+    longest_step = 0
+    async with trio.open_nursery() as nursery:
+        started = time.perf_counter()
+        nursery.start_soon(background_index.add_members, {member.id: member for member in members})
+        while nursery.child_tasks:
+            before = time.perf_counter()
+            await trio.sleep(0)
+            longest_step = max(longest_step, time.perf_counter() - before)
+        took = time.perf_counter() - started
+    return background_index, took * 1000, longest_step * 1000
+
+
+background_index, background_build_ms, background_max_step_ms = trio.run(build_in_background)
+same_background = sum(search([index], q) == search([background_index], q) for q in queries)
+
+new_ms, new_results = timed(lambda q: search([index], q), queries)
+new_results = new_results[::8]
+old_ms, old_results = timed(old_search, queries[::8])
+
+# compare scores, not ids, there are members with the same name
+same_best = sum(
+    new[0][0] == old[0][1] for new, old in zip(new_results, old_results)
+)
+
+print(json.dumps(
+    {
+        "benchmark": "member_search",
+        "members": MEMBERS,
+        "scorer": member_index.SCORER,
+        "index_build_ms": build_ms,
+        "background_build_ms": background_build_ms,
+        "background_build_longest_step_ms": background_max_step_ms,
+        "background_index_same_results": f"{same_background}/{len(queries)}",
+        "indexed_ms_per_search": new_ms,
+        "full_scan_ms_per_search": old_ms,
+        "same_best_match": f"{same_best}/{len(old_results)}",
+        "tier_hit_rates": tier_hit_rates(),
+    },
+    indent=2,
+))
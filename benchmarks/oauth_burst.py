@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Simulates a burst of registrations against a local stub OAuth server and
+# reports throughput and latency of the token exchange, once with the pooled
+# per-provider session and once with a new session per request (which is what
+# the module level asks.get/asks.post do).
+#
+# usage: benchmarks/oauth_burst.py [registrations] [handshake delay in ms]
+
+import json
+import os
+import sys
+import time
+
+# the stub server doesn't speak TLS
+os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+
+import asks
+import trio
+
+from orisa.web import OAUTH_CONNECTIONS, OAuthProvider, fetch_oauth_data
+
+REGISTRATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+# simulated cost of setting up a new (TLS) connection
+HANDSHAKE_DELAY = (int(sys.argv[2]) if len(sys.argv) > 2 else 100) / 1000
+# simulated processing time of the OAuth provider
+RESPONSE_DELAY = 0.02
+
+TOKEN = json.dumps({"access_token": "token", "token_type": "Bearer", "expires_in": 3600}).encode()
+USERINFO = json.dumps({"id": 1234, "battletag": "Orisa#1234"}).encode()
+
+
+async def stub_server(stream):
+    buf = b""
+    await trio.sleep(HANDSHAKE_DELAY)
+    try:
+        while True:
+            while b"\r\n\r\n" not in buf:
+                data = await stream.receive_some(65536)
+                if not data:
+                    return
+                buf += data
+            head, buf = buf.split(b"\r\n\r\n", 1)
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            path = request_line.split(" ")[1]
+            headers = dict(
+                (key.strip().lower(), value.strip())
+                for key, value in (line.split(":", 1) for line in header_lines)
+            )
+            length = int(headers.get("content-length", 0))
+            while len(buf) < length:
+                buf += await stream.receive_some(65536)
+            buf = buf[length:]
+
+            await trio.sleep(RESPONSE_DELAY)
+            body = TOKEN if path.startswith("/oauth/token") else USERINFO
+            await stream.send_all(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+            )
+    except (trio.BrokenResourceError, trio.ClosedResourceError):
+        pass
+
+
+def provider(port, session):
+    return OAuthProvider(
+        token_url=f"http://127.0.0.1:{port}/oauth/token",
+        endpoint=f"http://127.0.0.1:{port}/oauth/userinfo",
+        client_id="client",
+        client_secret="secret",
+        scope=[],
+        session=session,
+    )
+
+
+async def burst(port, pooled):
+    latencies = []
+    shared = provider(port, asks.Session(headers={"Connection": "keep-alive"}, connections=OAUTH_CONNECTIONS))
+
+    async def register(i):
+        started = time.monotonic()
+        prov = shared if pooled else provider(port, asks.Session())
+        await fetch_oauth_data(prov, f"http://127.0.0.1:{port}/?code={i}&state=state")
+        latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    async with trio.open_nursery() as nursery:
+        for i in range(REGISTRATIONS):
+            nursery.start_soon(register, i)
+    took = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        "registrations_per_second": REGISTRATIONS / took,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+async def main():
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(trio.serve_tcp, stub_server, 0)
+        port = listeners[0].socket.getsockname()[1]
+
+        results = {
+            "pooled": await burst(port, pooled=True),
+            "unpooled": await burst(port, pooled=False),
+        }
+        nursery.cancel_scope.cancel()
+
+    print(json.dumps(
+        {
+            "benchmark": "oauth_burst",
+            "registrations": REGISTRATIONS,
+            "handshake_delay_ms": HANDSHAKE_DELAY * 1000,
+            "results": results,
+        },
+        indent=2,
+    ))
+
+
+trio.run(main)
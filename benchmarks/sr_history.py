@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the SR history stored as one row per change (the latest of two equal
+# rows moved forward on every sync) with the same history after migrate_sr_runs
+# converted it to runs: rows, database size and "SR a day ago" lookups.
+#
+# usage: benchmarks/sr_history.py [handles] [days]
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from orisa.models import migrate_sr_runs
+
+HANDLES = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+
+# a sync every two hours, and the chance that one of them changes the SR
+SYNC_INTERVAL = timedelta(hours=2)
+CHANGE_CHANCE = 0.05
+
+random.seed(42)
+
+OLD_SCHEMA = """
+CREATE TABLE srs (
+    id INTEGER PRIMARY KEY,
+    handle_id INTEGER NOT NULL,
+    timestamp DATETIME NOT NULL,
+    tank SMALLINT,
+    damage SMALLINT,
+    support SMALLINT
+);
+CREATE INDEX ix_srs_handle_id ON srs (handle_id);
+"""
+
+
+def old_history(start):
+    "rows of one handle as the old update_sr wrote them, newest first"
+    rows = []
+    values = tuple(random.randint(1000, 4000) for _ in range(3))
+    timestamp = start
+    while timestamp < start + timedelta(days=DAYS):
+        if random.random() < CHANGE_CHANCE:
+            values = tuple(sr + random.randint(-50, 50) for sr in values)
+        if len(rows) > 1 and rows[0][1] == rows[1][1]:
+            rows[0] = (timestamp, values)
+        else:
+            rows.insert(0, (timestamp, values))
+        timestamp += SYNC_INTERVAL
+    return rows
+
+
+def stamp(timestamp):
+    "timestamp as SQLAlchemy stores DateTime in SQLite"
+    return timestamp.isoformat(" ", "microseconds")
+
+
+def size(engine):
+    with engine.connect() as conn:
+        conn.execute("VACUUM")
+    return os.path.getsize(engine.url.database)
+
+
+def timed(func, calls):
+    started = time.perf_counter()
+    results = [func(*args) for args in calls]
+    return (time.perf_counter() - started) / len(calls) * 1000, results
+
+
+def old_lookup(conn, handle_id, when):
+    # what prev_sr in _top_players did: walk the latest 30 rows
+    for timestamp, *values in conn.execute(
+        "SELECT timestamp, tank, damage, support FROM srs WHERE handle_id = ? ORDER BY timestamp DESC LIMIT 30",
+        handle_id,
+    ):
+        if timestamp < when:
+            break
+    return tuple(values)
+
+
+def run_lookup(conn, handle_id, when):
+    row = conn.execute(
+        "SELECT tank, damage, support FROM srs WHERE handle_id = ? AND valid_from <= ? ORDER BY valid_from DESC LIMIT 1",
+        handle_id,
+        when,
+    ).first()
+    return tuple(row)
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    engine = create_engine(f"sqlite:///{tmp}/history.sqlite")
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA.split(";"):
+            if statement.strip():
+                conn.execute(statement)
+        for handle_id in range(1, HANDLES + 1):
+            conn.execute(
+                "INSERT INTO srs (handle_id, timestamp, tank, damage, support) VALUES (?, ?, ?, ?, ?)",
+                [(handle_id, stamp(timestamp), *values) for timestamp, values in reversed(old_history(start))],
+            )
+
+    # lookups a day before the end, where prev_sr usually finds its row; between syncs,
+    # because the old walk skipped a row at exactly that time
+    end = start + timedelta(days=DAYS)
+    queries = [
+        (random.randint(1, HANDLES), stamp(end - timedelta(days=1, minutes=random.randint(0, 600), seconds=30)))
+        for _ in range(2000)
+    ]
+
+    old_rows = engine.execute("SELECT count(*) FROM srs").scalar()
+    old_size = size(engine)
+    with engine.connect() as conn:
+        old_ms, old_results = timed(lambda *args: old_lookup(conn, *args), queries)
+
+    started = time.perf_counter()
+    migrate_sr_runs(engine)
+    migration_s = time.perf_counter() - started
+
+    run_rows = engine.execute("SELECT count(*) FROM srs").scalar()
+    run_size = size(engine)
+    with engine.connect() as conn:
+        run_ms, run_results = timed(lambda *args: run_lookup(conn, *args), queries)
+
+print(json.dumps(
+    {
+        "benchmark": "sr_history",
+        "handles": HANDLES,
+        "days": DAYS,
+        "rows": {"per_change": old_rows, "runs": run_rows},
+        "bytes": {"per_change": old_size, "runs": run_size},
+        "ms_per_point_lookup": {"per_change": old_ms, "runs": run_ms},
+        "migration_s": migration_s,
+        "same_results": f"{sum(old == new for old, new in zip(old_results, run_results))}/{len(queries)}",
+    },
+    indent=2,
+))
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the real Orisa plugin against a fake Discord and a fake playoverwatch.com
+# (see fakes.py) with a seeded database, and prints the results of a few
+# scenarios as JSON, so runs on different commits can be compared:
+#
+#   sync        all handles are due and get synced (including nick updates)
+#   voice       a storm of members joining and leaving managed voice channels
+#   highscores  the highscore cron posting to every guild
+#   config      a config save on the big guild that changes every nick
+#   commands    a burst of !ow commands, with the per-stage times of their traces
+#
+# Orisa's deliberate pauses (between syncs and highscore tables) and the
+# Blizzard request budget are skipped
+# unless --keep-delays is given. Needs a config.py like the bot itself; the
+# database is a fresh SQLite file unless --database is given.
+#
+# usage: benchmarks/suite.py [--users N] [--guilds M] [--scenarios sync,voice] ...
+
+import argparse
+import json
+import logging
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import trio
+
+from sqlalchemy import create_engine
+
+import fakes
+
+from curious.dataclasses.channel import ChannelType
+
+from orisa import i18n, metrics, orisa as orisa_module, stalls, tracing, utils, web
+from orisa.config_classes import GuildConfig, PrefixConfig, VoiceCategoryInfo
+from orisa.i18n import CurrentLocale
+from orisa.models import BattleTag, Database, GuildConfigJson, Handle, SR, User
+from orisa.orisa import Orisa
+from orisa.sharding import Shards
+
+SCENARIOS = ("sync", "voice", "highscores", "config", "commands")
+
+BOT_ID = 10 ** 17
+OWNER_ID = BOT_ID + 1
+USER_ID_BASE = 2 * 10 ** 17
+GUILD_ID_BASE = 3 * 10 ** 17
+CHANNEL_ID_BASE = 4 * 10 ** 17
+
+# days of SR history every handle starts with
+HISTORY_DAYS = 10
+
+# share of the commands scenario per command
+COMMAND_MIX = {"ow": 40, "ow get": 20, "ow help": 15, "ow srgraph": 10, "ow forceupdate": 15}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of Orisa")
+    parser.add_argument("--users", type=int, default=2000, help="registered users")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--big-guild-members", type=int, default=50_000, help="members of the first guild")
+    parser.add_argument("--voice-events", type=int, default=500)
+    parser.add_argument("--voice-rate", type=float, default=50, help="voice events per second")
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20, help="commands in flight at the same time")
+    parser.add_argument("--discord-latency", type=float, default=50, help="ms")
+    parser.add_argument("--blizzard-latency", type=float, default=300, help="ms")
+    parser.add_argument("--database", help="SQLAlchemy URL of an empty database, default is a new SQLite file")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--keep-delays", action="store_true", help="don't skip Orisa's deliberate pauses")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios {', '.join(sorted(unknown))}")
+    return args
+
+
+def create_database(url):
+    if url is None:
+        url = f"sqlite:///{tempfile.mkdtemp(prefix='orisa-bench-')}/orisa.sqlite"
+    if url.startswith("sqlite"):
+        # sessions are used from worker threads
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(url, pool_size=20, max_overflow=10)
+    return Database(engine)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+    return {
+        "count": len(values),
+        "mean": statistics.mean(values),
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": values[-1],
+    }
+
+
+def metric_values():
+    "counter values and histogram counts/sums by series, to report what changed during a scenario"
+    values = {}
+    for metric in metrics.REGISTRY:
+        if isinstance(metric, metrics.Callback):
+            continue
+        for labels, child in metric._children.items():
+            series = metric.name + metrics._format_labels(metric.labelnames, labels)
+            if isinstance(metric, metrics.Histogram):
+                values[series + "_count"] = child.count
+                values[series + "_sum"] = child.sum
+            else:
+                values[series] = child.value
+    return values
+
+
+def metric_deltas(before, after):
+    return {
+        series: round(value - before.get(series, 0), 6)
+        for series, value in sorted(after.items())
+        if value != before.get(series, 0)
+    }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.database = create_database(args.database)
+        self.blizzard = fakes.FakeBlizzard(args.blizzard_latency / 1000)
+        self.discord = fakes.FakeDiscordAPI(args.discord_latency / 1000)
+        self._nursery = None
+
+    async def spawn(self, fn, *args):
+        "replaces Plugin.spawn, so background work started by a scenario is part of it"
+        self._nursery.start_soon(fn, *args)
+
+    # Setup
+
+    async def setup(self, nursery):
+        discord_port = await fakes.start_server(nursery, self.discord.handle)
+        blizzard_port = await fakes.start_server(nursery, self.blizzard.handle)
+        utils.PROFILE_URL = f"http://127.0.0.1:{blizzard_port}/en-us/career/{{type}}/{{handle}}"
+
+        self.client = fakes.FakeClient(fakes.FakeREST(discord_port), Shards((0,), 1))
+        owner = self.client.users[OWNER_ID] = fakes.FakeUser(self.client, OWNER_ID, "Owner")
+        self.client.application_info = fakes.FakeApplicationInfo(owner)
+        bot = self.client.users[BOT_ID] = fakes.FakeUser(self.client, BOT_ID, "Orisa")
+
+        self.orisa = Orisa(self.client, self.database, None)
+        self.orisa.spawn = self.spawn
+        web.client = self.client
+        web.orisa = self.orisa
+
+        if not self.args.keep_delays:
+            orisa_module.SYNC_DELAY = orisa_module.SYNC_DELAY_JITTER = 0
+            orisa_module.HIGHSCORE_TABLE_DELAY = 0
+            utils.BLIZZARD_BUDGET = utils.RequestBudget(10 ** 6)
+
+        started = time.perf_counter()
+        await trio.to_thread.run_sync(self.seed_database)
+        self.seed_guilds(bot)
+        return time.perf_counter() - started
+
+    def handle_name(self, index):
+        return f"Player{index}#{1000 + index % 9000}"
+
+    def seed_database(self):
+        session = self.database.Session()
+        now = datetime.utcnow()
+        for index in range(self.args.users):
+            user = User(discord_id=USER_ID_BASE + index, format="$sr", locale=None)
+            tag = BattleTag(battle_tag=self.handle_name(index), blizzard_id=index, position=0)
+            user.handles.append(tag)
+            srs = self.blizzard.srs(tag.battle_tag.replace("#", "-")) or (None, None, None)
+            for day in range(HISTORY_DAYS, 0, -1):
+                sr = SR(
+                    valid_from=now - timedelta(days=day),
+                    valid_to=now - timedelta(days=day),
+                    **{
+                        role: value and value - day * self.random.randint(0, 30)
+                        for role, value in zip(("tank", "damage", "support"), srs)
+                    },
+                )
+                tag.sr_history.append(sr)
+            tag.current_sr = sr
+            tag.last_checked_at = tag.last_synced_at = sr.valid_to
+            session.add(user)
+            if index % 500 == 499:
+                session.commit()
+        session.commit()
+        session.close()
+
+    def seed_guilds(self, bot):
+        channel_ids = iter(range(CHANNEL_ID_BASE, CHANNEL_ID_BASE + 10 ** 9))
+        session = self.database.Session()
+        for index in range(self.args.guilds):
+            guild_id = GUILD_ID_BASE + index
+            guild = self.client.guilds[guild_id] = fakes.FakeGuild(self.client, guild_id, f"Guild {index}", OWNER_ID)
+            guild.me = guild.add_member(bot)
+            guild.me.top_role = guild.roles["Orisa"]
+            listen = guild.add_channel(next(channel_ids), "orisa", ChannelType.TEXT, position=1)
+            congrats = guild.add_channel(next(channel_ids), "congrats", ChannelType.TEXT, position=2)
+            category = guild.add_channel(next(channel_ids), "Voice", ChannelType.CATEGORY, position=3)
+            for prefix in ("Comp", "QP"):
+                guild.add_channel(next(channel_ids), f"{prefix} #1", ChannelType.VOICE, parent_id=category.id, position=4)
+
+            config = GuildConfig(
+                show_sr_in_nicks_by_default=False,
+                post_highscores=True,
+                post_highscore_time="09:00",
+                congrats_channel_id=congrats.id,
+                listen_channel_id=listen.id,
+                locale=None,
+                managed_voice_categories=[
+                    VoiceCategoryInfo(
+                        category_id=category.id,
+                        channel_limit=8,
+                        remove_unknown=True,
+                        prefixes=[PrefixConfig(name="Comp", limit=6), PrefixConfig(name="QP", limit=0)],
+                        show_sr_in_nicks=True,
+                    )
+                ],
+                extra_register_text=None,
+            )
+            self.orisa.guild_config[guild_id] = config
+            session.add(GuildConfigJson(id=guild_id, config=config.to_json()))
+        session.commit()
+        session.close()
+
+        guilds = list(self.client.guilds.values())
+        for index in range(self.args.users):
+            user = self.client.users[USER_ID_BASE + index] = fakes.FakeUser(
+                self.client, USER_ID_BASE + index, f"user{index}"
+            )
+            for guild in {guilds[index % len(guilds)], guilds[index * 7 % len(guilds)], guilds[0]}:
+                guild.add_member(user)
+
+        # the big guild is mostly unregistered members
+        big_guild = guilds[0]
+        for index in range(len(big_guild.members), self.args.big_guild_members):
+            user_id = USER_ID_BASE + self.args.users + index
+            user = self.client.users[user_id] = fakes.FakeUser(self.client, user_id, f"lurker{index}")
+            big_guild.add_member(user)
+
+    def registered_members(self, guild):
+        return [
+            member for member in guild.members.values() if USER_ID_BASE <= member.id < USER_ID_BASE + self.args.users
+        ]
+
+    # Scenarios
+
+    async def run(self, scenario):
+        discord_before = Counter(self.discord.requests)
+        blizzard_before = self.blizzard.requests
+        metrics_before = metric_values()
+        started = time.perf_counter()
+        async with trio.open_nursery() as nursery:
+            self._nursery = nursery
+            result = await scenario()
+        took = time.perf_counter() - started
+        discord = Counter(self.discord.requests)
+        discord.subtract(discord_before)
+        return {
+            "seconds": took,
+            **result,
+            "discord_requests": {route: count for route, count in sorted(discord.items()) if count},
+            "blizzard_requests": self.blizzard.requests - blizzard_before,
+            "metrics": metric_deltas(metrics_before, metric_values()),
+        }
+
+    async def sync(self):
+        async with self.database.session() as session:
+            ids = [id for (id,) in await trio.to_thread.run_sync(session.query(Handle.id).all)]
+        # a new season, so most handles have a new SR
+        self.blizzard.season += 1
+        started = time.perf_counter()
+        await self.orisa._sync_handles(ids)
+        took = time.perf_counter() - started
+        return {"handles": len(ids), "handles_per_second": len(ids) / took}
+
+    async def voice(self):
+        gateway = fakes.FakeGateway(self.client, self.orisa)
+        guilds = list(self.client.guilds.values())
+        # the big guild has mostly lurkers, pick from the first few hundred members
+        candidates = {guild.id: list(guild.members.values())[:500] for guild in guilds}
+        latencies = []
+
+        async def event(member, channel):
+            started = time.perf_counter()
+            await gateway.move_voice(member, channel)
+            latencies.append(time.perf_counter() - started)
+
+        in_voice = []
+        async with trio.open_nursery() as nursery:
+            for _ in range(self.args.voice_events):
+                guild = self.random.choice(guilds)
+                if in_voice and self.random.random() < 0.4:
+                    member = in_voice.pop(self.random.randrange(len(in_voice)))
+                    channel = None
+                else:
+                    member = self.random.choice(candidates[guild.id])
+                    category_id = self.orisa.guild_config[guild.id].managed_voice_categories[0].category_id
+                    channels = guild.channels[category_id].children
+                    if not channels:
+                        continue
+                    channel = self.random.choice(channels)
+                    if member.voice is None:
+                        in_voice.append(member)
+                nursery.start_soon(event, member, channel)
+                await trio.sleep(1 / self.args.voice_rate)
+
+        return {"events": len(latencies), "latency": percentiles(latencies)}
+
+    async def highscores(self):
+        guild_ids = list(self.client.guilds.keys())
+        await self.orisa._top_players(guild_ids)
+        return {"guilds": len(guild_ids)}
+
+    async def config(self):
+        guild = next(iter(self.client.guilds.values()))
+        config = self.orisa.guild_config[guild.id]
+        new_config = GuildConfig.from_json2(config.to_json())
+        new_config.show_sr_in_nicks_by_default = not config.show_sr_in_nicks_by_default
+
+        test_client = web.app.test_client()
+        started = time.perf_counter()
+        response = await test_client.put(
+            f"{web.OAUTH_REDIRECT_PATH}guild_config/{guild.id}",
+            data=new_config.to_json(),
+            headers={"Authorization": f"Bearer {web.create_token(guild.id)}"},
+        )
+        accepted = time.perf_counter() - started
+        return {"status": response.status_code, "members": len(guild.members), "accepted_seconds": accepted}
+
+    async def commands(self):
+        guilds = list(self.client.guilds.values())
+        commands = list(COMMAND_MIX)
+        weights = list(COMMAND_MIX.values())
+        latencies = defaultdict(list)
+        traces = []
+        limit = trio.CapacityLimiter(self.args.concurrency)
+
+        async def invoke(command, ctx, other):
+            async with limit:
+                CurrentLocale.set(i18n.DEFAULT_LOCALE)
+                started = time.perf_counter()
+                with tracing.trace(command) as trace:
+                    try:
+                        if command == "ow":
+                            await self.orisa.ow(ctx)
+                        elif command == "ow get":
+                            await self.orisa.get(ctx, member=other)
+                        elif command == "ow help":
+                            await self.orisa.help(ctx)
+                        elif command == "ow srgraph":
+                            await self.orisa.srgraph(ctx)
+                        else:
+                            await self.orisa.forceupdate(ctx)
+                    except Exception:
+                        logging.exception("%s failed", command)
+                latencies[command].append(time.perf_counter() - started)
+                traces.append(trace)
+
+        async with trio.open_nursery() as nursery:
+            for _ in range(self.args.commands):
+                guild = self.random.choice(guilds)
+                members = self.registered_members(guild)
+                author, other = self.random.choice(members), self.random.choice(members)
+                channel = guild.channels[self.orisa.guild_config[guild.id].listen_channel_id]
+                command = self.random.choices(commands, weights)[0]
+                nursery.start_soon(invoke, command, fakes.FakeContext(self.client, author, channel), other)
+
+        stages = defaultdict(float)
+        for trace in traces:
+            for stage, duration in trace.stage_totals().items():
+                stages[stage] += duration
+        return {
+            "commands": sum(len(values) for values in latencies.values()),
+            "latency": {command: percentiles(values) for command, values in sorted(latencies.items())},
+            "stage_seconds": dict(sorted(stages.items())),
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    bench = Bench(args)
+    trio.hazmat.add_instrument(stalls.StallDetector())
+    results = {}
+    async with trio.open_nursery() as nursery:
+        seed_seconds = await bench.setup(nursery)
+        for name in args.scenarios:
+            logging.info("Running %s", name)
+            results[name] = await bench.run(getattr(bench, name))
+        nursery.cancel_scope.cancel()
+
+    output = json.dumps(
+        {
+            "benchmark": "suite",
+            "commit": git_commit(),
+            "started_at": datetime.utcnow().isoformat(),
+            "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "log_level")},
+            "seed_seconds": seed_seconds,
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level, stream=sys.stderr)
+    trio.run(main, args)
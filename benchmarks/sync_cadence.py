@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Simulates the sync scheduler on SR histories: Blizzard requests with the old
+# fixed 120-130 minute cadence compared to the adaptive one of sync_delay, and
+# how long it takes until an SR change is noticed.
+#
+# With a database URI, the SR changes are replayed from its srs table (the start
+# of every run but the first), otherwise a synthetic population of daily, weekly
+# and dormant players is used, some of them with visible "playing Overwatch"
+# presence, which triggers a sync shortly after they stop playing.
+#
+# usage: benchmarks/sync_cadence.py [database uri]
+
+import json
+import random
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select
+
+from orisa.models import SR, Handle, sync_delay
+
+DAYS = 60
+# player kind: (share of the players, SR changes per day)
+KINDS = {"daily": (0.3, 3), "weekly": (0.3, 0.3), "dormant": (0.4, 0.01)}
+# share of the synthetic players whose presence is visible
+PRESENCE_SHARE = 0.5
+# the sync after someone stopped playing, see _member_update
+STOPPED_PLAYING_DELAY = timedelta(seconds=20)
+
+random.seed(42)
+
+
+def fixed_delay(idle):
+    return timedelta(minutes=random.randint(120, 130))
+
+
+def adaptive_delay(idle):
+    return sync_delay(0, idle)
+
+
+def simulate(changes, start, end, delay, presence):
+    "returns the number of syncs and how long each change took to be noticed"
+    syncs = 0
+    noticed_after = []
+    last_active = start
+    next_change = 0
+    time = start
+    while time < end:
+        syncs += 1
+        while next_change < len(changes) and changes[next_change] <= time:
+            noticed_after.append(time - changes[next_change])
+            last_active = time
+            next_change += 1
+
+        next_sync = time + delay(time - last_active)
+        if presence and next_change < len(changes) and changes[next_change] + STOPPED_PLAYING_DELAY < next_sync:
+            # they played, and the SR changed when they stopped
+            next_sync = changes[next_change] + STOPPED_PLAYING_DELAY
+            last_active = changes[next_change]
+        time = next_sync
+    return syncs, noticed_after
+
+
+def synthetic_histories():
+    start = datetime(2020, 1, 1)
+    end = start + timedelta(days=DAYS)
+    histories = []
+    for kind, (share, per_day) in KINDS.items():
+        for _ in range(int(1000 * share)):
+            changes = sorted(
+                start + timedelta(days=random.uniform(0, DAYS)) for _ in range(int(random.expovariate(1 / (per_day * DAYS))))
+            )
+            histories.append((kind, changes, start, end, random.random() < PRESENCE_SHARE))
+    return histories
+
+
+def replayed_histories(uri):
+    engine = create_engine(uri)
+    srs, handles = SR.__table__, Handle.__table__
+    runs = defaultdict(list)
+    for handle_id, valid_from in engine.execute(
+        select([srs.c.handle_id, srs.c.valid_from]).order_by(srs.c.handle_id, srs.c.valid_from)
+    ):
+        runs[handle_id].append(valid_from)
+    ends = {handle_id: end for handle_id, end in engine.execute(select([handles.c.id, handles.c.last_synced_at]))}
+    return [
+        ("replayed", starts[1:], starts[0], ends.get(handle_id) or starts[-1], False)
+        for handle_id, starts in runs.items()
+        if len(starts) > 1
+    ]
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def summary(syncs, days, noticed_after):
+    hours = sorted(delta.total_seconds() / 3600 for delta in noticed_after)
+    return {
+        "requests_per_handle_day": syncs / days if days else None,
+        "changes": len(hours),
+        "hours_until_noticed": {
+            "mean": sum(hours) / len(hours) if hours else None,
+            "p50": percentile(hours, 0.5),
+            "p90": percentile(hours, 0.9),
+            "p99": percentile(hours, 0.99),
+        },
+    }
+
+
+histories = replayed_histories(sys.argv[1]) if len(sys.argv) > 1 else synthetic_histories()
+
+results = {}
+for kind in sorted({kind for kind, *_ in histories}) + ["all"]:
+    selected = [history for history in histories if kind in ("all", history[0])]
+    days = sum((end - start).total_seconds() / 86400 for _, _, start, end, _ in selected)
+    results[kind] = {}
+    for name, delay in (("fixed", fixed_delay), ("adaptive", adaptive_delay)):
+        syncs, noticed_after = 0, []
+        for _, changes, start, end, presence in selected:
+            handle_syncs, handle_noticed_after = simulate(changes, start, end, delay, presence)
+            syncs += handle_syncs
+            noticed_after.extend(handle_noticed_after)
+        results[kind][name] = summary(syncs, days, noticed_after)
+    fixed, adaptive = (results[kind][name]["requests_per_handle_day"] for name in ("fixed", "adaptive"))
+    results[kind]["requests_saved"] = 1 - adaptive / fixed if fixed else None
+
+print(json.dumps(
+    {
+        "benchmark": "sync_cadence",
+        "source": "replayed" if len(sys.argv) > 1 else "synthetic",
+        "handles": len(histories),
+        "results": results,
+    },
+    indent=2,
+))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Write amplification of syncs: rows written per table when every sync moves the
+# end of the current SR run forward (as before) compared to when syncs only update
+# the bookkeeping columns of the handle and the SR history is only written when
+# the values change.
+#
+# usage: benchmarks/sync_writes.py [handles] [sync rounds]
+
+import json
+import random
+import re
+import sys
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event
+
+from orisa.models import SR, BattleTag, Database, User
+from orisa.utils import TDS
+
+HANDLES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+# per sync, the chance that the SR changed and that the request failed
+CHANGE_CHANCE = 0.05
+ERROR_CHANCE = 0.02
+
+SYNC_INTERVAL = timedelta(hours=2)
+
+WRITE = re.compile(r"^\s*(INSERT INTO|UPDATE|DELETE FROM) (\w+)", re.IGNORECASE)
+
+
+def sync_before(handle, srs, timestamp):
+    "the sync before bookkeeping columns, moving valid_to of the current run on every sync"
+    if srs is None:
+        handle.error_count += 1
+        srs = handle.sr or TDS(None, None, None)
+    else:
+        handle.error_count = 0
+    if handle.current_sr is not None and handle.current_sr.values == srs:
+        handle.current_sr.valid_to = timestamp
+    else:
+        sr = SR(valid_from=timestamp, valid_to=timestamp, tank=srs.tank, damage=srs.damage, support=srs.support)
+        handle.sr_history.append(sr)
+        handle.current_sr = sr
+
+
+def sync_after(handle, srs, timestamp):
+    if srs is None:
+        handle.error_count += 1
+        handle.record_sync(timestamp=timestamp)
+    else:
+        handle.error_count = 0
+        handle.update_sr(srs, timestamp=timestamp)
+
+
+def outcomes():
+    "per round, per handle: the new SRs, or None for a failed request"
+    rng = random.Random(42)
+    srs = [TDS(*[rng.randint(1000, 4000) for _ in range(3)]) for _ in range(HANDLES)]
+    rounds = []
+    for _ in range(ROUNDS):
+        results = []
+        for i in range(HANDLES):
+            if rng.random() < CHANGE_CHANCE:
+                srs[i] = TDS(*[sr + rng.randint(-50, 50) for sr in srs[i]])
+            results.append(None if rng.random() < ERROR_CHANCE else srs[i])
+        rounds.append(results)
+    return rounds
+
+
+def run(sync, rounds, tmp):
+    engine = create_engine(f"sqlite:///{tmp}/{sync.__name__}.sqlite")
+    database = Database(engine)
+    # like a sync, which loads its handle first, so setting an unchanged value is not a write
+    session = database.Session(expire_on_commit=False)
+    start = datetime(2020, 1, 1)
+
+    handles = []
+    for i in range(HANDLES):
+        user = User(discord_id=i, format="$sr")
+        handle = BattleTag(battle_tag=f"Player{i}#1234", position=0, error_count=0)
+        user.handles.append(handle)
+        session.add(user)
+        handles.append(handle)
+    session.commit()
+
+    writes = Counter()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        match = WRITE.match(statement)
+        if match:
+            rows = len(parameters) if executemany else 1
+            writes[f"{match.group(2).lower()} {match.group(1).split()[0].lower()}"] += rows
+
+    for round, results in enumerate(rounds):
+        timestamp = start + round * SYNC_INTERVAL
+        for handle, srs in zip(handles, results):
+            sync(handle, srs, timestamp)
+        session.commit()
+
+    syncs = HANDLES * ROUNDS
+    return {
+        "rows_written_per_sync": {key: value / syncs for key, value in sorted(writes.items())},
+        "srs_rows": session.query(SR).count(),
+    }
+
+
+rounds = outcomes()
+with tempfile.TemporaryDirectory() as tmp:
+    before = run(sync_before, rounds, tmp)
+    after = run(sync_after, rounds, tmp)
+
+print(json.dumps(
+    {
+        "benchmark": "sync_writes",
+        "handles": HANDLES,
+        "rounds": ROUNDS,
+        "change_chance": CHANGE_CHANCE,
+        "error_chance": ERROR_CHANCE,
+        "before": before,
+        "after": after,
+    },
+    indent=2,
+))
@@ -29,6 +29,7 @@ from .config import SENTRY_DSN, BOT_TOKEN, GLADOS_TOKEN, MASHERY_API_KEY, DEVELO
 from .i18n import I18NCommandsManager
 from .models import Database
 from .orisa import Orisa, OrisaClient
+from .sharding import Shards, internal_web_address
 
 
 multio.init("trio")
@@ -57,20 +58,33 @@ else:
     logger.info("NOT USING SENTRY")
 
 
-client = OrisaClient(BOT_TOKEN)
+shards = Shards.from_environment()
+logger.info("Handling %s", shards)
+if shards.is_sharded and not internal_web_address():
+    # guild configs of our guilds couldn't be changed through the web interface
+    logger.critical("INTERNAL_WEB_ADDRESS is required when the shards are split over several processes")
+    raise SystemExit(1)
+
+client = OrisaClient(BOT_TOKEN, shards=shards)
 
 database = Database()
 
 manager = I18NCommandsManager.with_client(client, command_prefix="!" if not DEVELOPMENT else ",")
 
 already_loaded = False
+ready_shards = set()
 
 @client.event("ready")
 async def ready(ctx):
     global already_loaded
 
+    ready_shards.add(ctx.shard_id)
+
     if already_loaded:
         logger.info("Ignoring second call to ready")
+    elif ready_shards < shards.shard_ids:
+        # the plugin loads the configs of all guilds we know of, so wait for all our shards
+        logger.info("Shard %d ready, waiting for shards %s", ctx.shard_id, sorted(shards.shard_ids - ready_shards))
     else:
         already_loaded  = True
         await manager.load_plugin(Orisa, database, raven_client)
@@ -81,4 +95,4 @@ async def ready(ctx):
     await ctx.bot.change_status(game=Game(name=msg, type=GameType.LISTENING_TO))
 
 
-client.run()
+client.run(shard_count=shards.shard_count, autoshard=False)
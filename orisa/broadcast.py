@@ -0,0 +1,225 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Delivery of broadcast jobs (messages to many users or channels).
+
+Jobs and the status of every recipient are stored in the database, so a job
+interrupted by a restart continues where it stopped."""
+import logging
+import time
+
+from dataclasses import dataclass
+from datetime import timedelta
+
+import trio
+
+from .models import BROADCAST_FAILED, BROADCAST_PENDING, BROADCAST_SENT
+
+logger = logging.getLogger(__name__)
+
+# requests per second, Discord's global limit is 50 and a DM needs two requests
+# (opening the DM channel and sending), so this leaves room for everything else
+BROADCAST_RATE = 20
+
+# deliveries in flight at the same time
+BROADCAST_CONCURRENCY = 10
+
+# how many times a delivery is tried before the recipient is marked as failed
+DELIVERY_ATTEMPTS = 3
+
+# how often results are written to the database (and cancellation is checked).
+# If the process dies, recipients delivered since the last write get the message again
+RESULT_FLUSH_INTERVAL = 5
+
+# how often progress is reported
+PROGRESS_INTERVAL = 60
+
+
+class RateLimiter:
+    "token bucket allowing rate acquisitions per second on average, and bursts of up to burst"
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = trio.current_time()
+        self._lock = trio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = trio.current_time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await trio.sleep((tokens - self._tokens) / self.rate)
+
+
+@dataclass
+class Progress:
+    job_id: int
+    total: int
+    sent: int
+    failed: int
+    # delivered (or failed) since this run started, for the ETA
+    done_in_run: int = 0
+    started: float = 0.0
+    cancelled: bool = False
+
+    @property
+    def pending(self):
+        return self.total - self.sent - self.failed
+
+    @property
+    def eta(self):
+        elapsed = time.monotonic() - self.started
+        if not self.done_in_run or not elapsed:
+            return None
+        return timedelta(seconds=round(self.pending * elapsed / self.done_in_run))
+
+    def __str__(self):
+        if self.cancelled:
+            state = "cancelled"
+        elif not self.pending:
+            state = "done"
+        else:
+            eta = self.eta
+            state = f"ETA {eta}" if eta is not None else "ETA unknown"
+        return (
+            f"Broadcast #{self.job_id}: {self.sent} sent, {self.failed} failed, "
+            f"{self.pending} pending of {self.total} ({state})"
+        )
+
+
+async def run_broadcast(
+    database,
+    job_id,
+    deliver,
+    report,
+    *,
+    permanent_errors=(),
+    rate=BROADCAST_RATE,
+    concurrency=BROADCAST_CONCURRENCY,
+    requests_per_delivery=1,
+):
+    """Delivers the pending recipients of job_id.
+
+    deliver(target_id) sends the message to one recipient; exceptions in permanent_errors
+    fail the recipient immediately, other exceptions are retried. report(progress) is
+    awaited every PROGRESS_INTERVAL and at the end."""
+
+    async with database.session() as session:
+        recipients = await database.broadcast_recipients(session, job_id)
+        cancelled = await database.save_broadcast_results(session, job_id, {})
+
+    progress = Progress(
+        job_id,
+        total=sum(len(ids) for ids in recipients.values()),
+        sent=len(recipients[BROADCAST_SENT]),
+        failed=len(recipients[BROADCAST_FAILED]),
+        started=time.monotonic(),
+    )
+    limiter = RateLimiter(rate)
+    results = {}
+
+    async def flush():
+        nonlocal results
+        pending, results = results, {}
+        try:
+            async with database.session() as session:
+                return await database.save_broadcast_results(session, job_id, pending)
+        except Exception:
+            logger.exception("Unable to save results of broadcast %d, retrying later", job_id)
+            # newer results take precedence
+            results = {**pending, **results}
+            return False
+
+    async def deliver_one(target_id):
+        for attempt in range(1, DELIVERY_ATTEMPTS + 1):
+            await limiter.acquire(requests_per_delivery)
+            try:
+                await deliver(target_id)
+            except permanent_errors as e:
+                return BROADCAST_FAILED, repr(e)
+            except Exception as e:
+                logger.info("Attempt %d to deliver broadcast %d to %d failed", attempt, job_id, target_id, exc_info=True)
+                error = repr(e)
+            else:
+                return BROADCAST_SENT, None
+        return BROADCAST_FAILED, error
+
+    async def worker(recv_ch):
+        async with recv_ch:
+            async for target_id in recv_ch:
+                status, error = await deliver_one(target_id)
+                results[target_id] = status, error
+                progress.done_in_run += 1
+                if status == BROADCAST_SENT:
+                    progress.sent += 1
+                else:
+                    progress.failed += 1
+
+    async def flusher(cancel_scope):
+        while True:
+            await trio.sleep(RESULT_FLUSH_INTERVAL)
+            if await flush():
+                logger.info("Broadcast %d was cancelled", job_id)
+                progress.cancelled = True
+                cancel_scope.cancel()
+
+    async def send_report():
+        try:
+            await report(progress)
+        except Exception:
+            logger.exception("Unable to report progress of broadcast %d", job_id)
+
+    async def reporter():
+        while True:
+            await trio.sleep(PROGRESS_INTERVAL)
+            await send_report()
+
+    if cancelled:
+        progress.cancelled = True
+    else:
+        logger.info("Starting broadcast %d with %d pending recipients", job_id, progress.pending)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(flusher, nursery.cancel_scope)
+            nursery.start_soon(reporter)
+
+            async with trio.open_nursery() as workers:
+                send_ch, recv_ch = trio.open_memory_channel(0)
+                async with recv_ch:
+                    for _ in range(concurrency):
+                        workers.start_soon(worker, recv_ch.clone())
+                async with send_ch:
+                    for target_id in recipients[BROADCAST_PENDING]:
+                        await send_ch.send(target_id)
+
+            nursery.cancel_scope.cancel()
+
+    while results:
+        # the results must be saved before the job is finished
+        if await flush():
+            progress.cancelled = True
+        elif results:
+            await trio.sleep(RESULT_FLUSH_INTERVAL)
+
+    async with database.session() as session:
+        await database.finish_broadcast(session, job_id, cancelled=progress.cancelled)
+
+    logger.info("%s", progress)
+    await send_report()
+    return progress
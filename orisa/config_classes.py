@@ -14,7 +14,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-__all__ = ["GuildConfig", "VoiceCategoryInfo", "PrefixConfig"]
+__all__ = ["GuildConfig", "VoiceCategoryInfo", "PrefixConfig", "GuildConfigChanges", "diff_guild_configs"]
 
 import json
 import typing
@@ -127,3 +127,36 @@ class VoiceCategoryInfo:
     # the SR/rank when in this category,
     # even when change_nicks_by_default is False?
     show_sr_in_nicks: bool
+
+
+@dataclass
+class GuildConfigChanges:
+    # voice categories that are new or whose settings changed,
+    # their channels need to be adjusted
+    changed_categories: List[VoiceCategoryInfo]
+    # a guild wide setting changed that influences every nick
+    all_nicks: bool
+    # categories whose show_sr_in_nicks changed, only members
+    # in their voice channels need a nick update
+    nick_category_ids: Set[int]
+
+
+def diff_guild_configs(old: GuildConfig, new: GuildConfig) -> GuildConfigChanges:
+    old_categories = {vc.category_id: vc for vc in old.managed_voice_categories}
+
+    changed_categories = [
+        vc for vc in new.managed_voice_categories
+        if old_categories.get(vc.category_id) != vc
+    ]
+
+    def sr_categories(config):
+        return {vc.category_id for vc in config.managed_voice_categories if vc.show_sr_in_nicks}
+
+    return GuildConfigChanges(
+        changed_categories=changed_categories,
+        all_nicks=(
+            old.show_sr_in_nicks_by_default != new.show_sr_in_nicks_by_default
+            or old.locale != new.locale
+        ),
+        nick_category_ids=sr_categories(old) ^ sr_categories(new),
+    )
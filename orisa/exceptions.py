@@ -12,17 +12,42 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# the kind attributes of the profile request errors are the keys of utils.NEGATIVE_CACHE_TTLS
+
+
 class InvalidBattleTag(RuntimeError):
+    kind = "not_found"
+
     def __init__(self, message):
         self.message = message
 
 
 class BlizzardError(RuntimeError):
-    pass
+    kind = "error"
+
+
+class BlizzardTimeout(BlizzardError):
+    kind = "timeout"
+
+
+class BlizzardServerError(BlizzardError):
+    "a 5xx response"
+    kind = "server_error"
+
+
+class BlizzardUnavailable(BlizzardError):
+    "not asked, requests to Blizzard are paused after too many failures"
+    kind = "unavailable"
 
 
 class UnableToFindSR(RuntimeError):
-    pass
+    "a profile without competitive data"
+    kind = "no_competitive"
+
+
+class PrivateProfile(UnableToFindSR):
+    kind = "private"
 
 
 class NicknameTooLong(RuntimeError):
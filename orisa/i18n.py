@@ -1,13 +1,18 @@
 import gettext
 import logging
+import os
 import re
+import time
 
 from contextvars import ContextVar
+from types import MappingProxyType
 
 from curious.commands.manager import CommandsManager
 from curious.core.event import EventContext
 from curious.dataclasses.message import Message
-from trio.to_thread import run_sync
+from trio import to_thread
+
+from . import metrics, tracing
 
 logger = logging.getLogger(__name__)
 
@@ -38,10 +43,22 @@ FLAG_TO_LOCALE = {
 }
 FLAG_TO_LOCALE["🇬🇧"] = "en"
 
-TRANSLATIONS = {
-    locale: gettext.translation("bot", localedir="orisa/locale", languages=[locale])
-    for locale in LOCALES
-}
+LOCALE_DIR = os.path.join(os.path.dirname(__file__), "locale")
+
+
+def load_translations(localedir=LOCALE_DIR):
+    # gettext.translation caches the catalogs it has loaded, so read the .mo files ourselves
+    translations = {}
+    for locale in LOCALES:
+        with open(os.path.join(localedir, locale, "LC_MESSAGES", "bot.mo"), "rb") as f:
+            translations[locale] = gettext.GNUTranslations(f)
+    return translations
+
+
+TRANSLATIONS = load_translations()
+
+_MULTI_RE = re.compile(r"^<<([*\w]+)>> (.*?)$", re.MULTILINE | re.DOTALL)
+
 
 class MultiString(str):
     """fluent inspired string that can take multiple conditions.
@@ -62,7 +79,7 @@ class MultiString(str):
     def __new__(cls, val):
         if val.startswith("<<"):
             value_map = {}
-            for key, text in re.findall(r"^<<([*\w]+)>> (.*?)$", val, re.MULTILINE | re.DOTALL):
+            for key, text in _MULTI_RE.findall(val):
                 if key.startswith("*"):
                     default = text
                     key = key[1:]
@@ -71,7 +88,7 @@ class MultiString(str):
             return super().__new__(cls, val)
 
         inst = super().__new__(cls, default)
-        inst.value_map = value_map
+        inst.value_map = MappingProxyType(value_map)
         return inst
 
     def __getitem__(self, key):
@@ -83,32 +100,64 @@ class MultiString(str):
 
 class I18NCommandsManager(CommandsManager):
     async def handle_commands(self, ctx: EventContext, message: Message):
-        guild_id = message.guild_id
         try:
             orisa = self.plugins["Orisa"]
         except KeyError:
             logger.debug("Not initialized yet, ignoring command")
             return
+
+        command = self._command_label(orisa, message.content)
+        if command is None:
+            self._set_locale(orisa, message)
+            return await super().handle_commands(ctx, message)
+
+        started = time.perf_counter()
+        with tracing.trace(command):
+            try:
+                with tracing.span(tracing.DISPATCH, "locale"):
+                    self._set_locale(orisa, message)
+                return await super().handle_commands(ctx, message)
+            finally:
+                metrics.COMMAND_SECONDS.labels(command).observe(time.perf_counter() - started)
+
+    def _set_locale(self, orisa, message):
+        guild_id = message.guild_id
         # guild_config is a defaultdict, so we can just lookup, even if guild_id is None
         locale = orisa.guild_config[guild_id].locale
 
         if not locale:
             locale = orisa._welcome_language.get(guild_id, None)
 
-        # update locale for user, or get locale from user if we have no locale
-        async with orisa.database.session() as session:
-            user = await orisa.database.user_by_discord_id(session, message.author_id)
-            if user:
-                if locale:
-                    if user.locale != locale:
-                        user.locale = locale
-                        await run_sync(session.commit)
-                elif guild_id is None:
-                    # only change language in private messages
-                    locale = user.locale
+        # update locale for user, or get locale from user if we have no locale.
+        # user_locales only contains registered users
+        if message.author_id in orisa.user_locales:
+            if locale:
+                orisa.set_user_locale(message.author_id, locale)
+            elif guild_id is None:
+                # only change language in private messages
+                locale = orisa.user_locales[message.author_id]
 
         CurrentLocale.set(locale or DEFAULT_LOCALE)
-        return await super().handle_commands(ctx, message)
+
+    def _command_label(self, plugin, content):
+        "the (sub)command content invokes as metrics label, None if it's no command of plugin"
+        prefix = getattr(self, "command_prefix", None)
+        if not isinstance(prefix, str):
+            prefix = "!"
+        if not content or not content.startswith(prefix):
+            return None
+        words = content[len(prefix) :].split(maxsplit=2)
+
+        def known(name):
+            # commands and ow subcommands are public methods of the plugin
+            return not name.startswith("_") and callable(getattr(type(plugin), name, None))
+
+        if not words or not known(words[0]):
+            return None
+        if words[0] == "ow" and len(words) > 1:
+            # arbitrary user input must not become a label
+            return f"ow {words[1] if known(words[1]) else 'other'}"
+        return words[0]
 
 def N_(x):
     "No-op to mark strings that need to be translated, but not at this exact spot"
@@ -117,22 +166,69 @@ def N_(x):
 def NP_(sing, plural):
     return sing
 
+def compile_catalogs(translations):
+    """Parses all gettext catalogs into MultiStrings once.
+
+    Returns a dict of locale to a dict of msgid (or (msgid, plural index)) to MultiString.
+    Strings a locale hasn't translated yet map to the English original, so every msgid
+    known to any catalog is a single dict lookup.
+    """
+    catalogs = {
+        # the empty msgid is the catalog's metadata
+        locale: {key: MultiString(text) for key, text in translation._catalog.items() if key}
+        for locale, translation in translations.items()
+    }
+
+    default = {
+        key: MultiString(key)
+        for catalog in catalogs.values()
+        for key in catalog
+        if isinstance(key, str)
+    }
+
+    for catalog in catalogs.values():
+        for key, text in default.items():
+            catalog.setdefault(key, text)
+
+    catalogs[DEFAULT_LOCALE] = default
+
+    return catalogs
+
+
+CATALOGS = compile_catalogs(TRANSLATIONS)
+
+
+async def reload_catalogs():
+    """Reads the .mo files again and swaps in the new catalogs.
+
+    If anything goes wrong, the old catalogs stay active."""
+    global TRANSLATIONS, CATALOGS
+
+    translations = await to_thread.run_sync(load_translations)
+    catalogs = await to_thread.run_sync(compile_catalogs, translations)
+
+    TRANSLATIONS, CATALOGS = translations, catalogs
+
+
 def _(msg):
     locale = CurrentLocale.get()
     return get_translation(locale, msg)
 
 def get_translation(locale, msg):
-    if locale and locale != DEFAULT_LOCALE:
-        return MultiString(TRANSLATIONS[locale].gettext(msg))
-    else:
+    try:
+        return CATALOGS[locale or DEFAULT_LOCALE][msg]
+    except KeyError:
+        # not a known msgid, like a handle type or some other dynamic value
         return MultiString(msg)
 
 def ngettext(singular, plural, n):
     locale = CurrentLocale.get()
     if locale and locale != DEFAULT_LOCALE:
-        return MultiString(TRANSLATIONS[locale].ngettext(singular, plural, n))
-    else:
-        return MultiString(singular if n==1 else plural)
+        try:
+            return CATALOGS[locale][singular, TRANSLATIONS[locale].plural(n)]
+        except KeyError:
+            pass
+    return MultiString(singular if n==1 else plural)
 
 def locale_by_flag(flag):
     return FLAG_TO_LOCALE.get(flag, None)
@@ -0,0 +1,96 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Runs Orisa in several local processes, each handling some of the shards.
+
+Meant for testing sharding locally, e.g.
+
+    python -m orisa.launcher --shards 4 --processes 2
+
+starts two processes handling shards 0-1 and 2-3, with their internal web
+servers on 127.0.0.1:8100 and 8101. If one process exits, the others are
+stopped too."""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from .sharding import INTERNAL_WEB_ADDRESS_ENV, SHARD_COUNT_ENV, SHARD_IDS_ENV
+
+logger = logging.getLogger("orisa.launcher")
+
+
+def split_shards(shard_count, processes):
+    "splits range(shard_count) into processes contiguous, roughly equal parts"
+    per_process, extra = divmod(shard_count, processes)
+    parts = []
+    start = 0
+    for ix in range(processes):
+        end = start + per_process + (1 if ix < extra else 0)
+        parts.append(range(start, end))
+        start = end
+    return parts
+
+
+def launch(shard_count, processes, internal_port):
+    children = []
+    for ix, shard_ids in enumerate(split_shards(shard_count, processes)):
+        env = dict(
+            os.environ,
+            **{
+                SHARD_COUNT_ENV: str(shard_count),
+                SHARD_IDS_ENV: f"{shard_ids.start}-{shard_ids.stop - 1}",
+                INTERNAL_WEB_ADDRESS_ENV: f"127.0.0.1:{internal_port + ix}",
+            },
+        )
+        logger.info("starting process for shards %d-%d", shard_ids.start, shard_ids.stop - 1)
+        children.append(subprocess.Popen([sys.executable, "-m", "orisa"], env=env))
+
+    try:
+        while all(child.poll() is None for child in children):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("interrupted")
+    finally:
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+        for child in children:
+            child.wait()
+            logger.info("process %d exited with %d", child.pid, child.returncode)
+
+    return max(abs(child.returncode) for child in children)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, required=True, help="total number of shards")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes (default: one per shard)")
+    parser.add_argument(
+        "--internal-port", type=int, default=8100, help="port of the internal web server of the first process"
+    )
+    args = parser.parse_args()
+
+    processes = args.processes or args.shards
+    if not 0 < processes <= args.shards:
+        parser.error("--processes must be between 1 and --shards")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    sys.exit(launch(args.shards, processes, args.internal_port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import heapq
+import logging
+import re
+
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from itertools import islice
+from operator import itemgetter
+
+import trio
+
+try:
+    # much faster, but optional
+    from rapidfuzz.fuzz import WRatio as _WRatio
+    from rapidfuzz.utils import default_process
+
+    def wratio(s1, s2):
+        return _WRatio(s1, s2, processor=default_process)
+
+    full_process = default_process
+
+    SCORER = "rapidfuzz"
+except ImportError:
+    from fuzzywuzzy.fuzz import WRatio as wratio
+    from fuzzywuzzy.utils import full_process
+
+    SCORER = "fuzzywuzzy"
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# guilds with up to this many members are always scored completely
+FULL_SCAN_LIMIT = 2000
+
+# how many members sharing the most trigrams with the search term are scored,
+# also the maximum number of prefix matches that are scored
+MAX_CANDIDATES = 250
+
+# members added between two checkpoints when building an index with add_members
+BUILD_CHUNK_SIZE = 500
+
+# how often a search was answered by which tier, see search(); "scan" are the
+# searches done with scan() because an index wasn't built yet
+TIER_HITS = Counter()
+
+TIERS = ("mention", "scan", "exact", "prefix", "fuzzy", "miss")
+
+metrics.Callback(
+    "orisa_member_search_tier_hits_total",
+    "Member searches by the tier that answered them",
+    "counter",
+    lambda: {tier: TIER_HITS[tier] for tier in TIERS},
+    ("tier",),
+)
+
+_TAGS_RE = re.compile(r"^(.*?\|)?([^[{]*)((\[|\{).*)?")
+
+
+def strip_tags(name):
+    "removes clan tags like 'SG | ' and Orisa's [SR] suffix"
+    return _TAGS_RE.sub(r"\2", str(name)).strip()
+
+
+def trigrams(name):
+    padded = f"  {name.lower()} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def score(query, name):
+    return score_processed(full_process(query), full_process(name))
+
+
+def score_processed(query, name):
+    """score of strings that went through full_process (lower case, no punctuation),
+    like process.extractBests passed them to its scorer"""
+    if query == name:
+        return 200
+    else:
+        result = wratio(query, name)
+        if name.startswith(query):
+            result *= 2
+        return result
+
+
+class MemberIndex:
+    "Search index over the (tag stripped) names of the members of one guild"
+
+    def __init__(self, members=()):
+        # member id -> stripped name
+        self.names = {}
+        # member id -> full_process'ed stripped name, for scoring
+        self._processed = {}
+        # lower case name, username or username#discriminator -> member ids
+        self._exact = defaultdict(set)
+        # member id -> its keys in _exact
+        self._exact_keys = {}
+        # sorted list of (lower case name, member id) for prefix searches
+        self._sorted = []
+        # trigram -> member ids
+        self._trigrams = defaultdict(set)
+
+        # insort is O(n), so sort only once when building
+        self._building = True
+        for member in members:
+            self.add_member(member)
+        self._sorted.sort()
+        self._building = False
+
+    def __len__(self):
+        return len(self.names)
+
+    async def add_members(self, members):
+        """adds the members of members (a dict of member id to member, like guild.members)
+        in chunks with a checkpoint after each, so building the index of a big guild
+        doesn't block everything else. Members that change meanwhile can be add()ed
+        and remove()d as usual; they are looked up in members again when their
+        chunk is added, and skipped if they are already in the index."""
+        self._building = True
+        member_ids = list(members.keys())
+        for i in range(0, len(member_ids), BUILD_CHUNK_SIZE):
+            for member_id in member_ids[i : i + BUILD_CHUNK_SIZE]:
+                member = members.get(member_id)
+                if member is not None and member_id not in self.names:
+                    self.add_member(member)
+            await trio.sleep(0)
+        self._sorted.sort()
+        self._building = False
+
+    def add_member(self, member):
+        user = member.user
+        self.add(
+            member.id,
+            member.name,
+            keys=(user.username, f"{user.username}#{user.discriminator}"),
+        )
+
+    def add(self, member_id, name, keys=()):
+        name = strip_tags(name)
+        exact_keys = {key.lower() for key in (name, *keys)}
+
+        if self.names.get(member_id) == name and self._exact_keys.get(member_id) == exact_keys:
+            return
+        self.remove(member_id)
+
+        self.names[member_id] = name
+        self._processed[member_id] = full_process(name)
+        self._exact_keys[member_id] = exact_keys
+        for key in exact_keys:
+            self._exact[key].add(member_id)
+        if self._building:
+            self._sorted.append((name.lower(), member_id))
+        else:
+            insort(self._sorted, (name.lower(), member_id))
+        for trigram in trigrams(name):
+            self._trigrams[trigram].add(member_id)
+
+    def remove(self, member_id):
+        name = self.names.pop(member_id, None)
+        if name is None:
+            return
+        del self._processed[member_id]
+
+        for key in self._exact_keys.pop(member_id):
+            ids = self._exact[key]
+            ids.discard(member_id)
+            if not ids:
+                del self._exact[key]
+
+        if self._building:
+            # not sorted yet
+            self._sorted.remove((name.lower(), member_id))
+        else:
+            del self._sorted[bisect_left(self._sorted, (name.lower(), member_id))]
+
+        for trigram in trigrams(name):
+            ids = self._trigrams[trigram]
+            ids.discard(member_id)
+            if not ids:
+                del self._trigrams[trigram]
+
+    def exact(self, query):
+        return [(200, member_id) for member_id in self._exact.get(query.lower(), ())]
+
+    def prefix(self, query):
+        query_lower = query.lower()
+        processed = full_process(query)
+        start = bisect_left(self._sorted, (query_lower,))
+        matches = islice(self._sorted, start, start + MAX_CANDIDATES)
+        return [
+            (score_processed(processed, self._processed[member_id]), member_id)
+            for name, member_id in matches
+            if name.startswith(query_lower)
+        ]
+
+    def fuzzy(self, query):
+        if len(self.names) <= FULL_SCAN_LIMIT:
+            candidates = self.names.keys()
+        else:
+            counts = Counter()
+            for trigram in trigrams(query):
+                counts.update(self._trigrams.get(trigram, ()))
+            candidates = [member_id for member_id, _ in counts.most_common(MAX_CANDIDATES)]
+
+        processed = full_process(query)
+        return [(score_processed(processed, self._processed[member_id]), member_id) for member_id in candidates]
+
+
+def search(indexes, query, limit=5):
+    """Searches the indexes for query and returns up to limit (score, member_id) tuples, best first.
+
+    Exact matches of name, username or username#discriminator win; if there are none,
+    names starting with query are considered, and only then a fuzzy search is done."""
+
+    for tier in ("exact", "prefix", "fuzzy"):
+        results = heapq.nlargest(
+            limit,
+            (result for index in indexes for result in getattr(index, tier)(query)),
+            key=itemgetter(0),
+        )
+        if results:
+            TIER_HITS[tier] += 1
+            return results
+
+    TIER_HITS["miss"] += 1
+    return []
+
+
+def scan(members, query, limit=5):
+    """Scores the (tag stripped) name of every member for query and returns up to limit
+    (score, member_id) tuples, best first; for guilds whose index isn't built yet"""
+
+    processed = full_process(query)
+    TIER_HITS["scan"] += 1
+    return heapq.nlargest(
+        limit,
+        ((score_processed(processed, full_process(strip_tags(member.name))), member.id) for member in members),
+        key=itemgetter(0),
+    )
+
+
+def tier_hit_rates():
+    total = sum(TIER_HITS.values())
+    return {tier: TIER_HITS[tier] / total if total else 0.0 for tier in TIERS}
@@ -0,0 +1,303 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Metrics in the Prometheus text format, served by web.py under /metrics.
+
+Hot paths should use children bound once with labels(), observing a value is
+then just an addition (and a bisect for histograms). Only use labels with a
+small, fixed set of values; never ids."""
+import functools
+import inspect
+import re
+import time
+
+from bisect import bisect_left
+
+from . import tracing
+
+REGISTRY = []
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=(), *, register=True):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames and not isinstance(self, Callback):
+            # so it is exported before the first observation
+            self.labels()
+        if register:
+            REGISTRY.append(self)
+
+    def labels(self, *values):
+        "returns the child for the label values, bind it once outside of hot paths"
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} needs labels {self.labelnames}, got {values}")
+        values = tuple(str(value) for value in values)
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        "(suffix, label values, extra labels, value) tuples"
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    _new_child = _CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield "", values, (), child.value
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    _new_child = _GaugeChild
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield "", values, (), child.value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        "(upper bound, observations <= bound) pairs, the last bound is inf"
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), *, buckets=LATENCY_BUCKETS, register=True):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames, register=register)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in self._children.items():
+            for bound, count in child.cumulative():
+                yield "_bucket", values, (("le", _format_value(bound)),), count
+            yield "_sum", values, (), child.sum
+            yield "_count", values, (), child.count
+
+
+class Callback(_Metric):
+    "a metric whose values are computed when rendering, fn returns a dict of label values to value"
+
+    def __init__(self, name, help, type, fn, labelnames=(), *, register=True):
+        self.type = type
+        self.fn = fn
+        super().__init__(name, help, labelnames, register=register)
+
+    def _samples(self):
+        for values, value in self.fn().items():
+            if not isinstance(values, tuple):
+                values = (values,)
+            yield "", values, (), value
+
+
+def timed_methods(histogram, stage=None):
+    """Class decorator observing the duration of every public coroutine method
+    in histogram, labelled with the method name. If stage is given, the calls
+    are also recorded as spans of that stage in the current trace"""
+
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.iscoroutinefunction(method):
+                continue
+            setattr(cls, name, _timed(method, histogram.labels(name), stage))
+        return cls
+
+    return decorate
+
+
+def _timed(method, child, stage=None):
+    name = method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            if stage is None:
+                return await method(*args, **kwargs)
+            with tracing.span(stage, name):
+                return await method(*args, **kwargs)
+        finally:
+            child.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+_ID_RE = re.compile(r"\d{5,}")
+
+
+def route_label(route):
+    "a Discord REST route with ids replaced, so it can be used as label"
+    return _ID_RE.sub("{id}", str(route))
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Metrics of the bot, children used on hot paths are bound here
+
+HANDLE_SYNCS = Counter("orisa_handle_syncs_total", "Handle syncs by result", ("result",))
+HANDLE_SYNCS_OK = HANDLE_SYNCS.labels("ok")
+HANDLE_SYNCS_NO_SR = HANDLE_SYNCS.labels("no_sr")
+HANDLE_SYNCS_ERROR = HANDLE_SYNCS.labels("error")
+
+SYNC_BATCH_HANDLES = Histogram(
+    "orisa_sync_batch_handles", "Sync results written per batch (and commit)", buckets=(1, 5, 10, 25, 50, 100)
+)
+
+HANDLES_DUE = Gauge("orisa_handles_due", "Handles due for a sync at the last sync check")
+
+BLIZZARD_REQUEST_SECONDS = Histogram("orisa_blizzard_request_seconds", "Duration of profile requests to Blizzard")
+BLIZZARD_RESPONSES = Counter(
+    "orisa_blizzard_responses_total", "Responses from Blizzard by status code (or timeout/error)", ("status",)
+)
+BLIZZARD_RESPONSES_OK = BLIZZARD_RESPONSES.labels("200")
+BLIZZARD_RESPONSES_TIMEOUT = BLIZZARD_RESPONSES.labels("timeout")
+BLIZZARD_RESPONSES_ERROR = BLIZZARD_RESPONSES.labels("error")
+BLIZZARD_BUDGET_WAIT_SECONDS = Histogram(
+    "orisa_blizzard_budget_wait_seconds", "Time profile requests waited for the request budget", ("priority",)
+)
+BLIZZARD_CIRCUIT_OPEN = Gauge("orisa_blizzard_circuit_open", "1 while requests to Blizzard are paused after failures")
+BLIZZARD_REQUESTS_REJECTED = Counter(
+    "orisa_blizzard_requests_rejected_total", "Profile requests rejected while requests to Blizzard were paused"
+)
+
+SR_CACHE_LOOKUPS = Counter("orisa_sr_cache_lookups_total", "Lookups in the SR cache", ("result",))
+SR_CACHE_HITS = SR_CACHE_LOOKUPS.labels("hit")
+SR_CACHE_MISSES = SR_CACHE_LOOKUPS.labels("miss")
+NEGATIVE_CACHE_HITS = Counter(
+    "orisa_negative_cache_hits_total", "Profile requests answered by a cached failure, by kind", ("kind",)
+)
+
+DB_CALL_SECONDS = Histogram("orisa_db_call_seconds", "Duration of Database method calls", ("method",))
+
+DISCORD_REQUESTS = Counter("orisa_discord_requests_total", "Discord REST requests by route", ("route",))
+
+NICK_UPDATES = Counter("orisa_nick_updates_total", "Nickname updates by result", ("result",))
+NICK_UPDATES_APPLIED = NICK_UPDATES.labels("applied")
+NICK_UPDATES_SKIPPED = NICK_UPDATES.labels("skipped")
+NICK_UPDATES_FAILED = NICK_UPDATES.labels("failed")
+
+VOICE_ADJUSTMENTS = Counter("orisa_voice_adjustments_total", "Runs of the managed voice channel adjustment")
+VOICE_CHANNEL_CHANGES = Counter("orisa_voice_channel_changes_total", "Managed voice channels changed", ("action",))
+VOICE_CHANNELS_CREATED = VOICE_CHANNEL_CHANGES.labels("created")
+VOICE_CHANNELS_DELETED = VOICE_CHANNEL_CHANGES.labels("deleted")
+
+HIGHSCORE_SECONDS = Histogram(
+    "orisa_highscore_guild_seconds", "Duration of posting the highscores of one guild", buckets=(1, 5, 10, 30, 60, 120, 300)
+)
+
+COMMAND_SECONDS = Histogram("orisa_command_seconds", "Duration of commands by (sub)command", ("command",))
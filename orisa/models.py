@@ -12,6 +12,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import logging
 import random
 import typing
 
@@ -27,25 +29,39 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    MetaData,
     SmallInteger,
     String,
+    Table,
+    bindparam,
     create_engine,
+    exists,
     func,
+    or_,
+    select,
 )
+from sqlalchemy import inspect as inspect_schema
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy.sql.functions import coalesce
-from sqlalchemy.orm import raiseload, relationship, sessionmaker
+from sqlalchemy.orm import joinedload, raiseload, relationship, sessionmaker
 import sqlalchemy.types as types
 
-from .config import DATABASE_URI
-from .utils import sr_to_rank, TDS
+from . import metrics, tracing
+from .config import DATABASE_URI, MAX_SYNC_INTERVAL_HOURS
+from .utils import NEGATIVE_CACHE_TTLS, sr_to_rank, TDS
 from .i18n import _, N_, NP_
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
+# users deleted per transaction by Database.delete_users
+CLEANUP_CHUNK_SIZE = 500
+
 
 class Role(Flag):
     NONE = 0
@@ -112,10 +128,46 @@ class User(Base):
 
     always_show_sr = Column(Boolean, nullable=False, default=False)
 
+    # when the user last stopped playing Overwatch, as far as we know
+    last_seen_playing = Column(DateTime)
+
     def __repr__(self):
         return f"<User(id={self.id}, discord_id={self.discord_id})>"
 
 
+# healthy handles are synced every MIN_SYNC_INTERVAL; after a while without activity
+# (no SR change, not seen playing), every IDLE_SYNC_FACTOR of the idle time, up to
+# MAX_SYNC_INTERVAL_HOURS
+MIN_SYNC_INTERVAL = timedelta(minutes=120)
+IDLE_SYNC_FACTOR = 0.25
+MAX_SYNC_INTERVAL = timedelta(hours=MAX_SYNC_INTERVAL_HOURS)
+
+
+def sync_delay(error_count, idle=None, failure=None):
+    """how long to wait before syncing a handle again; idle is the time since its last activity,
+    failure the kind of a failed request, which is not retried before get_sr would ask Blizzard again"""
+    if error_count == 0:
+        interval = min(max(MIN_SYNC_INTERVAL, (idle or timedelta(0)) * IDLE_SYNC_FACTOR), MAX_SYNC_INTERVAL)
+        # slight randomization (up to a twelfth) to avoid having all
+        # battletags update at the same time if Orisa didn't run
+        # for a while
+        delay = interval * random.uniform(1, 13 / 12)
+    elif 0 < error_count < 3:
+        delay = timedelta(
+            minutes=5
+        )  # we actually want to try again fast, in case it was a temporary problem
+    elif 3 <= error_count < 5:
+        delay = timedelta(
+            minutes=240
+        )  # ok, the error's not going away, so wait longer
+    elif 5 <= error_count < 10:
+        # exponential backoff
+        delay = timedelta(minutes=300 + 20 * (error_count - 5) ** 2)
+    else:
+        delay = timedelta(days=1)
+    return max(delay, NEGATIVE_CACHE_TTLS.get(failure, delay))
+
+
 class Handle(Base):
     "Base class for gamer handles (BattleTag, Gamertag, PSN ID in the future)"
     __tablename__ = "handle"
@@ -131,7 +183,7 @@ class Handle(Base):
 
     sr_history = relationship(
         "SR",
-        order_by="desc(SR.timestamp)",
+        order_by="desc(SR.valid_from)",
         cascade="all, delete-orphan",
         lazy="dynamic",
         foreign_keys="SR.handle_id",
@@ -145,7 +197,15 @@ class Handle(Base):
         lazy="joined",
     )
 
+    # sync bookkeeping, changes on every sync unlike the SR history
     error_count = Column(Integer, nullable=False, default=0)
+    # last sync attempt, successful or not
+    last_checked_at = Column(DateTime)
+    # last successful sync, the current SR run lasts until then
+    last_synced_at = Column(DateTime)
+    # None means due now; not indexed, the due handles are found with a scan anyway
+    # and updates that don't touch an index are cheaper
+    next_sync_at = Column(DateTime)
 
 
     __mapper_args__ = {
@@ -162,29 +222,56 @@ class Handle(Base):
 
     @property
     def last_update(self):
-        return self.current_sr.timestamp if self.current_sr else None
+        return self.last_synced_at
 
-    def update_sr(self, new_srs, *, timestamp=None):
+    def record_sync(self, *, timestamp=None, failure=None):
+        """records a sync attempt and schedules the next one; set error_count before.
+        failure is the kind of the failed request, if any"""
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        self.last_checked_at = timestamp
+        active_at = max(
+            [
+                active_at
+                for active_at in (self.current_sr and self.current_sr.valid_from, self.user and self.user.last_seen_playing)
+                if active_at
+            ],
+            default=timestamp,
+        )
+        self.next_sync_at = timestamp + sync_delay(self.error_count or 0, timestamp - active_at, failure)
+
+    def update_sr(self, new_srs, *, timestamp=None, failure=None):
+        """records a successful sync; the SR history is only written if the values changed,
+        then a new run is started. Returns whether they did. failure is the kind of a
+        profile without SRs, see record_sync."""
         if timestamp is None:
             timestamp = datetime.utcnow()
 
         if new_srs is None:
             new_srs = TDS(None, None, None)
 
-        if (
-            len(self.sr_history[:2]) > 1
-            and self.sr_history[0].values == self.sr_history[1].values
-        ):
-            sr_obj = self.sr_history[0]
-            sr_obj.timestamp = timestamp
-            sr_obj.values = new_srs
-        else:
-            sr_obj = SR(timestamp=timestamp, tank=new_srs.tank, damage=new_srs.damage, support=new_srs.support)
+        sr_obj = self.current_sr
+        changed = sr_obj is None or sr_obj.values != new_srs
+        if changed:
+            if sr_obj is not None:
+                # the last sync that still saw the old values; not last_checked_at,
+                # failed syncs didn't see any
+                sr_obj.valid_to = self.last_synced_at or sr_obj.valid_from
+
+            sr_obj = SR(valid_from=timestamp, valid_to=timestamp, tank=new_srs.tank, damage=new_srs.damage, support=new_srs.support)
             self.sr_history.append(
                 sr_obj
             )  # sqlalchemy dynamic wrapper does not support prepend
 
-        self.current_sr = sr_obj
+            self.current_sr = sr_obj
+
+        self.last_synced_at = timestamp
+        self.record_sync(timestamp=timestamp, failure=failure)
+        return changed
+
+    def sr_at(self, when):
+        "the SR run that was current at when, None if there is no SR that old"
+        return self.sr_history.filter(SR.valid_from <= when).first()
 
 
     def __repr__(self):
@@ -293,15 +380,18 @@ class SR(Base):
     __tablename__ = "srs"
 
     id = Column(Integer, primary_key=True, index=True)
-    handle_id = Column(
-        Integer, ForeignKey("handle.id"), nullable=False, index=True
-    )
+    # indexed by SR_VALID_FROM_INDEX
+    handle_id = Column(Integer, ForeignKey("handle.id"), nullable=False)
 
     handle = relationship(
         "Handle", back_populates="sr_history", foreign_keys=[handle_id],
         single_parent=True
     )
-    timestamp = Column(DateTime, nullable=False)
+    # the SR had these values from the sync at valid_from up to (at least) the one at valid_to;
+    # valid_to is only written when the run ends, the current run lasts until the
+    # last_synced_at of its handle
+    valid_from = Column(DateTime, nullable=False)
+    valid_to = Column(DateTime, nullable=False)
     tank = Column(SmallInteger)
     damage = Column(SmallInteger)
     support = Column(SmallInteger)
@@ -324,6 +414,11 @@ class SR(Base):
         return f"<SR(id={self.id}, values={self.values})>"
 
 
+# point in time lookups are a single probe of this index, it also serves all other
+# lookups by handle
+SR_VALID_FROM_INDEX = Index("ix_srs_handle_id_valid_from", SR.handle_id, SR.valid_from)
+
+
 class GuildConfigJson(Base):
     __tablename__ = "guild_configs"
 
@@ -332,6 +427,45 @@ class GuildConfigJson(Base):
     config = Column(String, nullable=False)
 
 
+class Lease(Base):
+    "a named lease, only its holder may run the job it protects until it expires"
+    __tablename__ = "leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires = Column(DateTime, nullable=False)
+    # where the holder can be reached, for leases of servers
+    address = Column(String)
+
+
+# status of a BroadcastRecipient
+BROADCAST_PENDING, BROADCAST_SENT, BROADCAST_FAILED = range(3)
+
+
+class BroadcastJob(Base):
+    "a message sent by the owner to many users or channels, see orisa.broadcast"
+    __tablename__ = "broadcast_jobs"
+
+    id = Column(Integer, primary_key=True)
+    # "users" and "owners" are DMs to user ids, "servers" messages to channel ids
+    kind = Column(String, nullable=False)
+    message = Column(String, nullable=False)
+    # where progress is reported to
+    report_channel_id = Column(BigInteger)
+    created = Column(DateTime, nullable=False)
+    finished = Column(DateTime)
+    cancelled = Column(Boolean, nullable=False, default=False)
+
+
+class BroadcastRecipient(Base):
+    __tablename__ = "broadcast_recipients"
+
+    job_id = Column(Integer, ForeignKey("broadcast_jobs.id", ondelete="CASCADE"), primary_key=True)
+    target_id = Column(BigInteger, primary_key=True)
+    status = Column(SmallInteger, nullable=False, default=BROADCAST_PENDING)
+    error = Column(String)
+
+
 class WelcomeMessage(Base):
     __tablename__ = "welcome_message"
 
@@ -341,13 +475,134 @@ class WelcomeMessage(Base):
     guild_name = Column(String)
 
 
+# columns added to existing tables after they were created, with an UPDATE to fill
+# them (or None); create_all only creates missing tables, so these get added on
+# startup if necessary
+ADDED_COLUMNS = [
+    (
+        "handle",
+        "last_checked_at",
+        "UPDATE handle SET last_checked_at = (SELECT valid_to FROM srs WHERE srs.id = handle.current_sr_id)",
+    ),
+    # failed syncs weren't told apart before, so the last attempt is the best guess
+    ("handle", "last_synced_at", "UPDATE handle SET last_synced_at = last_checked_at"),
+    # None, so every handle is synced once after the upgrade
+    ("handle", "next_sync_at", None),
+    ("users", "last_seen_playing", None),
+    ("leases", "address", None),
+]
+
+# rows per statement when converting the SR history to runs
+MIGRATION_CHUNK_SIZE = 1000
+# handles whose SR history is read at once when converting it; a run never spans handles
+MIGRATION_HANDLE_CHUNK_SIZE = 200
+
+
+def add_missing_columns(engine):
+    schema = inspect_schema(engine)
+    for table_name, column_name, fill in ADDED_COLUMNS:
+        if column_name in {col["name"] for col in schema.get_columns(table_name)}:
+            continue
+        column_type = Base.metadata.tables[table_name].c[column_name].type.compile(dialect=engine.dialect)
+        logger.info("Adding column %s.%s", table_name, column_name)
+        with engine.begin() as conn:
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+            if fill:
+                conn.execute(fill)
+
+
+def _sr_runs_of_chunk(conn, handle_ids):
+    """the (run id, run start) of every run of the handles, and the ids of the rows
+    made obsolete by them"""
+    srs = SR.__table__
+    rows = conn.execute(
+        select([srs.c.id, srs.c.handle_id, srs.c.valid_to, srs.c.tank, srs.c.damage, srs.c.support])
+        .where(srs.c.handle_id.in_(handle_ids))
+        .order_by(srs.c.handle_id, srs.c.valid_to, srs.c.id)
+    ).fetchall()
+
+    # the latest row of a run is kept, because it's the one current_sr points to
+    starts, obsolete = [], []
+    run_start = None
+    for row, next_row in zip(rows, rows[1:] + [None]):
+        if run_start is None:
+            run_start = row.valid_to
+        if next_row is not None and next_row.handle_id == row.handle_id and next_row[3:] == row[3:]:
+            obsolete.append({"obsolete_id": row.id})
+        else:
+            starts.append({"run_id": row.id, "run_start": run_start})
+            run_start = None
+    return starts, obsolete
+
+
+def migrate_sr_runs(engine):
+    """Converts an SR history with one row per change (with a timestamp, the latest
+    of two equal rows being moved forward on every sync) to one row per run of equal
+    values from valid_from to valid_to. Does nothing if it was already converted.
+
+    Runs in a single transaction that locks srs first, so of several processes
+    starting at once only one converts, the others wait for it and then find
+    nothing left to do."""
+
+    if "timestamp" not in {col["name"] for col in inspect_schema(engine).get_columns("srs")}:
+        return
+
+    datetime_type = DateTime().compile(dialect=engine.dialect)
+    srs = SR.__table__
+    update = srs.update().where(srs.c.id == bindparam("run_id")).values(valid_from=bindparam("run_start"))
+    delete = srs.delete().where(srs.c.id == bindparam("obsolete_id"))
+    row_count = run_count = 0
+
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute("LOCK TABLE srs IN ACCESS EXCLUSIVE MODE")
+        # check again now that we have the lock, another process might have converted it meanwhile
+        if "timestamp" not in {col["name"] for col in inspect_schema(conn).get_columns("srs")}:
+            return
+
+        logger.info("Converting SR history to runs, this may take a while")
+        conn.execute("ALTER TABLE srs RENAME COLUMN timestamp TO valid_to")
+        conn.execute(f"ALTER TABLE srs ADD COLUMN valid_from {datetime_type}")
+
+        last_handle_id = None
+        while True:
+            query = select([srs.c.handle_id]).distinct().order_by(srs.c.handle_id).limit(MIGRATION_HANDLE_CHUNK_SIZE)
+            if last_handle_id is not None:
+                query = query.where(srs.c.handle_id > last_handle_id)
+            handle_ids = [row.handle_id for row in conn.execute(query)]
+            if not handle_ids:
+                break
+            last_handle_id = handle_ids[-1]
+
+            starts, obsolete = _sr_runs_of_chunk(conn, handle_ids)
+            for i in range(0, len(starts), MIGRATION_CHUNK_SIZE):
+                conn.execute(update, starts[i : i + MIGRATION_CHUNK_SIZE])
+            for i in range(0, len(obsolete), MIGRATION_CHUNK_SIZE):
+                conn.execute(delete, obsolete[i : i + MIGRATION_CHUNK_SIZE])
+            row_count += len(starts) + len(obsolete)
+            run_count += len(starts)
+
+        # every remaining row is a run with a start now; SQLite can't alter columns, but
+        # there the constraint only matters for new databases, which create_all gets right
+        if engine.dialect.name == "postgresql":
+            conn.execute("ALTER TABLE srs ALTER COLUMN valid_from SET NOT NULL")
+
+        SR_VALID_FROM_INDEX.create(conn)
+        conn.execute("DROP INDEX IF EXISTS ix_srs_handle_id")
+
+    logger.info("Converted %d SR rows to %d runs", row_count, run_count)
+
+
+@metrics.timed_methods(metrics.DB_CALL_SECONDS, stage=tracing.DB)
 class Database:
-    def __init__(self):
-        engine = create_engine(DATABASE_URI, pool_size=20, max_overflow=10)
+    def __init__(self, engine=None):
+        "uses an engine for DATABASE_URI unless another one is given (the benchmarks use their own)"
+        if engine is None:
+            engine = create_engine(DATABASE_URI, pool_size=20, max_overflow=10)
         self.Session = sessionmaker(bind=engine, autoflush=False)
         Base.metadata.create_all(engine)
-
-        self._min_delay = min(self._sync_delay(x) for x in range(10))
+        migrate_sr_runs(engine)
+        add_missing_columns(engine)
 
     @asynccontextmanager
     async def session(self):
@@ -363,9 +618,377 @@ class Database:
     async def handle_by_id(self, session, id):
         return await trio.to_thread.run_sync(session.query(Handle).filter_by(id=id).one_or_none)
 
+    async def handles_by_ids(self, session, ids, *, chunk_size=500):
+        "the handles (with their users) that still exist, queried in chunks like users_by_discord_ids"
+        ids = list(ids)
+        handles = []
+        for i in range(0, len(ids), chunk_size):
+            handles.extend(
+                await trio.to_thread.run_sync(
+                    session.query(Handle)
+                    .options(joinedload(Handle.user))
+                    .filter(Handle.id.in_(ids[i : i + chunk_size]))
+                    .all
+                )
+            )
+        return handles
+
+    async def save_sync_results(self, session, results):
+        """Writes a batch of background sync results, (handle id, TDS or None if the
+        request failed, timestamp, failure kind or None), like Handle.update_sr and record_sync would, but
+        with bulk statements and a single commit. Returns the ids of the handles whose
+        SR changed."""
+
+        users, handles, srs = User.__table__, Handle.__table__, SR.__table__
+
+        def save():
+            current = {
+                row.id: row
+                for row in session.execute(
+                    select(
+                        [
+                            handles.c.id,
+                            handles.c.error_count,
+                            handles.c.last_synced_at,
+                            handles.c.current_sr_id,
+                            srs.c.valid_from,
+                            srs.c.tank,
+                            srs.c.damage,
+                            srs.c.support,
+                            users.c.last_seen_playing,
+                        ]
+                    )
+                    .select_from(
+                        handles.join(users, users.c.id == handles.c.user_id).outerjoin(
+                            srs, srs.c.id == handles.c.current_sr_id
+                        )
+                    )
+                    .where(handles.c.id.in_({handle_id for handle_id, *_ in results}))
+                )
+            }
+
+            checked, closed, started = [], [], []
+            # only the latest result of a handle counts
+            latest = {handle_id: (values, timestamp, failure) for handle_id, values, timestamp, failure in results}
+            for handle_id, (values, timestamp, failure) in latest.items():
+                row = current.get(handle_id)
+                if row is None:
+                    # deleted during the sync
+                    continue
+                error_count = row.error_count + 1 if values is None else 0
+                changed = values is not None and (
+                    row.current_sr_id is None or TDS(row.tank, row.damage, row.support) != values
+                )
+                active_at = timestamp if changed else max(filter(None, (row.valid_from, row.last_seen_playing)), default=timestamp)
+                checked.append(
+                    {
+                        "b_handle_id": handle_id,
+                        "error_count": error_count,
+                        "last_checked_at": timestamp,
+                        "last_synced_at": row.last_synced_at if values is None else timestamp,
+                        "next_sync_at": timestamp + sync_delay(error_count, timestamp - active_at, failure),
+                    }
+                )
+                if not changed:
+                    continue
+                if row.current_sr_id is not None:
+                    closed.append({"b_sr_id": row.current_sr_id, "valid_to": row.last_synced_at or row.valid_from})
+                started.append(
+                    {"b_handle_id": handle_id, "b_valid_from": timestamp, **values._asdict()}
+                )
+
+            if closed:
+                session.execute(srs.update().where(srs.c.id == bindparam("b_sr_id")), closed)
+            if started:
+                session.execute(
+                    srs.insert().values(
+                        handle_id=bindparam("b_handle_id"),
+                        valid_from=bindparam("b_valid_from"),
+                        valid_to=bindparam("b_valid_from"),
+                    ),
+                    started,
+                )
+                # the new runs are the latest ones starting at that time
+                session.execute(
+                    handles.update()
+                    .where(handles.c.id == bindparam("b_handle_id"))
+                    .values(
+                        current_sr_id=select([func.max(srs.c.id)])
+                        .where(srs.c.handle_id == handles.c.id)
+                        .where(srs.c.valid_from == bindparam("b_valid_from"))
+                        .as_scalar()
+                    ),
+                    [{"b_handle_id": run["b_handle_id"], "b_valid_from": run["b_valid_from"]} for run in started],
+                )
+            if checked:
+                session.execute(handles.update().where(handles.c.id == bindparam("b_handle_id")), checked)
+            session.commit()
+
+            return {run["b_handle_id"] for run in started}
+
+        return await trio.to_thread.run_sync(save)
+
     async def user_by_discord_id(self, session, discord_id):
         return session.query(User).filter_by(discord_id=discord_id).one_or_none()
 
+    async def users_by_discord_ids(self, session, discord_ids, *, chunk_size=500):
+        "like user_by_discord_id, but for many ids; queries in chunks to avoid huge IN lists"
+        discord_ids = list(discord_ids)
+        users = []
+        for i in range(0, len(discord_ids), chunk_size):
+            users.extend(
+                await trio.to_thread.run_sync(
+                    session.query(User)
+                    .filter(User.discord_id.in_(discord_ids[i : i + chunk_size]))
+                    .all
+                )
+            )
+        return users
+
+    async def update_user_locales(self, session, locales):
+        "sets the locales of many users (dict of discord id to locale) in one statement and commits"
+        users = User.__table__
+        stmt = (
+            users.update()
+            .where(users.c.discord_id == bindparam("_discord_id"))
+            .values(locale=bindparam("_locale"))
+        )
+
+        def update():
+            session.execute(
+                stmt,
+                [{"_discord_id": discord_id, "_locale": locale} for discord_id, locale in locales.items()],
+            )
+            session.commit()
+
+        await trio.to_thread.run_sync(update)
+
+    async def acquire_lease(self, session, name, holder, duration, *, address=None):
+        """Acquires or renews the lease name for holder, returns whether holder has it now.
+
+        The lease is taken over if it expired; commits."""
+        leases = Lease.__table__
+
+        def acquire():
+            now = datetime.utcnow()
+            result = session.execute(
+                leases.update()
+                .where(leases.c.name == name)
+                .where(or_(leases.c.holder == holder, leases.c.expires < now))
+                .values(holder=holder, expires=now + duration, address=address)
+            )
+            if result.rowcount == 0:
+                try:
+                    session.execute(
+                        leases.insert().values(name=name, holder=holder, expires=now + duration, address=address)
+                    )
+                except IntegrityError:
+                    # exists and is held by someone else
+                    session.rollback()
+                    return False
+            session.commit()
+            return True
+
+        return await trio.to_thread.run_sync(acquire)
+
+    async def release_lease(self, session, name, holder):
+        leases = Lease.__table__
+
+        def release():
+            session.execute(leases.delete().where(leases.c.name == name).where(leases.c.holder == holder))
+            session.commit()
+
+        await trio.to_thread.run_sync(release)
+
+    async def lease_addresses(self, session, prefix):
+        "(name, address) of the unexpired leases whose name starts with prefix"
+        leases = Lease.__table__
+
+        def query():
+            return session.execute(
+                select([leases.c.name, leases.c.address])
+                .where(leases.c.name.startswith(prefix))
+                .where(leases.c.expires >= datetime.utcnow())
+            ).fetchall()
+
+        return await trio.to_thread.run_sync(query)
+
+    async def claim_highscore_run(self, session, guild_id, scheduled, now, next_run):
+        """Moves the highscore run of the guild scheduled for scheduled to next_run,
+        unless another process did it already.
+
+        Returns whether this process claimed the run; commits."""
+        crons = HighscoreCron.__table__
+
+        def claim():
+            result = session.execute(
+                crons.update()
+                .where(crons.c.id == guild_id)
+                .where(crons.c.next_run == scheduled)
+                .values(last_run=now, next_run=next_run)
+            )
+            session.commit()
+            return result.rowcount == 1
+
+        return await trio.to_thread.run_sync(claim)
+
+    async def create_broadcast(self, session, kind, message, target_ids, report_channel_id):
+        "creates a broadcast job with a pending recipient per target id, commits and returns the job id"
+
+        def create():
+            job = BroadcastJob(
+                kind=kind, message=message, report_channel_id=report_channel_id, created=datetime.utcnow()
+            )
+            session.add(job)
+            session.flush()
+            session.execute(
+                BroadcastRecipient.__table__.insert(),
+                [{"job_id": job.id, "target_id": target_id, "status": BROADCAST_PENDING} for target_id in set(target_ids)],
+            )
+            session.commit()
+            return job.id
+
+        return await trio.to_thread.run_sync(create)
+
+    async def unfinished_broadcasts(self, session):
+        "(id, kind, message, report_channel_id) of all unfinished jobs, oldest first"
+        return await trio.to_thread.run_sync(
+            session.query(BroadcastJob.id, BroadcastJob.kind, BroadcastJob.message, BroadcastJob.report_channel_id)
+            .filter(BroadcastJob.finished.is_(None))
+            .order_by(BroadcastJob.id)
+            .all
+        )
+
+    async def broadcast_recipients(self, session, job_id):
+        "status -> list of target ids"
+        rows = await trio.to_thread.run_sync(
+            session.query(BroadcastRecipient.status, BroadcastRecipient.target_id)
+            .filter_by(job_id=job_id)
+            .all
+        )
+        recipients = {BROADCAST_PENDING: [], BROADCAST_SENT: [], BROADCAST_FAILED: []}
+        for status, target_id in rows:
+            recipients[status].append(target_id)
+        return recipients
+
+    async def save_broadcast_results(self, session, job_id, results):
+        """Stores results (dict of target id to (status, error)) and commits.
+
+        Returns whether the job was cancelled in the meantime."""
+        recipients = BroadcastRecipient.__table__
+        stmt = (
+            recipients.update()
+            .where(recipients.c.job_id == job_id)
+            .where(recipients.c.target_id == bindparam("_target_id"))
+            .values(status=bindparam("_status"), error=bindparam("_error"))
+        )
+
+        def save():
+            if results:
+                session.execute(
+                    stmt,
+                    [
+                        {"_target_id": target_id, "_status": status, "_error": error}
+                        for target_id, (status, error) in results.items()
+                    ],
+                )
+            cancelled = session.query(BroadcastJob.cancelled).filter_by(id=job_id).scalar()
+            session.commit()
+            return cancelled
+
+        return await trio.to_thread.run_sync(save)
+
+    async def cancel_broadcast(self, session, job_id):
+        "marks an unfinished job as cancelled, the process running it stops soon; returns whether there was such a job"
+
+        def cancel():
+            count = (
+                session.query(BroadcastJob)
+                .filter_by(id=job_id, finished=None)
+                .update({"cancelled": True})
+            )
+            session.commit()
+            return count > 0
+
+        return await trio.to_thread.run_sync(cancel)
+
+    async def finish_broadcast(self, session, job_id, *, cancelled=False):
+        def finish():
+            values = {"finished": datetime.utcnow()}
+            if cancelled:
+                values["cancelled"] = True
+            session.query(BroadcastJob).filter_by(id=job_id).update(values)
+            session.commit()
+
+        await trio.to_thread.run_sync(finish)
+
+    async def stale_users(self, session, member_ids):
+        """(id, discord_id) of all users whose discord id is not in member_ids.
+
+        The member ids are staged in a temporary table, so the diff is done by the database."""
+
+        def find():
+            members = Table(
+                "cleanup_members",
+                MetaData(),
+                Column("discord_id", BigInteger, primary_key=True),
+                prefixes=["TEMPORARY"],
+            )
+            connection = session.connection()
+            members.create(connection)
+            try:
+                ids = list(set(member_ids))
+                for i in range(0, len(ids), 10000):
+                    connection.execute(members.insert(), [{"discord_id": id} for id in ids[i : i + 10000]])
+                return (
+                    session.query(User.id, User.discord_id)
+                    .filter(~exists().where(members.c.discord_id == User.discord_id))
+                    .all()
+                )
+            finally:
+                members.drop(connection)
+
+        return await trio.to_thread.run_sync(find)
+
+    async def count_user_rows(self, session, user_ids, *, chunk_size=CLEANUP_CHUNK_SIZE):
+        "number of (users, handles, srs) rows belonging to the users, see delete_users"
+
+        def count():
+            handles = srs = 0
+            for i in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[i : i + chunk_size]
+                handles += session.query(func.count(Handle.id)).filter(Handle.user_id.in_(chunk)).scalar()
+                srs += (
+                    session.query(func.count(SR.id))
+                    .join(SR.handle)
+                    .filter(Handle.user_id.in_(chunk))
+                    .scalar()
+                )
+            return len(user_ids), handles, srs
+
+        return await trio.to_thread.run_sync(count)
+
+    async def delete_users(self, session, user_ids, *, chunk_size=CLEANUP_CHUNK_SIZE):
+        """Deletes the users with their handles and SR history with set based deletes,
+        committing after every chunk_size users. Returns the number of deleted (users, handles, srs)."""
+
+        users, handles, srs = User.__table__, Handle.__table__, SR.__table__
+
+        def delete():
+            deleted = [0, 0, 0]
+            for i in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[i : i + chunk_size]
+                handle_ids = select([handles.c.id]).where(handles.c.user_id.in_(chunk))
+                # handles reference their current SR, and SRs their handle
+                session.execute(handles.update().where(handles.c.user_id.in_(chunk)).values(current_sr_id=None))
+                deleted[2] += session.execute(srs.delete().where(srs.c.handle_id.in_(handle_ids))).rowcount
+                deleted[1] += session.execute(handles.delete().where(handles.c.user_id.in_(chunk))).rowcount
+                deleted[0] += session.execute(users.delete().where(users.c.id.in_(chunk))).rowcount
+                session.commit()
+            return tuple(deleted)
+
+        return await trio.to_thread.run_sync(delete)
+
     async def get_srs(self, session, discord_ids):
         return await trio.to_thread.run_sync(
             session.query(SR)
@@ -375,41 +998,73 @@ class Database:
             .all
         )
 
-    def _sync_delay(self, error_count):
-        if error_count == 0:
-            # slight randomization to avoid having all
-            # battletags update at the same time if Orisa didn't run
-            # for a while
-            return timedelta(minutes=random.randint(120, 130))
-        elif 0 < error_count < 3:
-            return timedelta(
-                minutes=5
-            )  # we actually want to try again fast, in case it was a temporary problem
-        elif 3 <= error_count < 5:
-            return timedelta(
-                minutes=240
-            )  # ok, the error's not going away, so wait longer
-        elif 5 <= error_count < 10:
-            # exponential backoff
-            return timedelta(minutes=300 + 20 * (error_count - 5) ** 2)
-        else:
-            return timedelta(days=1)
-
-    async def get_handles_to_be_synced(self, session):
+    async def get_handles_to_be_synced(self, session, shards=None):
+        "ids of handles due for a sync; if shards is given, only those of users owned by it"
         results = await trio.to_thread.run_sync(
-            session.query(Handle)
-            .outerjoin(Handle.current_sr)
-            .filter(
-                coalesce(SR.timestamp, datetime.min) <= datetime.utcnow() - self._min_delay
-            )
+            session.query(Handle.id, User.discord_id)
+            .join(Handle.user)
+            .filter(or_(Handle.next_sync_at == None, Handle.next_sync_at <= datetime.utcnow()))
             .all
         )
         return [
-            result.id
-            for result in results
-            if (result.last_update or datetime.min) <= datetime.utcnow() - self._sync_delay(result.error_count)
+            handle_id
+            for handle_id, discord_id in results
+            if shards is None or shards.owns_user(discord_id)
         ]
 
+    async def users_synced_since(self, session, since):
+        "users with a handle whose SR changed after since"
+        return await trio.to_thread.run_sync(
+            session.query(User)
+            .join(User.handles)
+            .join(Handle.current_sr)
+            .filter(SR.valid_from > since)
+            .distinct()
+            .all
+        )
+
+    async def primary_srs(self, session):
+        "(discord id, TDS) of the current SR of the primary handle of every user that has one"
+        rows = await trio.to_thread.run_sync(
+            session.query(User.discord_id, SR.tank, SR.damage, SR.support)
+            .join(Handle, Handle.user_id == User.id)
+            .join(SR, SR.id == Handle.current_sr_id)
+            .filter(Handle.position == 0)
+            .all
+        )
+        return [(discord_id, TDS(tank, damage, support)) for discord_id, tank, damage, support in rows]
+
+    async def save_guild_configs(self, session, configs):
+        "persist a batch of guild configs (dict of guild id to GuildConfig) with a single commit"
+
+        def save():
+            for guild_id, config in configs.items():
+                gc = session.query(GuildConfigJson).filter_by(id=guild_id).one_or_none()
+                if not gc:
+                    gc = GuildConfigJson(id=guild_id)
+                    session.add(gc)
+
+                gc.config = json.dumps(config.to_js_json())
+
+                cron = session.query(HighscoreCron).filter_by(id=guild_id).one_or_none()
+
+                if config.post_highscores:
+                    if not cron:
+                        cron = HighscoreCron(id=guild_id)
+                        session.add(cron)
+                    ts = datetime.strptime(config.post_highscore_time, "%H:%M")
+                    now = datetime.today()
+                    ts = ts.replace(year=now.year, month=now.month, day=now.day)
+                    if ts < now:
+                        ts += timedelta(days=1)
+                    cron.next_run = ts
+                elif cron:
+                    session.delete(cron)
+
+            session.commit()
+
+        await trio.to_thread.run_sync(save)
+
     async def get_welcome_message(self, session, message_id):
         msg = await trio.to_thread.run_sync(
             session.query(WelcomeMessage)
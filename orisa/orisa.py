@@ -21,7 +21,10 @@ import math
 import re
 import random
 import os
+import signal
+import socket
 import tempfile
+import time
 import traceback
 import unicodedata
 import urllib.parse
@@ -73,7 +76,6 @@ from curious.dataclasses.embed import Embed
 from curious.dataclasses.guild import Guild
 from curious.dataclasses.member import Member
 from curious.dataclasses.presence import Game, Status
-from fuzzywuzzy import process, fuzz
 from lxml import html
 from oauthlib.oauth2 import WebApplicationClient
 from pandas.plotting import register_matplotlib_converters
@@ -106,13 +108,21 @@ from .config import (
 from .models import HighscoreCron, User, BattleTag, Gamertag, SR, OnlineID, Role, GuildConfigJson, WelcomeMessage
 from .exceptions import (
     BlizzardError,
+    BlizzardUnavailable,
     InvalidBattleTag,
     UnableToFindSR,
     NicknameTooLong,
     InvalidFormat,
 )
 from .i18n import _, N_, ngettext, CurrentLocale, locale_by_flag
+from . import member_index
+from .member_index import MemberIndex
+from .sr_index import SRIndex
+from .sharding import Shards, internal_web_address
+from .broadcast import run_broadcast
+from . import metrics, stalls, tracing
 from .utils import (
+    NEGATIVE_CACHE_TTLS,
     get_sr,
     sort_secondaries,
     send_long,
@@ -132,6 +142,55 @@ SUPPORT_DISCORD="https://discord.gg/ZKzBEDF"
 VOTE_LINK="https://discordbots.org/bot/445905377712930817/vote"
 DONATE_LINK="https://ko-fi.com/R5R2PC36"
 
+# how long the config writer waits to collect more saves into one commit
+CONFIG_WRITE_BATCH_DELAY = 2
+# pause after a failed config write, and how long writing the queued configs
+# may take when shutting down
+CONFIG_WRITE_RETRY_DELAY = 10
+CONFIG_FLUSH_TIMEOUT = 30
+
+# rendered help/about/privacy messages kept by _cached_render
+RENDER_CACHE_SIZE = 500
+
+# how often changed user locales are written to the database
+USER_LOCALE_WRITE_INTERVAL = 60
+
+# OAuth results the web server can queue before it has to wait,
+# and how many of them are processed at the same time
+REGISTRATION_QUEUE_SIZE = 100
+REGISTRATION_WORKERS = 5
+
+# how far _refresh_foreign_nicks looks back beyond its last run, in seconds
+FOREIGN_NICKS_OVERLAP = 120
+
+# how often the broadcast task looks for broadcasts queued by other processes
+BROADCAST_POLL_INTERVAL = 60
+
+# leases of the internal web servers are named this plus the key of their shards
+GUILD_API_LEASE_PREFIX = "guild_api/"
+
+# how often a process of a sharded setup reloads the user locales changed by others
+USER_LOCALE_REFRESH_INTERVAL = 300
+
+# leases for singleton jobs, see _run_with_lease. A lease is renewed every
+# LEASE_DURATION / 3; processes without it retry every LEASE_RETRY_INTERVAL
+LEASE_DURATION = timedelta(seconds=60)
+LEASE_RETRY_INTERVAL = 30
+# how long giving a lease back may take
+LEASE_RELEASE_TIMEOUT = 10
+
+# pause of a sync worker between two handles: SYNC_DELAY plus up to SYNC_DELAY_JITTER seconds
+SYNC_DELAY = 1
+SYNC_DELAY_JITTER = 5
+
+# sync results are written in batches of up to SYNC_BATCH_SIZE handles, a batch is
+# written at the latest SYNC_BATCH_DELAY seconds after its first result
+SYNC_BATCH_SIZE = 50
+SYNC_BATCH_DELAY = 10
+
+# pause between two highscore tables, to avoid running into rate limits
+HIGHSCORE_TABLE_DELAY = 5
+
 RANKS = (
     # Translators: 2 letter code for "Bronze" rank
     N_("Br"), 
@@ -188,13 +247,14 @@ COLORS = (
 
 
 def correct_channel(ctx):
-    return (
-        any(
-            ctx.channel.id == guild.listen_channel_id
-            for guild in Orisa._instance.guild_config.values()
+    with tracing.span(tracing.CONDITION, "correct_channel"):
+        return (
+            any(
+                ctx.channel.id == guild.listen_channel_id
+                for guild in Orisa._instance.guild_config.values()
+            )
+            or ctx.channel.private
         )
-        or ctx.channel.private
-    )
 
 
 def only_owner(ctx):
@@ -231,8 +291,17 @@ class Orisa(Plugin):
         super().__init__(client)
         Orisa._instance = self
         self.database = database
+        self.shards = client.shards
+        # identifies this process as holder of leases
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}"
         self.dialogues = {}
-        self.web_send_ch, self.web_recv_ch = trio.open_memory_channel(5)
+        self.web_send_ch, self.web_recv_ch = trio.open_memory_channel(REGISTRATION_QUEUE_SIZE)
+        # discord id -> lock held while a registration of that user is handled
+        self._registration_locks = {}
+        # configs saved in the web interface that are not in the database yet; this
+        # only lives in memory, see _config_writer
+        self.config_write_send_ch, self.config_write_recv_ch = trio.open_memory_channel(math.inf)
+        self._pending_configs = {}
         self.raven_client = raven_client
         self.sync_cache = cachetools.TTLCache(maxsize=1000, ttl=30)
         self.stopped_playing_cache = cachetools.TTLCache(maxsize=1000, ttl=10)
@@ -240,6 +309,35 @@ class Orisa(Plugin):
         self.guild_config = defaultdict(GuildConfig.default)
         self._welcome_language = cachetools.Cache(maxsize=100)
 
+        # locale of every registered user, so the commands manager doesn't
+        # need to hit the database for every command
+        self.user_locales = {}
+        self._changed_user_locales = {}
+
+        # rendered help/about/privacy content, see _cached_render; keyed by listen
+        # channel and locale, so only keep the ones used recently
+        self._render_cache = cachetools.LRUCache(maxsize=RENDER_CACHE_SIZE)
+        self._render_cache_catalogs = None
+
+        # guild id -> MemberIndex, built in the background by _member_index_builder when a
+        # guild becomes available (or is searched before); until then, searches scan the members
+        self.member_indexes = {}
+        # guild id -> MemberIndex being built, member events are applied to it too
+        self._member_indexes_building = {}
+        self._member_index_queued = set()
+        self.member_index_send_ch, self.member_index_recv_ch = trio.open_memory_channel(math.inf)
+
+        # discord id -> SRs of the primary handle, and guild id -> SRIndex over
+        # them, built when findplayers is used in a guild for the first time
+        self.primary_srs = {}
+        self.sr_indexes = {}
+
+        # set when a broadcast is queued, so _broadcast_task doesn't wait for its next poll
+        self._broadcast_queued = trio.Event()
+
+        # handles of users owned by other processes are synced there, see _refresh_foreign_nicks
+        self._foreign_nicks_checked = datetime.utcnow()
+
         # Translators: sent by Orisa when she joins a new server
         self._welcome_text = N_(
             "*Greetings*! I am excited to be here :smiley:\n"
@@ -268,17 +366,64 @@ class Orisa(Plugin):
                 )
                 logger.debug("Configured %d as %s", config.id, data)
 
+            self.user_locales = dict(await run_sync(session.query(User.discord_id, User.locale).all))
+            logger.debug("Loaded locales of %d users", len(self.user_locales))
+
+            self.primary_srs = dict(await self.database.primary_srs(session))
+            logger.debug("Loaded SRs of %d primary handles", len(self.primary_srs))
+
+        trio.hazmat.add_instrument(stalls.StallDetector())
+        await self.spawn(stalls.monitor_loop_lag)
+        await self.spawn(tracing.write_traces)
+        await self.spawn(self._member_index_builder)
+
         logger.warn("TEMPORARILY NOT SENDING MESSAGES TO GUILDS!")
         # await self.spawn(self._message_new_guilds)
 
-        await self.spawn(self._sync_all_handles_task)
+        # replicas of this process (same shards) share the work: jobs that
+        # must not run twice are protected by a lease, cron runs are claimed
+        await self.spawn(self._run_with_lease, f"sync/{self.shards.key}", self._sync_all_handles_task)
 
         logger.info("spawning cron")
         await self.spawn(self._cron_task)
 
-        await self.spawn(self._web_server)
+        await self.spawn(self._run_with_lease, "broadcast", self._broadcast_task)
+
+        if self.shards.is_primary:
+            await self.spawn(self._run_with_lease, "web", self._web_tasks)
+        else:
+            logger.info("Not the primary process, web server runs elsewhere")
+
+        if self.shards.is_sharded:
+            # guild config requests for our guilds are forwarded to the internal web server
+            # of the replica holding this lease, see guild_api_address
+            address = internal_web_address()
+            await self.spawn(self._web_server, address)
+            await self.spawn(
+                self._run_with_lease, f"{GUILD_API_LEASE_PREFIX}{self.shards.key}", trio.sleep_forever, address
+            )
+            await self.spawn(self._user_locale_refresher)
+
+        await self.spawn(self._config_writer)
+
+        await self.spawn(self._user_locale_writer)
+
+        await self.spawn(self._shutdown_on_sigterm)
+
+    def set_user_locale(self, discord_id, locale):
+        "Sets the locale of a registered user, it is written to the database later by _user_locale_writer"
+        if self.user_locales.get(discord_id) != locale:
+            self.user_locales[discord_id] = locale
+            self._changed_user_locales[discord_id] = locale
+
+    def _forget_user_locale(self, discord_id):
+        self.user_locales.pop(discord_id, None)
+        self._changed_user_locales.pop(discord_id, None)
 
-        await self.spawn(self._oauth_result_listener)
+    def queue_config_write(self, guild_id, config):
+        "Makes config the active config for the guild and queues it (in memory only) for _config_writer"
+        self.guild_config[guild_id] = config
+        self.config_write_send_ch.send_nowait((guild_id, config))
 
     # admin commands
 
@@ -295,11 +440,24 @@ class Orisa(Plugin):
             await reply(ctx, "Shutting down...")
         except:
             pass
+        await self._shutdown(42)
+
+    async def _shutdown(self, exit_code):
+        "writes the configs that are only queued in memory, then stops the bot"
+        with trio.move_on_after(CONFIG_FLUSH_TIMEOUT):
+            await self._write_pending_configs()
         try:
             await self.client.kill()
         except:
             pass
-        raise SystemExit(42)
+        raise SystemExit(exit_code)
+
+    async def _shutdown_on_sigterm(self):
+        # the launcher and most process managers stop the bot this way
+        with trio.open_signal_receiver(signal.SIGTERM) as signals:
+            async for _signum in signals:
+                logger.info("Got SIGTERM, shutting down")
+                await self._shutdown(0)
 
     @command()
     @condition(only_owner, bypass_owner=False)
@@ -321,42 +479,96 @@ class Orisa(Plugin):
                     self.client.find_channel(vc.category_id)
                 )
 
+    @command()
+    @condition(only_owner, bypass_owner=False)
+    async def reloadtranslations(self, ctx):
+        started = time.monotonic()
+        try:
+            await i18n.reload_catalogs()
+        except Exception:
+            logger.exception("Unable to reload translations")
+            await reply(ctx, "Reloading failed, still using the old translations. Check the log.")
+            return
+        took = time.monotonic() - started
+        logger.info("Reloaded translations in %.3fs", took)
+        await reply(ctx, f"Reloaded translations in {took:.3f}s")
+
+    @command()
+    @condition(only_owner, bypass_owner=False)
+    async def searchstats(self, ctx):
+        total = sum(member_index.TIER_HITS.values())
+        rates = member_index.tier_hit_rates()
+        lines = [
+            f"{tier}: {member_index.TIER_HITS[tier]} ({rates[tier]:.1%})"
+            for tier in member_index.TIERS
+        ]
+        lines.append(f"{total} searches, {len(self.member_indexes)} guilds indexed")
+        await ctx.channel.messages.send("\n".join(lines))
+
+    @command()
+    @condition(only_owner, bypass_owner=False)
+    async def loopstats(self, ctx):
+        await send_long(ctx.channel.messages.send, f"```\n{stalls.summary()}\n```")
+
+    @command()
+    @condition(only_owner, bypass_owner=False)
+    async def slowcommands(self, ctx, count: int = 10):
+        await send_long(ctx.channel.messages.send, f"```\n{tracing.slowest(count)}\n```")
+
     @command()
     @condition(only_owner, bypass_owner=False)
     async def messageallusers(self, ctx, *, message: str):
         async with self.database.session() as s:
-            users = await run_sync(s.query(User).all)
-            for user in users:
-                try:
-                    logger.debug(f"Sending message to {user.discord_id}")
-                    u = await self.client.get_user(user.discord_id)
-                    await u.send(message)
-                except:
-                    logger.exception(f"Error while sending to {user.discord_id}")
-            logger.debug("Done sending")
+            discord_ids = [id for (id,) in await run_sync(s.query(User.discord_id).all)]
+        await self._queue_broadcast(ctx, "users", message, discord_ids)
 
     @command()
     @condition(only_owner, bypass_owner=False)
     async def messageallservers(self, ctx, *, message: str):
-        for guild_config in self.guild_config.copy().values():
-            try:
-                logger.debug(f"Sending message to {guild_config}")
-                ch = self.client.find_channel(guild_config.listen_channel_id)
-                await ch.messages.send(message)
-            except:
-                logger.exception(f"Error while sending to {guild_config}")
-        logger.debug("Done sending")
+        # guild_config only has the guilds of our shards, so read all of them; ours
+        # may have changes that aren't written yet
+        async with self.database.session() as session:
+            guild_configs = {
+                config.id: GuildConfig.from_json2(config.config)
+                for config in await run_sync(session.query(GuildConfigJson).all)
+            }
+        guild_configs.update(self.guild_config.copy())
+        channel_ids = [
+            guild_config.listen_channel_id
+            for guild_config in guild_configs.values()
+            if guild_config.listen_channel_id
+        ]
+        await self._queue_broadcast(ctx, "servers", message, channel_ids)
 
     @command()
     @condition(only_owner, bypass_owner=False)
     async def messageserverowners(self, ctx, *, message: str):
-        for guild in ctx.bot.guilds.values():
-            try:
-                logger.info("working on guild %s with owner %s (%s)", guild, guild.owner, guild.owner.name)
-                await ctx.author.send(f"sending to {guild.owner.mention} ({guild.owner.name}) of {guild}")
-                await guild.owner.send(message)
-            except Exception:
-                logger.exception("unable to send to owner of guild %s", guild)
+        if self.shards.is_sharded:
+            await ctx.channel.messages.send(
+                "messageserverowners needs to see all guilds, so it can't run in a sharded process"
+            )
+            return
+
+        owner_ids = [guild.owner_id for guild in ctx.bot.guilds.values()]
+        await self._queue_broadcast(ctx, "owners", message, owner_ids)
+
+    @command()
+    @condition(only_owner, bypass_owner=False)
+    async def cancelbroadcast(self, ctx, job_id: int):
+        async with self.database.session() as session:
+            cancelled = await self.database.cancel_broadcast(session, job_id)
+        await ctx.channel.messages.send(
+            f"Broadcast #{job_id} will be cancelled" if cancelled else f"No unfinished broadcast #{job_id}"
+        )
+
+    async def _queue_broadcast(self, ctx, kind, message, target_ids):
+        async with self.database.session() as session:
+            job_id = await self.database.create_broadcast(session, kind, message, target_ids, ctx.channel.id)
+        self._broadcast_queued.set()
+        await ctx.channel.messages.send(
+            f"Queued broadcast #{job_id} to {len(set(target_ids))} {kind}, I'll report progress here. "
+            f"`!cancelbroadcast {job_id}` to stop it."
+        )
 
 
     @command()
@@ -447,29 +659,36 @@ class Orisa(Plugin):
     @command()
     @condition(only_owner, bypass_owner=False)
     async def cleanup(self, ctx, *, doit: str = None):
-        member_ids = [
+        if self.shards.is_sharded:
+            await ctx.channel.messages.send(
+                "cleanup needs to see the members of all guilds, so it can't run in a sharded process"
+            )
+            return
+
+        member_ids = {
             id for guild in self.client.guilds.values() for id in guild.members.keys()
-        ]
+        }
         async with self.database.session() as session:
-            registered_ids = [x[0] for x in await run_sync(session.query(User.discord_id).all)]
-            stale_ids = set(registered_ids) - set(member_ids)
-            ids = "\n".join(f"<@{id}>" for id in stale_ids)
-            await send_long(
-                ctx.channel.messages.send, 
-                f"there are {len(stale_ids)} stale entries: {ids}"
+            stale = await self.database.stale_users(session, member_ids)
+            user_ids = [id for id, discord_id in stale]
+            users, handles, srs = await self.database.count_user_rows(session, user_ids)
+            await ctx.channel.messages.send(
+                f"there are {users} stale users with {handles} handles and {srs} SR entries "
+                f"({users + handles + srs} rows)"
             )
+            if doit == "list":
+                ids = "\n".join(f"<@{discord_id}>" for id, discord_id in stale)
+                await send_long(ctx.channel.messages.send, ids)
             if doit == "confirm":
-                for id in stale_ids:
-                    user = await self.database.user_by_discord_id(session, id)
-                    if not user:
-                        await ctx.channel.messages.send(f"{id} not found in DB???")
-                    else:
-                        await run_sync(session.delete, user)
-                        logger.info(f"deleted {id}")
-                await send_long(ctx.channel.messages.send, f"Deleted {len(stale_ids)} entries")
-                await run_sync(session.commit)
-            elif stale_ids:
-                await ctx.channel.messages.send("issue `!cleanup confirm` to delete.")
+                users, handles, srs = await self.database.delete_users(session, user_ids)
+                for id, discord_id in stale:
+                    self._forget_user_locale(discord_id)
+                    self._unindex_user(discord_id)
+                logger.info("cleanup deleted %d users, %d handles and %d SRs", users, handles, srs)
+                await ctx.channel.messages.send(f"Deleted {users} users, {handles} handles and {srs} SR entries")
+            elif doit is None and stale:
+                # only after the dry run summary
+                await ctx.channel.messages.send("issue `!cleanup list` to see them, `!cleanup confirm` to delete.")
 
     @command()
     @condition(correct_channel)
@@ -602,6 +821,12 @@ class Orisa(Plugin):
     @ow.subcommand()
     @condition(correct_channel)
     async def about(self, ctx):
+        embed = self._cached_render(("about",), self._create_about)
+        await ctx.author.send(content=None, embed=embed)
+        if not ctx.channel.private:
+            await reply(ctx, _("I've sent you a DM."))
+
+    def _create_about(self):
         embed = Embed(
             title=_("About Me"),
             description=( 
@@ -637,9 +862,7 @@ class Orisa(Plugin):
                 _("If you find me useful, [buy my maintainer a cup of coffee]({DONATE_LINK}).").format(DONATE_LINK=DONATE_LINK)
             )
         )
-        await ctx.author.send(content=None, embed=embed)
-        if not ctx.channel.private:
-            await reply(ctx, _("I've sent you a DM."))
+        return embed
 
     @ow.subcommand()
     async def config(self, ctx, guild_id: int = None):
@@ -868,6 +1091,7 @@ class Orisa(Plugin):
                 t.position = i + 1
 
             await run_sync(session.commit)
+            self._index_primary_sr(user.discord_id, s.sr)
 
             await reply(
                 ctx,
@@ -978,18 +1202,24 @@ Pornography Historian""").split("\n")
             if not user:
                 await reply(ctx, _("you are not registered!"))
             else:
-                fault = False
+                fault = unavailable = False
                 async with ctx.channel.typing:
                     for handle in user.handles:
                         try:
                             await self._sync_handle(session, handle)
+                        except BlizzardUnavailable:
+                            # the other handles would be rejected as well
+                            unavailable = True
+                            break
                         except Exception as e:
                             if self.raven_client:
                                 self.raven_client.captureException()
                             logger.exception(f"exception while syncing {handle}")
                             fault = True
 
-                if fault:
+                if unavailable:
+                    await reply(ctx, _("Blizzard is unavailable, try again later."))
+                elif fault:
                     await reply(
                         ctx,
                         _("There were some problems updating your SR! Try again later."),
@@ -1024,6 +1254,8 @@ Pornography Historian""").split("\n")
                 except Exception:
                     logger.exception("Some problems while resetting nicks")
                 session.delete(user)
+                self._forget_user_locale(user_id)
+                self._unindex_user(user_id)
                 await reply(ctx, _("OK, deleted {name} from database").format(name=ctx.author.name))
                 await run_sync(session.commit)
             else:
@@ -1091,8 +1323,6 @@ Pornography Historian""").split("\n")
     async def _findplayers(
         self, ctx, diff_or_min_sr: int = None, max_sr: int = None, *, findall
     ):
-        await reply(ctx, _("Sorry, findplayers doesn't work with role based SR yet. Try later."))
-        return
         logger.info(
             f"{ctx.author.id} issued findplayers {diff_or_min_sr} {max_sr} {findall}"
         )
@@ -1121,7 +1351,7 @@ Pornography Historian""").split("\n")
                         return
 
                 base_sr = asker.handles[0].sr
-                if not base_sr:
+                if not base_sr or not any(base_sr):
                     await reply(
                         ctx,
                         # Translators: type is BattleTag or GamerTag
@@ -1130,11 +1360,16 @@ Pornography Historian""").split("\n")
                     return
 
                 if sr_diff is None:
-                    sr_diff = 1000 if base_sr < 3500 else 500
+                    sr_diff = 1000 if max(sr for sr in base_sr if sr) < 3500 else 500
 
-                min_sr, max_sr = base_sr - sr_diff, base_sr + sr_diff
+                # only the roles the asker has an SR for
+                ranges = {
+                    role_ix: (sr - sr_diff, sr + sr_diff) for role_ix, sr in enumerate(base_sr) if sr
+                }
 
-                type_msg = _("within {sr_diff} of {base_sr} SR").format(sr_diff=sr_diff, base_sr=base_sr)
+                type_msg = _("within {sr_diff} of {base_sr} SR").format(
+                    sr_diff=sr_diff, base_sr="/".join(str(sr) if sr else "—" for sr in base_sr)
+                )
 
             else:
                 # we are looking at a range
@@ -1150,77 +1385,83 @@ Pornography Historian""").split("\n")
                         _("min and max must be between 500 and 5000, and min must not be larger than max."),
                     )
                     return
+
+                ranges = {role_ix: (min_sr, max_sr) for role_ix in range(3)}
+
                 # Translators: used as part of the string "Here is a list of players <between min_sr and max_sr SR>" or "there are no players <between...>"
                 type_msg = _("between {min_sr} and {max_sr} SR").format(min_sr=min_sr, max_sr=max_sr)
 
-            candidates = (
-                session.query(BattleTag)
-                .join(BattleTag.current_sr)
-                .options(joinedload(BattleTag.user))
-                .filter(SR.value.between(min_sr, max_sr))
-                .all()
-            )
-
-            users = set(c.user for c in candidates)
+        # discord id -> (member, {role index: SR})
+        found = {}
 
-            cmap = {u.discord_id: u for u in users}
+        for guild in self.client.guilds.values():
+            if ctx.author.id not in guild.members:
+                continue
 
-            online = []
-            offline = []
+            index = self.get_sr_index(guild)
+            for role_ix, (min_sr, max_sr) in ranges.items():
+                for sr, discord_id in index.range(role_ix, min_sr, max_sr):
+                    if discord_id == ctx.author.id:
+                        continue
+                    try:
+                        member, srs = found[discord_id]
+                    except KeyError:
+                        member = guild.members.get(discord_id)
+                        if member is None:
+                            continue
+                        member, srs = found[discord_id] = member, {}
+                    srs[role_ix] = sr
 
-            for guild in self.client.guilds.values():
+        online = []
+        offline = []
 
-                if ctx.author.id not in guild.members:
-                    continue
+        for member, srs in sorted(found.values(), key=lambda item: str(item[0].name).lower()):
+            if member.status == Status.OFFLINE:
+                offline.append((member, srs))
+            else:
+                online.append((member, srs))
 
-                for member in guild.members.values():
-                    if member.user.id == ctx.author.id or member.user.id not in cmap:
-                        continue
-                    if member.status == Status.OFFLINE:
-                        offline.append(member)
-                    else:
-                        online.append(member)
+        def format_member(member, srs):
+            markup = "~~" if member.status == Status.DND else ""
 
-            def format_member(member):
-                nonlocal cmap
-                markup = "~~" if member.status == Status.DND else ""
+            if member.status == Status.IDLE:
+                hint = "(idle)"
+            elif member.status == Status.DND:
+                hint = "(DND)"
+            else:
+                hint = ""
 
-                if member.status == Status.IDLE:
-                    hint = "(idle)"
-                elif member.status == Status.DND:
-                    hint = "(DND)"
-                else:
-                    hint = ""
+            sr_str = "\u00a0".join(f"{ROLE_EMOJIS[role_ix]}{sr}" for role_ix, sr in sorted(srs.items()))
 
-                return f"{markup}{str(member.name)}\u00a0{member.mention}{markup}\u00a0{hint}\n"
+            return f"{markup}{str(member.name)}\u00a0{member.mention}{markup}\u00a0{sr_str}\u00a0{hint}\n"
 
-            msg = ""
+        msg = ""
 
-            if not online:
-                msg += _("There are no players currently online {type_msg}!\n\n").format(type_msg=type_msg)
-            else:
-                msg += _("**The following players are currently online and {type_msg}:**\n\n").format(type_msg=type_msg)
-                msg += "\n".join(format_member(m) for m in online)
-                msg += "\n"
+        if not online:
+            msg += _("There are no players currently online {type_msg}!\n\n").format(type_msg=type_msg)
+        else:
+            msg += _("**The following players are currently online and {type_msg}:**\n\n").format(type_msg=type_msg)
+            msg += "\n".join(format_member(*m) for m in online)
+            msg += "\n"
 
-            if findall:
+        if findall:
 
-                if not offline:
-                    if online:
-                        msg += _("There are no offline players within that range.")
-                    else:
-                        msg += _("There are also no offline players within that range. :(")
+            if not offline:
+                if online:
+                    msg += _("There are no offline players within that range.")
                 else:
-                    msg += _("**The following players are within that range, but currently offline:**\n\n")
-                    msg += "\n".join(format_member(m) for m in offline)
-
+                    msg += _("There are also no offline players within that range. :(")
             else:
-                if offline:
-                    msg += _("\nThere are also {len} offline players within that range. Use the `findallplayers` command to show them as well.").format(len=len(offline))
+                msg += _("**The following players are within that range, but currently offline:**\n\n")
+                msg += "\n".join(format_member(*m) for m in offline)
 
-            await send_long(ctx.author.send, msg)
-            if not ctx.channel.private:
-                await reply(ctx, _("I sent you a DM with the results."))
+        else:
+            if offline:
+                msg += _("\nThere are also {len} offline players within that range. Use the `findallplayers` command to show them as well.").format(len=len(offline))
+
+        await send_long(ctx.author.send, msg)
+        if not ctx.channel.private:
+            await reply(ctx, _("I sent you a DM with the results."))
 
     @ow.subcommand()
     async def help(self, ctx):
@@ -1243,8 +1484,11 @@ Pornography Historian""").split("\n")
                     logger.exception("Unable to send help embed")
 
                 return
+        channel_id = self._help_channel_id(ctx)
+        embeds = self._cached_render(("help", channel_id), functools.partial(self._create_help, channel_id))
+
         forbidden = False
-        for embed in self._create_help(ctx):
+        for embed in embeds:
             try:
                 await ctx.author.send(content=None, embed=embed)
             except Forbidden:
@@ -1260,14 +1504,98 @@ Pornography Historian""").split("\n")
         elif not ctx.channel.private:
             await reply(ctx, _("I sent you a DM with instructions."))
 
-    def _create_help(self, ctx):
-        channel_id = None
-
+    def _help_channel_id(self, ctx):
         for guild in self.client.guilds.values():
             if ctx.author.id in guild.members:
-                channel_id = self.guild_config[guild.id].listen_channel_id
-                break
+                return self.guild_config[guild.id].listen_channel_id
+        return None
+
+    def get_member_index(self, guild):
+        "the member index of guild, None (and it gets built) if it isn't built yet"
+        try:
+            return self.member_indexes[guild.id]
+        except KeyError:
+            self._queue_member_index(guild)
+            return None
+
+    def _queue_member_index(self, guild):
+        if guild.id in self._member_index_queued or guild.id in self.member_indexes:
+            return
+        self._member_index_queued.add(guild.id)
+        self.member_index_send_ch.send_nowait(guild)
+
+    def _member_index_of(self, guild_id):
+        "the index for member events, built or still being built"
+        index = self.member_indexes.get(guild_id)
+        return index if index is not None else self._member_indexes_building.get(guild_id)
+
+    async def _member_index_builder(self):
+        "builds the queued member indexes one at a time, without blocking the event loop for long"
+        async for guild in self.member_index_recv_ch:
+            self._member_index_queued.discard(guild.id)
+            if guild.id in self.member_indexes or guild.id not in self.client.guilds:
+                continue
+            started = time.monotonic()
+            index = self._member_indexes_building[guild.id] = MemberIndex()
+            try:
+                await index.add_members(guild.members)
+            except Exception:
+                logger.exception("Unable to build the member index for %s", guild)
+                self._member_indexes_building.pop(guild.id, None)
+                continue
+            # unless we left the guild meanwhile
+            if self._member_indexes_building.pop(guild.id, None) is index:
+                self.member_indexes[guild.id] = index
+                logger.debug(
+                    "built member index for %s with %d members in %.2fs", guild, len(index), time.monotonic() - started
+                )
+
+    def get_sr_index(self, guild):
+        try:
+            return self.sr_indexes[guild.id]
+        except KeyError:
+            index = self.sr_indexes[guild.id] = SRIndex(
+                (member_id, self.primary_srs[member_id])
+                for member_id in guild.members.keys()
+                if member_id in self.primary_srs
+            )
+            logger.debug("built SR index for %s with %d members", guild, len(index))
+            return index
+
+    def _index_primary_sr(self, discord_id, srs):
+        "to be called whenever the SR or the primary handle of a user changes"
+        if self.primary_srs.get(discord_id) == srs:
+            return
+        self.primary_srs[discord_id] = srs
+        for guild_id, index in self.sr_indexes.items():
+            guild = self.client.guilds.get(guild_id)
+            if guild and discord_id in guild.members:
+                index.set(discord_id, srs)
+
+    def _unindex_user(self, discord_id):
+        self.primary_srs.pop(discord_id, None)
+        for index in self.sr_indexes.values():
+            index.remove(discord_id)
+
+    def _cached_render(self, key, render):
+        """Returns the cached result of render() for key, the current locale and the owner.
+
+        Only use it for content that doesn't depend on anything else (or that is part of the key).
+        The cache is emptied when the translation catalogs change."""
+
+        if self._render_cache_catalogs is not i18n.CATALOGS:
+            self._render_cache.clear()
+            self._render_cache_catalogs = i18n.CATALOGS
 
+        key = (*key, CurrentLocale.get(), self.client.application_info.owner.id)
+        try:
+            return self._render_cache[key]
+        except KeyError:
+            with tracing.span(tracing.RENDER, key[0]):
+                result = self._render_cache[key] = render()
+            return result
+
+    def _create_help(self, channel_id):
         embed = Embed(
             title=_("Orisa's purpose"),
             # Translators: <@!> and <#> are discord codes and must be kept
@@ -1488,14 +1816,17 @@ Pornography Historian""").split("\n")
 
     @ow.subcommand()
     async def privacy(self, ctx):
-        with open(PRIVACY_POLICY_PATH) as f:
-            text = f.read()
-        text = text.replace("OWNER_ID", f"<@!{self.client.application_info.owner.id}>")
+        text = self._cached_render(("privacy",), self._create_privacy)
         await send_long(ctx.author.send, text)
         if not ctx.channel.private:
             # Translators: privacy policy is currently only availabe in English
             await reply(ctx, _("I sent you the privacy policy as DM."))
 
+    def _create_privacy(self):
+        with open(PRIVACY_POLICY_PATH) as f:
+            text = f.read()
+        return text.replace("OWNER_ID", f"<@!{self.client.application_info.owner.id}>")
+
     @ow.subcommand()
     async def dumpsr(self, ctx):
         async with self.database.session() as session:
@@ -1509,11 +1840,16 @@ Pornography Historian""").split("\n")
                 with pd.ExcelWriter(filename, engine="openpyxl") as xls_wr:
                     for handle in user.handles:
                         df = pd.DataFrame.from_records(
-                            [(sr.timestamp, sr.tank, sr. damage, sr.support) for sr in handle.sr_history], 
-                            columns=[_("Timestamp"), _("Tank"), _("Damage"), _("Support")],
+                            [
+                                (sr.valid_from, handle.last_update if sr is handle.current_sr else sr.valid_to, sr.tank, sr. damage, sr.support)
+                                for sr in handle.sr_history
+                            ],
+                            # Translators: an SR had these values from this timestamp to that one
+                            columns=[_("From"), _("To"), _("Tank"), _("Damage"), _("Support")],
                         )
                         df.to_excel(xls_wr, sheet_name=handle.handle, index=False)
                         xls_wr.sheets[handle.handle].column_dimensions['A'].width = 25
+                        xls_wr.sheets[handle.handle].column_dimensions['B'].width = 25
 
                 tmp.file.seek(0)
                 data = tmp.file.read()
@@ -1540,7 +1876,14 @@ Pornography Historian""").split("\n")
 
         handle = user.handles[0]
 
-        data = [(sr.timestamp, *sr.values) for sr in handle.sr_history]
+        with tracing.span(tracing.DB, "sr_history"):
+            data = []
+            for sr in handle.sr_history:
+                # newest first, reversed below; the current run lasts until the last sync
+                valid_to = handle.last_update if sr is handle.current_sr else sr.valid_to
+                if valid_to != sr.valid_from:
+                    data.append((valid_to, *sr.values))
+                data.append((sr.valid_from, *sr.values))
 
         if not data:
             await ctx.channel.messages.send(
@@ -1573,20 +1916,21 @@ Pornography Historian""").split("\n")
 
             data = data[data.index >= date]
 
-        fig, ax = plt.subplots()
+        with tracing.span(tracing.RENDER, "srgraph"):
+            fig, ax = plt.subplots()
 
-        ax.xaxis_date()
+            ax.xaxis_date()
 
-        sns.lineplot(data=data, ax=ax, drawstyle="steps-post", dashes=True)
+            sns.lineplot(data=data, ax=ax, drawstyle="steps-post", dashes=True)
 
-        ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%d.%m.%y"))
-        fig.autofmt_xdate()
+            ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%d.%m.%y"))
+            fig.autofmt_xdate()
 
-        plt.xlabel("Date")
-        plt.ylabel("SR")
+            plt.xlabel("Date")
+            plt.ylabel("SR")
 
-        image = BytesIO()
-        plt.savefig(format="png", fname=image, transparent=False)
+            image = BytesIO()
+            plt.savefig(format="png", fname=image, transparent=False)
         image.seek(0)
         embed = Embed(
             title=_("SR History For {name}").format(name=name),
@@ -1603,6 +1947,10 @@ Pornography Historian""").split("\n")
     # Events
     @event("member_update")
     async def _member_update(self, ctx, old_member: Member, new_member: Member):
+        index = self._member_index_of(new_member.guild_id)
+        if index is not None:
+            index.add_member(new_member)
+
         def plays_overwatch(m):
             try:
                 return m.game.name == "Overwatch"
@@ -1634,6 +1982,11 @@ Pornography Historian""").split("\n")
                     return
 
                 ids_to_sync = [t.id for t in user.handles]
+
+                # the scheduler syncs recently active users more often
+                user.last_seen_playing = datetime.utcnow()
+                await run_sync(session.commit)
+
                 logger.info(
                     f"{new_member.name} stopped playing OW and has {len(ids_to_sync)} BattleTags that need to be checked"
                 )
@@ -1694,8 +2047,21 @@ Pornography Historian""").split("\n")
                 session.delete(gc)
             with suppress(KeyError):
                 del self.guild_config[guild.id]
+            self.member_indexes.pop(guild.id, None)
+            self._member_indexes_building.pop(guild.id, None)
+            self.sr_indexes.pop(guild.id, None)
             await run_sync(session.commit)
 
+    @event("guild_member_add")
+    async def _guild_member_add(self, ctx: Context, member: Member):
+        index = self._member_index_of(member.guild_id)
+        if index is not None:
+            index.add_member(member)
+
+        index = self.sr_indexes.get(member.guild_id)
+        if index is not None and member.id in self.primary_srs:
+            index.set(member.id, self.primary_srs[member.id])
+
     @event("guild_member_remove")
     async def _guild_member_remove(self, ctx: Context, member: Member):
         logger.debug(
@@ -1707,9 +2073,21 @@ Pornography Historian""").split("\n")
             await self._guild_leave(ctx, member.guild)
             return
         else:
+            index = self._member_index_of(member.guild_id)
+            if index is not None:
+                index.remove(member.id)
+
+            index = self.sr_indexes.get(member.guild_id)
+            if index is not None:
+                index.remove(member.id)
+
             async with self.database.session() as session:
                 user = await self.database.user_by_discord_id(session, member.id)
-                if user:
+                if user and self.shards.is_sharded:
+                    # we only see the guilds of our shards, they might still be in one of the others;
+                    # like cleanup, leave it to an unsharded process
+                    logger.debug(f"not deleting {user}, they might still be in a guild of another shard")
+                elif user:
                     in_other_guild = False
                     for guild in self.client.guilds.values():
                         if guild.id != member.guild.id and member.id in guild.members:
@@ -1721,6 +2099,8 @@ Pornography Historian""").split("\n")
                             f"deleting {user} from database because {member.name} left the guild and has no other guilds"
                         )
                         session.delete(user)
+                        self._forget_user_locale(member.id)
+                        self._unindex_user(member.id)
                         await run_sync(session.commit)
 
 
@@ -1761,12 +2141,14 @@ Pornography Historian""").split("\n")
     @event("guild_join")
     async def _guild_joined(self, ctx: Context, guild: Guild):
         logger.info("Joined guild %r", guild)
+        self._queue_member_index(guild)
         await self._handle_new_guild(guild)
 
 
     @event("guild_streamed")
     async def _guild_streamed(self, ctx, guild):
         logger.info("Streamed guild %r", guild)
+        self._queue_member_index(guild)
         if guild.id not in self.guild_config:
             await self._handle_new_guild(guild)
 
@@ -1879,6 +2261,8 @@ Pornography Historian""").split("\n")
             logger.debug("channel is not managed")
             return
 
+        metrics.VOICE_ADJUSTMENTS.inc()
+
         def chan_name_no_sr(chan):
             return re.sub(r" \[.*?\]$", "", chan.name)
 
@@ -1901,6 +2285,7 @@ Pornography Historian""").split("\n")
                 "channel_delete", lambda chan: chan.id == id
             ):
                 await chan.delete()
+            metrics.VOICE_CHANNELS_DELETED.inc()
             made_changes = True
 
         async def add_a_channel():
@@ -1917,6 +2302,7 @@ Pornography Historian""").split("\n")
                 await guild.channels.create(
                     type_=ChannelType.VOICE, name=name, parent=parent, user_limit=limit
                 )
+            metrics.VOICE_CHANNELS_CREATED.inc()
 
             made_changes = True
 
@@ -2180,6 +2566,7 @@ Pornography Historian""").split("\n")
             try:
                 await member.nickname.set(new_nn)
             except (HierarchyError, PermissionsError):
+                metrics.NICK_UPDATES_FAILED.inc()
                 logger.info(
                     "Cannot update nick %s to %s due to not enough permissions",
                     nn,
@@ -2188,8 +2575,13 @@ Pornography Historian""").split("\n")
                 if raise_hierachy_error:
                     raise
             except Exception as e:
+                metrics.NICK_UPDATES_FAILED.inc()
                 logger.warn("error while setting nick", exc_info=True)
                 raise
+            else:
+                metrics.NICK_UPDATES_APPLIED.inc()
+        else:
+            metrics.NICK_UPDATES_SKIPPED.inc()
 
         return new_nn
 
@@ -2254,11 +2646,8 @@ Pornography Historian""").split("\n")
     async def _top_players(self, guild_ids, style="fancy_grid", update_cron=True):
 
         def prev_sr(tag):
-            for sr in tag.sr_history[:30]:
-                prev_sr = sr
-                if sr.timestamp < datetime.now() - timedelta(days=1):
-                    break
-            return prev_sr
+            # the SR a day ago, or the oldest one for handles that are newer
+            return tag.sr_at(datetime.now() - timedelta(days=1)) or tag.sr_history.order_by(None).order_by(SR.valid_from).first()
 
         async with self.database.session() as session:
 
@@ -2315,6 +2704,7 @@ Pornography Historian""").split("\n")
 
             for guild_id, role_tops in top_per_guild.items():
                 logger.debug(f"Processing guild {guild_id} for top_players")
+                guild_started = time.monotonic()
                 CurrentLocale.set(self.guild_config[guild_id].locale)
                 for type_role, tops in role_tops.items():
                     type_class, role = type_role
@@ -2435,10 +2825,14 @@ Pornography Historian""").split("\n")
 
                     # wait a bit before sending the next batch to avoid running into
                     # rate limiting and sending data twice due to "timeouts"
-                    logger.debug("sleeping for 5s")
-                    await trio.sleep(5)
+                    logger.debug("sleeping for %ds", HIGHSCORE_TABLE_DELAY)
+                    await trio.sleep(HIGHSCORE_TABLE_DELAY)
                     logger.debug("done sleeping")
                 # one guild done
+                took = time.monotonic() - guild_started
+                # per guild only in the log, a guild label would create too many series
+                metrics.HIGHSCORE_SECONDS.observe(took)
+                logger.info("Posted highscores of guild %d in %.1fs", guild_id, took)
 
 
     async def _message_new_guilds(self):
@@ -2447,25 +2841,36 @@ Pornography Historian""").split("\n")
                 await self._handle_new_guild(guild)
 
     async def _sync_handle(self, session, handle):
+        failure = None
         try:
-            srs, images = await get_sr(handle)
-        except UnableToFindSR:
+            srs, images = await get_sr(handle, interactive=True)
+        except UnableToFindSR as e:
             logger.debug(f"No SR for {handle}, oh well...")
+            metrics.HANDLE_SYNCS_NO_SR.inc()
             srs = TDS(None, None, None)
             images = [None]*3
-        except Exception:
+            failure = e.kind
+        except BlizzardUnavailable:
+            # Blizzard wasn't asked, so this isn't a failed sync of the handle
+            logger.info(f"Not syncing {handle.handle}, requests to Blizzard are paused")
+            raise
+        except Exception as e:
+            metrics.HANDLE_SYNCS_ERROR.inc()
             handle.error_count += 1
-            # we need to update the last_update pseudo-column
-            handle.update_sr(handle.sr)
+            handle.record_sync(failure=getattr(e, "kind", None))
             if self.raven_client:
                 self.raven_client.captureException()
             logger.exception(f"Got exception while requesting {handle.handle}")
             raise
+        else:
+            metrics.HANDLE_SYNCS_OK.inc()
         handle.error_count = 0
-        handle.update_sr(srs)
-        await self._handle_new_sr(session, handle, srs, images)
+        changed = handle.update_sr(srs, failure=failure)
+        if handle.position == 0:
+            self._index_primary_sr(handle.user.discord_id, handle.sr)
+        await self._handle_new_sr(session, handle, srs, images, changed=changed)
 
-    async def _handle_new_sr(self, session, handle, srs, images):
+    async def _handle_new_sr(self, session, handle, srs, images, *, changed=True):
         try:
             await self._update_nick(handle.user)
         except HierarchyError:
@@ -2488,18 +2893,22 @@ Pornography Historian""").split("\n")
 
             # we can still do the rest, no need to return here
 
+        if changed:
+            # the queries below need current_sr_id
+            await run_sync(session.flush)
+
         for role_ix, rank, sr, type_to_check, image in zip(range(3), handle.rank, srs, [SR.tank, SR.damage, SR.support], images):
 
-            if rank is not None:
+            # an unchanged SR continues the current run, and was already checked when it started
+            if rank is not None and changed:
                 # get highest SR, but exclude current_sr
-                await run_sync(session.commit)
                 prev_highest_sr_value = session.query(func.max(type_to_check)).filter(
                     SR.handle == handle, SR.id != handle.current_sr_id
                 )
                 prev_highest_sr = (
                     session.query(SR)
                     .filter(type_to_check == prev_highest_sr_value)
-                    .order_by(desc(SR.timestamp))
+                    .order_by(desc(SR.valid_from))
                     .first()
                 )
 
@@ -2510,66 +2919,159 @@ Pornography Historian""").split("\n")
                     )
                     await self._send_congrats(handle, role_ix, sr, rank, image)
 
-    async def _sync_handles_from_channel(self, channel):
+    async def _sync_handles_from_channel(self, channel, results):
+        "requests the SRs of the handles in channel, the results are written by _write_sync_results"
         first = True
-        async with channel:
-            async for handle_id in channel:
-                logger.debug("got %s from channel %r", handle_id, channel)
-                if handle_id in self.sync_cache:
+        async with channel, results:
+            async for handle in channel:
+                logger.debug("got %s from channel %r", handle, channel)
+                if handle.id in self.sync_cache:
                     logger.debug("Already updated, not doing it again")
                     continue
                 else:
-                    self.sync_cache[handle_id] = True  # any value really
+                    self.sync_cache[handle.id] = True  # any value really
                 if not first:
-                    delay = 1 + random.random() * 5
+                    delay = SYNC_DELAY + random.random() * SYNC_DELAY_JITTER
                     logger.debug(f"rate limiting: sleeping for {delay:3.02}s")
                     await trio.sleep(delay)
                 else:
                     first = False
-                async with self.database.session() as session:
-                    try:
-                        handle = await self.database.handle_by_id(session, handle_id)
-                        if handle:
-                            await self._sync_handle(session, handle)
-                        else:
-                            logger.warn(f"No handle for id {handle_id} found, probably deleted")
-                        await run_sync(session.commit)
-                    except Exception:
-                        if handle:
-                            logger.warn(
-                                f"exception while syncing {handle} for {handle.user.discord_id}", exc_info=True
-                            )
-                        else:
-                            logger.warn("Exception while getting handle for sync", exc_info=True)
-                    finally:
-                        try:
-                            await run_sync(session.commit)
-                        except Exception:
-                            logger.exception("cannot sync session")
+                failure = None
+                try:
+                    srs, images = await get_sr(handle)
+                except UnableToFindSR as e:
+                    logger.debug(f"No SR for {handle}, oh well...")
+                    metrics.HANDLE_SYNCS_NO_SR.inc()
+                    srs = TDS(None, None, None)
+                    images = [None]*3
+                    failure = e.kind
+                except BlizzardUnavailable:
+                    # the handle stays due and is synced by a later sync check, skip
+                    # through the rest without pausing
+                    logger.debug(f"Not syncing {handle}, requests to Blizzard are paused")
+                    self.sync_cache.pop(handle.id, None)
+                    first = True
+                    continue
+                except (InvalidBattleTag, BlizzardError) as e:
+                    metrics.HANDLE_SYNCS_ERROR.inc()
+                    if self.raven_client and e.kind not in NEGATIVE_CACHE_TTLS:
+                        self.raven_client.captureException()
+                    logger.warn(f"{e.kind} while syncing {handle} for {handle.user.discord_id}: {e}")
+                    srs = images = None
+                    failure = e.kind
+                except Exception:
+                    metrics.HANDLE_SYNCS_ERROR.inc()
+                    if self.raven_client:
+                        self.raven_client.captureException()
+                    logger.warn(
+                        f"exception while syncing {handle} for {handle.user.discord_id}", exc_info=True
+                    )
+                    srs = images = None
+                else:
+                    metrics.HANDLE_SYNCS_OK.inc()
+                await results.send((handle.id, srs, images, datetime.utcnow(), failure))
             
         logger.debug("channel %r closed, done", channel)
 
+    async def _write_sync_results(self, results):
+        "collects the results of the sync workers into batches of up to SYNC_BATCH_SIZE"
+        async with results:
+            while True:
+                try:
+                    batch = [await results.receive()]
+                except trio.EndOfChannel:
+                    break
+                with trio.move_on_after(SYNC_BATCH_DELAY):
+                    while len(batch) < SYNC_BATCH_SIZE:
+                        try:
+                            batch.append(await results.receive())
+                        except trio.EndOfChannel:
+                            break
+                await self._save_sync_batch(batch)
+
+    async def _save_sync_batch(self, batch):
+        "writes a batch of sync results, and then updates nicks and sends congrats for the synced handles"
+        try:
+            async with self.database.session() as session:
+                changed = await self.database.save_sync_results(
+                    session,
+                    [(handle_id, srs, timestamp, failure) for handle_id, srs, images, timestamp, failure in batch],
+                )
+                metrics.SYNC_BATCH_HANDLES.observe(len(batch))
+
+                synced = {handle_id: (srs, images) for handle_id, srs, images, timestamp, _ in batch if srs is not None}
+                for handle in await self.database.handles_by_ids(session, synced):
+                    srs, images = synced[handle.id]
+                    if handle.position == 0:
+                        self._index_primary_sr(handle.user.discord_id, handle.sr)
+                    try:
+                        await self._handle_new_sr(session, handle, srs, images, changed=handle.id in changed)
+                    except Exception:
+                        logger.warn(
+                            f"exception while handling the new SR of {handle} for {handle.user.discord_id}", exc_info=True
+                        )
+                # nickname warnings
+                if session.dirty:
+                    await run_sync(session.commit)
+        except Exception:
+            logger.exception("Unable to save %d sync results", len(batch))
+
     async def _sync_check(self):
         async with self.database.session() as session:
-            ids_to_sync = await self.database.get_handles_to_be_synced(session)
+            ids_to_sync = await self.database.get_handles_to_be_synced(session, self.shards)
+        metrics.HANDLES_DUE.set(len(ids_to_sync))
         if ids_to_sync:
             logger.info(f"{len(ids_to_sync)} handles need to be synced")
             await self._sync_handles(ids_to_sync)
         else:
             logger.debug("No tags need to be synced")
 
+        if self.shards.is_sharded:
+            await self._refresh_foreign_nicks()
+
+    async def _refresh_foreign_nicks(self):
+        "update the nicks of members whose handles were synced by the process owning the user"
+
+        now = datetime.utcnow()
+        # SRs are written before they are committed, so look back a bit;
+        # updating a nick that is already correct is a no-op
+        since = self._foreign_nicks_checked - timedelta(seconds=FOREIGN_NICKS_OVERLAP)
+        self._foreign_nicks_checked = now
+
+        async with self.database.session() as session:
+            users = await self.database.users_synced_since(session, since)
+            users = [
+                user
+                for user in users
+                if not self.shards.owns_user(user.discord_id)
+                and any(user.discord_id in guild.members for guild in self.client.guilds.values())
+            ]
+            logger.debug("Updating nicks of %d users synced by other shards", len(users))
+            for user in users:
+                self._index_primary_sr(user.discord_id, user.handles[0].sr)
+                try:
+                    await self._update_nick(user)
+                except Exception:
+                    logger.info("Unable to update nick of %s", user.discord_id, exc_info=True)
+
     async def _sync_handles(self, ids_to_sync):
-        send_ch, receive_ch = trio.open_memory_channel(len(ids_to_sync))
+        # the workers only read the handles, so they can be loaded at once
+        async with self.database.session() as session:
+            handles = await self.database.handles_by_ids(session, ids_to_sync)
+
+        send_ch, receive_ch = trio.open_memory_channel(len(handles))
+        result_send_ch, result_receive_ch = trio.open_memory_channel(SYNC_BATCH_SIZE)
         logger.debug("preparing to sync handles: %s into channel %r", ids_to_sync, send_ch)
 
         async with send_ch:
-            for tag_id in ids_to_sync:
-                await send_ch.send(tag_id)
+            for handle in handles:
+                await send_ch.send(handle)
 
         async with trio.open_nursery() as nursery:
-            async with receive_ch:
-                for _ in range(min(len(ids_to_sync), 5)):
-                    nursery.start_soon(self._sync_handles_from_channel, receive_ch.clone())
+            nursery.start_soon(self._write_sync_results, result_receive_ch)
+            async with receive_ch, result_send_ch:
+                for _ in range(min(len(handles), 5)):
+                    nursery.start_soon(self._sync_handles_from_channel, receive_ch.clone(), result_send_ch.clone())
         logger.info("done syncing")
 
     async def _sync_all_handles_task(self):
@@ -2592,19 +3094,23 @@ Pornography Historian""").split("\n")
                 logger.debug("checking cron...")
                 async with self.database.session() as s:
                     now = datetime.utcnow()
-                    to_run = await run_sync(s.query(HighscoreCron).filter(HighscoreCron.next_run <= now).all)
+                    to_run = [
+                        (hc.id, hc.next_run)
+                        for hc in await run_sync(s.query(HighscoreCron).filter(HighscoreCron.next_run <= now).all)
+                        if self.shards.owns_guild(hc.id)
+                    ]
                     logger.debug(
                         "to_run %s",
                         to_run
                     )
-                    for hc in to_run:
-                        hc.last_run = now
-                        n = hc.next_run
-                        n = now.replace(hour=n.hour, minute=n.minute, second=n.second, microsecond=0) + timedelta(days=1)
-                        hc.next_run = n
-                    await run_sync(s.commit)                        
-
-                    guild_ids = [h.id for h in to_run]
+                    guild_ids = []
+                    for guild_id, scheduled in to_run:
+                        n = now.replace(hour=scheduled.hour, minute=scheduled.minute, second=scheduled.second, microsecond=0) + timedelta(days=1)
+                        # a replica might have run it already
+                        if await self.database.claim_highscore_run(s, guild_id, scheduled, now, n):
+                            guild_ids.append(guild_id)
+                        else:
+                            logger.debug("highscore of %d claimed by another process", guild_id)
 
                 if guild_ids:
                     logger.debug("running highscore...")
@@ -2615,15 +3121,206 @@ Pornography Historian""").split("\n")
             await trio.sleep(1 * 60)
 
 
-    async def _web_server(self):
+    async def _config_writer(self):
+        """write-behind for queue_config_write, configs saved in quick succession end up in one commit.
+        The queue only lives in memory, so it is written once more when the writer is cancelled."""
+        try:
+            while True:
+                if not self._pending_configs:
+                    guild_id, config = await self.config_write_recv_ch.receive()
+                    self._pending_configs[guild_id] = config
+                await trio.sleep(CONFIG_WRITE_BATCH_DELAY)
+                if not await self._write_pending_configs():
+                    await trio.sleep(CONFIG_WRITE_RETRY_DELAY)
+        finally:
+            with trio.move_on_after(CONFIG_FLUSH_TIMEOUT) as flush_scope:
+                flush_scope.shield = True
+                await self._write_pending_configs()
+
+    async def _write_pending_configs(self):
+        "writes all queued configs in one commit; returns whether that worked, if not, they stay queued"
+        while True:
+            try:
+                guild_id, config = self.config_write_recv_ch.receive_nowait()
+            except trio.WouldBlock:
+                break
+            # only the latest config of a guild is relevant
+            self._pending_configs[guild_id] = config
+        if not self._pending_configs:
+            return True
+
+        pending, self._pending_configs = self._pending_configs, {}
+        started = time.monotonic()
+        try:
+            async with self.database.session() as session:
+                await self.database.save_guild_configs(session, pending)
+        except Exception:
+            logger.exception("Unable to write configs for guilds %s, retrying later", list(pending))
+            # configs queued in the meantime are newer
+            self._pending_configs = {**pending, **self._pending_configs}
+            return False
+        logger.info("Wrote configs for %d guild(s) in %.3fs", len(pending), time.monotonic() - started)
+        return True
+
+    async def _user_locale_refresher(self):
+        "picks up locales other processes changed; ours that aren't written yet win"
+        while True:
+            await trio.sleep(USER_LOCALE_REFRESH_INTERVAL)
+            try:
+                async with self.database.session() as session:
+                    locales = dict(await run_sync(session.query(User.discord_id, User.locale).all))
+            except Exception:
+                logger.exception("Unable to reload user locales")
+                continue
+            self.user_locales = {**locales, **self._changed_user_locales}
+            logger.debug("Reloaded locales of %d users", len(self.user_locales))
+
+    async def _user_locale_writer(self):
+        while True:
+            await trio.sleep(USER_LOCALE_WRITE_INTERVAL)
+            if not self._changed_user_locales:
+                continue
+            changed, self._changed_user_locales = self._changed_user_locales, {}
+            try:
+                async with self.database.session() as session:
+                    await self.database.update_user_locales(session, changed)
+                logger.debug("Wrote %d changed user locales", len(changed))
+            except Exception:
+                logger.exception("Unable to write user locales, retrying later")
+                # newer changes take precedence
+                self._changed_user_locales = {**changed, **self._changed_user_locales}
+
+    async def _broadcast_task(self):
+        "delivers queued broadcasts, including those interrupted by a restart"
+
+        while True:
+            try:
+                async with self.database.session() as session:
+                    jobs = await self.database.unfinished_broadcasts(session)
+                for job_id, kind, message, report_channel_id in jobs:
+                    await run_broadcast(
+                        self.database,
+                        job_id,
+                        functools.partial(self._deliver_broadcast, kind, message),
+                        functools.partial(self._report_broadcast, report_channel_id),
+                        permanent_errors=(Forbidden, NotFound),
+                        requests_per_delivery=1 if kind == "servers" else 2,
+                    )
+            except Exception:
+                logger.exception("Error while running broadcasts")
+
+            # a broadcast queued by another process is picked up by polling
+            with trio.move_on_after(BROADCAST_POLL_INTERVAL):
+                await self._broadcast_queued.wait()
+            self._broadcast_queued = trio.Event()
+
+    async def _deliver_broadcast(self, kind, message, target_id):
+        # low level access, get_user would need an extra request per user
+        http = self.client.http
+        if kind == "servers":
+            await http.send_message(target_id, message)
+        else:
+            channel = await http.create_private_channel(target_id)
+            await http.send_message(int(channel["id"]), message)
+
+    async def _report_broadcast(self, channel_id, progress):
+        if channel_id:
+            await self.client.http.send_message(channel_id, str(progress))
+
+    async def _run_with_lease(self, name, job, address=None):
+        """runs job only while this process holds the lease name, waiting for it if necessary;
+        address is stored with the lease, for jobs that are servers"""
+
+        while True:
+            try:
+                async with self.database.session() as session:
+                    acquired = await self.database.acquire_lease(
+                        session, name, self.instance_id, LEASE_DURATION, address=address
+                    )
+            except Exception:
+                logger.exception("Unable to acquire lease %s", name)
+                acquired = False
+
+            if not acquired:
+                logger.debug("Lease %s is held by another process", name)
+                await trio.sleep(LEASE_RETRY_INTERVAL)
+                continue
+
+            logger.info("Acquired lease %s, starting %s", name, job.__name__)
+            finished = False
+            try:
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(self._renew_lease, name, address, nursery.cancel_scope)
+                    await job()
+                    finished = True
+                    nursery.cancel_scope.cancel()
+            finally:
+                # so a replica can take over right away instead of waiting for it to expire
+                await self._release_lease(name)
+
+            if finished:
+                logger.info("%s finished, released lease %s", job.__name__, name)
+                return
+            logger.warning("Lost lease %s, stopped %s", name, job.__name__)
+
+    async def _release_lease(self, name):
+        with trio.move_on_after(LEASE_RELEASE_TIMEOUT) as release_scope:
+            # also when we are being cancelled
+            release_scope.shield = True
+            try:
+                async with self.database.session() as session:
+                    await self.database.release_lease(session, name, self.instance_id)
+            except Exception:
+                logger.exception("Unable to release lease %s, it expires on its own", name)
+
+    async def _renew_lease(self, name, address, cancel_scope):
+        expires = trio.current_time() + LEASE_DURATION.total_seconds()
+        while True:
+            await trio.sleep(LEASE_DURATION.total_seconds() / 3)
+            try:
+                async with self.database.session() as session:
+                    renewed = await self.database.acquire_lease(
+                        session, name, self.instance_id, LEASE_DURATION, address=address
+                    )
+            except Exception:
+                logger.exception("Unable to renew lease %s", name)
+                # keep running while the lease is still valid, the database might be back soon
+                if trio.current_time() >= expires - LEASE_DURATION.total_seconds() / 3:
+                    cancel_scope.cancel()
+                continue
+
+            if renewed:
+                expires = trio.current_time() + LEASE_DURATION.total_seconds()
+            else:
+                cancel_scope.cancel()
+
+    async def _web_tasks(self):
+        "the web server and the processing of its OAuth results belong together"
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self._web_server)
+            nursery.start_soon(self._oauth_result_listener)
+
+    async def guild_api_address(self, guild_id):
+        "host:port of the internal web server of a process handling guild_id, None if none is running"
+        async with self.database.session() as session:
+            leases = await self.database.lease_addresses(session, GUILD_API_LEASE_PREFIX)
+        for name, address in leases:
+            if Shards.from_key(name[len(GUILD_API_LEASE_PREFIX) :]).owns_guild(guild_id):
+                return address
+        return None
+
+    async def _web_server(self, bind=None):
+        "serves the web app, on bind (host:port) instead of hypercorn's default if given"
         config = hypercorn.config.Config()
         config.access_logger = config.error_logger = logger
+        if bind:
+            config.bind = [bind]
 
         web.send_ch = self.web_send_ch
         web.client = self.client
         web.orisa = self
 
-        logger.info("Starting web server")
+        logger.info("Starting web server on %s", bind or "the default address")
         while True:
             try:
                 await hypercorn.trio.serve(web.app, config)
@@ -2633,16 +3330,29 @@ Pornography Historian""").split("\n")
             await trio.sleep(10)
 
     async def _oauth_result_listener(self):
-        async with self.web_recv_ch as recv_ch:
+        async with trio.open_nursery() as nursery:
+            # a clone, the listener is restarted when the web lease is reacquired
+            async with self.web_recv_ch.clone() as recv_ch:
+                for _worker in range(REGISTRATION_WORKERS):
+                    nursery.start_soon(self._oauth_result_worker, recv_ch.clone())
+
+    async def _oauth_result_worker(self, recv_ch):
+        async with recv_ch:
             async for uid, type, data in recv_ch:
                 logger.debug(f"got OAuth response data {data} of type {type} for uid {uid}")
+                # registrations of the same user one after the other, or both could add the same handle
+                lock = self._registration_locks.setdefault(uid, trio.Lock())
                 try:
                     with trio.move_on_after(60):
-                        await self._handle_registration(uid, type, data)
+                        async with lock:
+                            await self._handle_registration(uid, type, data)
                 except Exception:
                     logger.error(
                         "Something went wrong when working with data %s", data, exc_info=True
                     )
+                finally:
+                    if not lock.locked() and not lock.statistics().tasks_waiting:
+                        self._registration_locks.pop(uid, None)
 
     async def _handle_registration(self, user_id, type, data):
         handles_to_check = []
@@ -2774,7 +3484,7 @@ Pornography Historian""").split("\n")
                     # Translators: Used during registration while Orisa checks the BattleTag/GamerTag. {type} is BattleTag/GamerTag, {tag} is the tag (Foo#2345)
                     check_msg_obj = await user_channel.messages.send(_("Checking your {type} {tag}…").format(type=_(handle.desc), tag=handle.handle))
                     async with user_channel.typing:
-                        srs, images = await get_sr(handle)
+                        srs, images = await get_sr(handle, interactive=True)
                 except InvalidBattleTag as e:
                     logger.exception(f"Got invalid {handle.desc} for {handle.handle}")
                     await user_channel.messages.send(
@@ -2792,26 +3502,32 @@ Pornography Historian""").split("\n")
                         _("Sorry, but it seems like Blizzard's site has some problems currently ({e}), please try again later!").format(e=e)
                     )
                     raise
-                except UnableToFindSR:
+                except UnableToFindSR as e:
+                    failure = e.kind
                     embed.add_field(
                         # Translators: :warning: is an emoji code
                         name=_(":warning: No SR"),
                         value=_("You don't have an SR though, your profile needs to be public for SR tracking to work… I still saved your {type}.").format(type=_(handle.desc)),
                     )
                     srs = TDS(None, None, None)
+                else:
+                    failure = None
                 finally:
                     try:
                         await check_msg_obj.delete()
                     except Exception:
                         logger.exception("Unable to delete check message")
 
-                handle.update_sr(srs)
+                handle.update_sr(srs, failure=failure)
 
 
             sort_secondaries(user)
 
             await run_sync(session.commit)
 
+            self.user_locales.setdefault(user_id, user.locale)
+            self._index_primary_sr(user_id, user.handles[0].sr)
+
             try:
                 await self._update_nick(user, force=True, raise_hierachy_error=True)
             except NicknameTooLong as e:
@@ -2855,9 +3571,6 @@ Pornography Historian""").split("\n")
 
 
 def fuzzy_nick_match(ann, ctx: Context, name: str):
-    def strip_tags(name):
-        return re.sub(r"^(.*?\|)?([^[{]*)((\[|\{).*)?", r"\2", str(name)).strip()
-
     member = member_id = None
     if ctx.guild:
         guilds = [ctx.guild]
@@ -2874,29 +3587,19 @@ def fuzzy_nick_match(ann, ctx: Context, name: str):
             member_id = int(id)
         except ValueError:
             raise ConversionFailedError(ctx, name, Member, "Invalid member ID")
+        member_index.TIER_HITS["mention"] += 1
     else:
-
-        def scorer(s1, s2, force_ascii=True, full_process=True):
-            if s1.lower() == s2.lower():
-                return 200
-            else:
-                score = fuzz.WRatio(s1, s2, force_ascii, full_process)
-                if s2.startswith(s1):
-                    score *= 2
-                return score
-
-        candidates = process.extractBests(
-            name,
-            {
-                id: strip_tags(mem.name)
-                for guild in guilds
-                for id, mem in guild.members.items()
-            },
-            scorer=scorer,
-        )
+        indexes = [Orisa._instance.get_member_index(guild) for guild in guilds]
+        if None in indexes:
+            # not built yet, building it here would block everything for seconds in big guilds
+            candidates = member_index.scan(
+                {id: member for guild in guilds for id, member in guild.members.items()}.values(), name
+            )
+        else:
+            candidates = member_index.search(indexes, name)
         logger.debug(f"candidates are {candidates}")
         if candidates:
-            member_name, score, member_id = candidates[0]
+            score, member_id = candidates[0]
 
     if member_id is not None:
         for guild in guilds:
@@ -2920,10 +3623,33 @@ register_matplotlib_converters()
 GLaDOS: ContextVar[bool] = ContextVar("GLaDOS", default=False)
 
 
+def _count_requests(http):
+    "counts the REST requests done by http per route, and traces them"
+    request = http.request
+
+    async def counted_request(bucket, *args, **kwargs):
+        # the bucket is the route, or (route, major parameter)
+        route = metrics.route_label(bucket[0] if isinstance(bucket, tuple) else bucket)
+        metrics.DISCORD_REQUESTS.labels(route).inc()
+        with tracing.span(tracing.DISCORD, route):
+            return await request(bucket, *args, **kwargs)
+
+    http.request = counted_request
+    return http
+
+
 class OrisaClient(Client):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, shards=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__GLaDOS_http = HTTPClient(GLADOS_TOKEN, bot=True)
+        self.shards = shards or Shards.from_environment()
+        self.__GLaDOS_http = _count_requests(HTTPClient(GLADOS_TOKEN, bot=True))
+
+    async def handle_shard(self, shard_id, shard_count):
+        # curious starts all shard_count shards, the others are handled by other processes
+        if shard_id not in self.shards.shard_ids:
+            logger.debug("Shard %d is not handled by this process", shard_id)
+            return
+        return await super().handle_shard(shard_id, shard_count)
 
     @contextmanager
     def as_glados(self):
@@ -2937,6 +3663,6 @@ class OrisaClient(Client):
         return self.__GLaDOS_http if GLaDOS.get() else self.__http
 
     def _http_set(self, http):
-        self.__http = http
+        self.__http = _count_requests(http)
 
     http = property(_http_get, _http_set)
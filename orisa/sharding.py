@@ -0,0 +1,127 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# What each process of a sharded setup owns:
+#
+# - guilds (their configs, voice channels, highscores and member indexes): the
+#   process whose shards Discord sends the guild's events to, see owns_guild.
+#   The web server runs on the primary process and forwards guild config
+#   requests for other guilds to the internal web server of their process
+#   (INTERNAL_WEB_ADDRESS).
+# - users (syncing their handles): see owns_user. Every process keeps the
+#   primary SRs of all users for its own guilds; SR changes synced elsewhere are
+#   picked up by _refresh_foreign_nicks, other changes of the primary handle
+#   made on another process (setprimary, unregistering) only after a restart.
+# - user locales: every process has all of them; changes are written to the
+#   database by the process where they were made, and the others reload them
+#   every USER_LOCALE_REFRESH_INTERVAL.
+# - metrics: per process, /metrics of the internal web server of every process
+#   needs to be scraped (the public one only has the primary process's).
+
+import os
+
+from dataclasses import dataclass
+from typing import FrozenSet
+
+from .config import INTERNAL_WEB_ADDRESS, SHARD_COUNT, SHARD_IDS
+
+# set by the launcher, override SHARD_COUNT, SHARD_IDS and INTERNAL_WEB_ADDRESS from the config
+SHARD_COUNT_ENV = "ORISA_SHARD_COUNT"
+SHARD_IDS_ENV = "ORISA_SHARD_IDS"
+INTERNAL_WEB_ADDRESS_ENV = "ORISA_INTERNAL_WEB_ADDRESS"
+
+
+def internal_web_address():
+    "host:port of the internal web server of this process, None if there is none"
+    return os.environ.get(INTERNAL_WEB_ADDRESS_ENV, INTERNAL_WEB_ADDRESS)
+
+
+def shard_for(snowflake, shard_count):
+    "the shard Discord sends the events of a guild with this id to"
+    return (snowflake >> 22) % shard_count
+
+
+def parse_shard_ids(value):
+    "parses '0,1,2' or '4-7' style lists"
+    shard_ids = set()
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if sep:
+            shard_ids.update(range(int(first), int(last) + 1))
+        else:
+            shard_ids.add(int(part))
+    return frozenset(shard_ids)
+
+
+@dataclass(frozen=True)
+class Shards:
+    "the shards handled by this process"
+
+    shard_ids: FrozenSet[int]
+    shard_count: int
+
+    def __post_init__(self):
+        if not self.shard_ids:
+            raise ValueError("at least one shard id is required")
+        invalid = [id for id in self.shard_ids if not 0 <= id < self.shard_count]
+        if invalid:
+            raise ValueError(f"shard ids {sorted(invalid)} are not in range(0, {self.shard_count})")
+
+    @classmethod
+    def from_environment(cls):
+        shard_count = int(os.environ.get(SHARD_COUNT_ENV, SHARD_COUNT))
+        if SHARD_IDS_ENV in os.environ:
+            shard_ids = parse_shard_ids(os.environ[SHARD_IDS_ENV])
+        elif SHARD_IDS is not None:
+            shard_ids = frozenset(SHARD_IDS)
+        else:
+            shard_ids = frozenset(range(shard_count))
+        return cls(shard_ids, shard_count)
+
+    @classmethod
+    def from_key(cls, key):
+        "the shards identified by key, see key"
+        shard_ids, _sep, shard_count = key.partition("/")
+        return cls(parse_shard_ids(shard_ids), int(shard_count))
+
+    @property
+    def is_sharded(self):
+        "True if other processes handle some of the shards"
+        return len(self.shard_ids) < self.shard_count
+
+    @property
+    def is_primary(self):
+        "the primary process runs the jobs that must only run once, like the web server"
+        return 0 in self.shard_ids
+
+    @property
+    def key(self):
+        "identifies the set of shards; processes with the same key are replicas of each other"
+        return f"{','.join(map(str, sorted(self.shard_ids)))}/{self.shard_count}"
+
+    def owns_guild(self, guild_id):
+        return shard_for(guild_id, self.shard_count) in self.shard_ids
+
+    def owns_user(self, discord_id):
+        """Users are spread over the shards like guilds, the owning process syncs their handles.
+
+        User ids are snowflakes too, so they are partitioned the same way."""
+        return shard_for(discord_id, self.shard_count) in self.shard_ids
+
+    def __str__(self):
+        return f"shards {sorted(self.shard_ids)} of {self.shard_count}"
@@ -0,0 +1,68 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from bisect import bisect_left, bisect_right, insort
+
+# the roles of a TDS, in order
+ROLES = ("tank", "damage", "support")
+
+
+class SRIndex:
+    """SRs of the primary handles of the registered members of one guild,
+    sorted per role so members within an SR range are found with bisect"""
+
+    def __init__(self, srs=()):
+        # discord id -> TDS
+        self.srs = {}
+        # per role, a sorted list of (sr, discord id)
+        self._sorted = tuple([] for _ in ROLES)
+
+        # insort is O(n), so sort only once when building
+        for discord_id, values in srs:
+            self.srs[discord_id] = values
+            for entries, sr in zip(self._sorted, values):
+                if sr is not None:
+                    entries.append((sr, discord_id))
+        for entries in self._sorted:
+            entries.sort()
+
+    def __len__(self):
+        return len(self.srs)
+
+    def set(self, discord_id, values):
+        "sets (or with None, removes) the SRs of a member"
+        if self.srs.get(discord_id) == values:
+            return
+        self.remove(discord_id)
+        if values is None:
+            return
+        self.srs[discord_id] = values
+        for entries, sr in zip(self._sorted, values):
+            if sr is not None:
+                insort(entries, (sr, discord_id))
+
+    def remove(self, discord_id):
+        values = self.srs.pop(discord_id, None)
+        if values is None:
+            return
+        for entries, sr in zip(self._sorted, values):
+            if sr is not None:
+                del entries[bisect_left(entries, (sr, discord_id))]
+
+    def range(self, role_index, min_sr, max_sr):
+        "(sr, discord id) of the members whose SR for the role is between min_sr and max_sr (inclusive)"
+        entries = self._sorted[role_index]
+        start = bisect_left(entries, (min_sr,))
+        end = bisect_right(entries, (max_sr, float("inf")))
+        return entries[start:end]
@@ -0,0 +1,127 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Detection of code blocking the trio loop.
+
+StallDetector is a trio instrument that times every step of every task; steps
+taking longer than a threshold are logged with the stack they were blocked in.
+monitor_loop_lag measures how late the loop wakes up sleeping tasks."""
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import trio
+
+from .metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# task steps running longer than this (in seconds) are stalls
+STALL_THRESHOLD = 0.1
+
+# how often the loop lag is measured, in seconds
+LOOP_LAG_INTERVAL = 0.5
+
+# task names are function names, so there is a limited number of them
+STALLS = Counter("orisa_loop_stalls_total", "Task steps blocking the loop longer than the threshold", ("task",))
+
+LOOP_LAG = Histogram(
+    "orisa_loop_lag_seconds",
+    "How late the loop wakes up sleeping tasks",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+).labels()
+
+STALL_DURATIONS = Histogram(
+    "orisa_loop_stall_seconds", "Durations of task steps blocking the loop", buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+).labels()
+
+
+class StallDetector(trio.abc.Instrument):
+    """Logs and counts task steps taking longer than threshold.
+
+    A watchdog thread samples the stack of the loop thread while a step is
+    running too long, so the log shows where it blocked, not where it resumed."""
+
+    def __init__(self, threshold=STALL_THRESHOLD):
+        self.threshold = threshold
+        self._loop_thread_id = threading.get_ident()
+        self._step_started = None
+        self._sampled_stack = None
+        self._watchdog = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def before_task_step(self, task):
+        self._sampled_stack = None
+        self._step_started = time.perf_counter()
+
+    def after_task_step(self, task):
+        started, self._step_started = self._step_started, None
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        if duration >= self.threshold:
+            STALLS.labels(task.name).inc()
+            STALL_DURATIONS.observe(duration)
+            stack = self._sampled_stack
+            logger.warning(
+                "Task %s blocked the loop for %.3fs%s",
+                task.name,
+                duration,
+                f", blocked in:\n{stack}" if stack else "",
+            )
+
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            started = self._step_started
+            if (
+                started is not None
+                and self._sampled_stack is None
+                and time.perf_counter() - started >= self.threshold
+            ):
+                frame = sys._current_frames().get(self._loop_thread_id)
+                # the step might have ended in the meantime
+                if frame is not None and self._step_started == started:
+                    self._sampled_stack = "".join(traceback.format_stack(frame))
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    "records how much later than requested sleeps end into LOOP_LAG"
+    while True:
+        expected = trio.current_time() + interval
+        await trio.sleep_until(expected)
+        LOOP_LAG.observe(max(0.0, trio.current_time() - expected))
+
+
+def summary(top=10):
+    "a text report for the loopstats owner command"
+    lines = ["Loop lag:"]
+    previous = 0
+    for bound, count in LOOP_LAG.cumulative():
+        if bound == float("inf"):
+            label = f"> {LOOP_LAG.bounds[-1] * 1000:g}ms"
+        else:
+            label = f"<= {bound * 1000:g}ms"
+        lines.append(f"  {label}: {count - previous}")
+        previous = count
+    if LOOP_LAG.count:
+        lines.append(f"  mean {LOOP_LAG.sum / LOOP_LAG.count * 1000:.1f}ms over {LOOP_LAG.count} samples")
+
+    lines.append(f"Stalls over {STALL_THRESHOLD * 1000:g}ms: {STALL_DURATIONS.count}")
+    stalls = sorted(((child.value, name) for (name,), child in STALLS._children.items()), reverse=True)
+    for count, name in stalls[:top]:
+        lines.append(f"  {count:5} {name}")
+    return "\n".join(lines)
@@ -0,0 +1,170 @@
+# Orisa, a simple Discord bot with good intentions
+# Copyright (C) 2018, 2019 Dennis Brakhane
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, version 3 only
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Per-stage tracing of commands.
+
+A trace is started for every command by the commands manager; code running
+as part of it records spans with
+
+    with tracing.span("db", "user_by_discord_id"):
+        ...
+
+which costs next to nothing when no trace is active. Finished traces are kept
+in memory for the slowcommands owner command, and a sample of them (plus all
+slow ones) is written to TRACE_FILE (from the config) as JSON lines."""
+import json
+import logging
+import logging.handlers
+import math
+import random
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+import trio
+
+from .config import TRACE_FILE, TRACE_FILE_BACKUPS, TRACE_FILE_MAX_BYTES, TRACE_SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+# stages, so the spans of different commands can be compared
+DISPATCH, CONDITION, DB, HTTP, RENDER, DISCORD = "dispatch", "condition", "db", "http", "render", "discord"
+
+# traces slower than this (in seconds) are always written, others with TRACE_SAMPLE_RATE
+SLOW_TRACE = 2.0
+
+# how many finished traces are kept for slowcommands
+RECENT_TRACES = 500
+
+CurrentTrace: ContextVar["Trace"] = ContextVar("CurrentTrace", default=None)
+
+RECENT = deque(maxlen=RECENT_TRACES)
+
+_send_ch, _recv_ch = trio.open_memory_channel(math.inf)
+
+
+class Trace:
+    def __init__(self, command):
+        self.command = command
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.duration = None
+        # (stage, name, offset, duration)
+        self.spans = []
+
+    def stage_totals(self):
+        totals = {}
+        for stage, name, offset, duration in self.spans:
+            totals[stage] = totals.get(stage, 0) + duration
+        return totals
+
+    def to_json(self):
+        return {
+            "command": self.command,
+            "started_at": self.started_at.isoformat(),
+            "duration": self.duration,
+            "spans": [
+                {"stage": stage, "name": name, "offset": offset, "duration": duration}
+                for stage, name, offset, duration in self.spans
+            ],
+        }
+
+
+@contextmanager
+def trace(command):
+    "traces everything done inside as command"
+    current = Trace(command)
+    token = CurrentTrace.set(current)
+    try:
+        yield current
+    finally:
+        CurrentTrace.reset(token)
+        current.duration = time.perf_counter() - current.started
+        RECENT.append(current)
+        if TRACE_FILE and (current.duration >= SLOW_TRACE or random.random() < TRACE_SAMPLE_RATE):
+            _send_ch.send_nowait(current)
+
+
+@contextmanager
+def span(stage, name=None):
+    current = CurrentTrace.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        current.spans.append((stage, name, started - current.started, now - started))
+
+
+def _trace_log(path):
+    "a logger writing lines to path, rotated when it reaches TRACE_FILE_MAX_BYTES"
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUPS, delay=True
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_log = logging.getLogger(f"{__name__}.file")
+    trace_log.handlers = [handler]
+    trace_log.setLevel(logging.INFO)
+    # the traces don't belong in the normal log
+    trace_log.propagate = False
+    return trace_log
+
+
+async def write_traces(path=TRACE_FILE):
+    "writes the sampled traces to path, in batches and in a thread"
+    if not path:
+        return
+    trace_log = _trace_log(path)
+    async with _recv_ch:
+        async for first in _recv_ch:
+            traces = [first]
+            while True:
+                try:
+                    traces.append(_recv_ch.receive_nowait())
+                except trio.WouldBlock:
+                    break
+            lines = [json.dumps(trace.to_json()) for trace in traces]
+
+            def write():
+                for line in lines:
+                    trace_log.info(line)
+
+            try:
+                await trio.to_thread.run_sync(write)
+            except Exception:
+                logger.exception("Unable to write %d traces", len(traces))
+
+
+def slowest(count=10):
+    "a text report of the slowest recent traces for the slowcommands owner command"
+    traces = sorted(RECENT, key=lambda trace: trace.duration, reverse=True)[:count]
+    lines = [f"{len(traces)} slowest of the last {len(RECENT)} commands:"]
+    for trace in traces:
+        stages = trace.stage_totals()
+        # time not covered by any span, like building embeds from lazily loaded relations
+        stages["other"] = max(0.0, trace.duration - sum(stages.values()))
+        totals = ", ".join(
+            f"{stage} {duration * 1000:.0f}ms"
+            for stage, duration in sorted(stages.items(), key=lambda item: item[1], reverse=True)
+        )
+        lines.append(
+            f"{trace.duration * 1000:7.0f}ms {trace.command} at {trace.started_at:%H:%M:%S} ({totals})"
+        )
+    return "\n".join(lines)
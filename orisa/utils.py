@@ -14,9 +14,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import logging
 import re
+import time
 
 from bisect import bisect
 from collections import namedtuple
+from datetime import timedelta
 from operator import attrgetter
 
 import asks
@@ -26,9 +28,15 @@ from cachetools.func import TTLCache
 from fuzzywuzzy import process
 from lxml import html
 
+from . import metrics, tracing
+from .config import BLIZZARD_REQUESTS_PER_MINUTE
 from .exceptions import (
     BlizzardError,
+    BlizzardServerError,
+    BlizzardTimeout,
+    BlizzardUnavailable,
     InvalidBattleTag,
+    PrivateProfile,
     UnableToFindSR,
     NicknameTooLong,
     InvalidFormat,
@@ -45,6 +53,30 @@ SR_LOCKS = TTLCache(
     maxsize=1000, ttl=60
 )  # if a request should be hanging for 60s, just try another
 
+# how long failed profile requests are remembered, by kind of failure (other errors
+# aren't); get_sr raises them again from NEGATIVE_CACHE, and the sync scheduler
+# doesn't sync the handle again earlier either
+NEGATIVE_CACHE_TTLS = {
+    "not_found": timedelta(hours=12),
+    "private": timedelta(hours=6),
+    "no_competitive": timedelta(hours=3),
+    "server_error": timedelta(minutes=5),
+    "timeout": timedelta(minutes=2),
+}
+# handle -> (time.monotonic() deadline, exception type, exception args); not the exception
+# itself, its traceback would keep the parsed profile page alive
+NEGATIVE_CACHE = TTLCache(
+    maxsize=10000, ttl=max(NEGATIVE_CACHE_TTLS.values()).total_seconds()
+)
+
+# after this many failed profile requests in a row, requests to Blizzard are rejected
+# with BlizzardUnavailable for BLIZZARD_BREAKER_COOLDOWN seconds
+BLIZZARD_BREAKER_THRESHOLD = 5
+BLIZZARD_BREAKER_COOLDOWN = 60
+
+# requests of BLIZZARD_REQUESTS_PER_MINUTE that background syncs leave for interactive ones
+BLIZZARD_INTERACTIVE_RESERVE = 3
+
 
 _SESSION = asks.Session(
     headers={
@@ -53,7 +85,106 @@ _SESSION = asks.Session(
     connections=10
 )
 
-async def get_sr(handle):
+# career profile of a handle, type is pc, xbl or psn
+PROFILE_URL = "https://playoverwatch.com/en-us/career/{type}/{handle}"
+
+class RequestBudget:
+    """token bucket allowing requests_per_minute requests, with bursts of up to
+    burst_seconds worth of them. Interactive requests go first, and background
+    requests leave BLIZZARD_INTERACTIVE_RESERVE tokens for them."""
+
+    def __init__(self, requests_per_minute, burst_seconds=10):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1, self.rate * burst_seconds)
+        self.reserve = min(BLIZZARD_INTERACTIVE_RESERVE, self.capacity - 1)
+        self.tokens = self.capacity
+        # created outside of trio, so the bucket starts full at the first request
+        self.updated = None
+        self.interactive_waiting = 0
+
+    def _refill(self):
+        now = trio.current_time()
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, *, interactive=False):
+        "waits until the next request may be made"
+        started = trio.current_time()
+        needed = 1 if interactive else 1 + self.reserve
+        if interactive:
+            self.interactive_waiting += 1
+        try:
+            while True:
+                self._refill()
+                if self.tokens >= needed and (interactive or not self.interactive_waiting):
+                    self.tokens -= 1
+                    break
+                await trio.sleep((needed - self.tokens if self.tokens < needed else 1) / self.rate)
+        finally:
+            if interactive:
+                self.interactive_waiting -= 1
+        metrics.BLIZZARD_BUDGET_WAIT_SECONDS.labels("interactive" if interactive else "background").observe(
+            trio.current_time() - started
+        )
+
+
+class CircuitBreaker:
+    """opens after threshold failed requests in a row, then rejects requests for cooldown
+    seconds; after that, it is half open and lets a single probe request through, which
+    closes it again if it succeeds, or keeps it open for another cooldown"""
+
+    # tokens returned by allow, for record
+    REQUEST, PROBE = "request", "probe"
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        """a token (REQUEST, or PROBE for the probe) if a request may be made now, which must
+        be passed to record when it is done, None if not"""
+        if self.opened_at is None:
+            return self.REQUEST
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return None
+        logger.info("probing whether Blizzard is back")
+        self.probing = True
+        return self.PROBE
+
+    def record(self, token, healthy):
+        """records the outcome of a request allowed with token; healthy is None if there was
+        none (like when it was cancelled)"""
+        if token == self.PROBE:
+            # only the probe itself ends the probe, not requests allowed before the breaker opened
+            self.probing = False
+        if healthy is None:
+            return
+        if healthy:
+            if self.opened_at is not None:
+                logger.info("Blizzard is back, resuming requests")
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.threshold:
+                logger.warning("%d failed requests to Blizzard in a row, pausing requests for %ds", self.failures, self.cooldown)
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+        metrics.BLIZZARD_CIRCUIT_OPEN.set(int(self.opened_at is not None))
+
+
+BLIZZARD_BUDGET = RequestBudget(BLIZZARD_REQUESTS_PER_MINUTE)
+BLIZZARD_BREAKER = CircuitBreaker(BLIZZARD_BREAKER_THRESHOLD, BLIZZARD_BREAKER_COOLDOWN)
+
+
+async def get_sr(handle, *, interactive=False):
+    """the SRs and rank images of handle. interactive requests are the ones a user waits
+    for: they go first in the request budget, and aren't answered by a failure
+    remembered in the negative cache."""
     try:
         lock = SR_LOCKS[handle.handle]
     except KeyError:
@@ -65,56 +196,99 @@ async def get_sr(handle):
         try:
             res = SR_CACHE[handle.handle]
             logger.info(f"got SR for {handle} from cache")
+            metrics.SR_CACHE_HITS.inc()
             return res
         except KeyError:
-            pass
+            metrics.SR_CACHE_MISSES.inc()
+
+        if not interactive:
+            expires, error_type, error_args = NEGATIVE_CACHE.get(handle.handle, (0, None, None))
+            if time.monotonic() < expires:
+                logger.debug("%s failed with %s recently, not asking again", handle, error_type.kind)
+                metrics.NEGATIVE_CACHE_HITS.labels(error_type.kind).inc()
+                # a new instance each time, concurrent tasks would overwrite each other's traceback
+                raise error_type(*error_args)
+
+        token = BLIZZARD_BREAKER.allow()
+        if token is None:
+            metrics.BLIZZARD_REQUESTS_REJECTED.inc()
+            raise BlizzardUnavailable("Too many failed requests, not asking Blizzard for a while")
+
+        healthy = None
+        try:
+            await BLIZZARD_BUDGET.acquire(interactive=interactive)
+            res = SR_CACHE[handle.handle] = await _request_sr(handle)
+        except (InvalidBattleTag, UnableToFindSR, BlizzardError) as e:
+            # Blizzard did answer, just not with SRs, unless it's a BlizzardError
+            healthy = not isinstance(e, BlizzardError)
+            ttl = NEGATIVE_CACHE_TTLS.get(e.kind)
+            if ttl:
+                NEGATIVE_CACHE[handle.handle] = (time.monotonic() + ttl.total_seconds(), type(e), e.args)
+            raise
+        else:
+            healthy = True
+        finally:
+            BLIZZARD_BREAKER.record(token, healthy)
+        NEGATIVE_CACHE.pop(handle.handle, None)
+        return res
+    finally:
+        lock.release()
 
 
-        url = f'https://playoverwatch.com/en-us/career/{handle.blizzard_url_type}/{handle.handle.replace("#", "-")}'
-        
-        logger.debug("requesting %s", url)
-        try:
+async def _request_sr(handle):
+    url = PROFILE_URL.format(type=handle.blizzard_url_type, handle=handle.handle.replace("#", "-"))
+    
+    logger.debug("requesting %s", url)
+    started = time.perf_counter()
+    try:
+        with tracing.span(tracing.HTTP, "blizzard_profile"):
             result = await _SESSION.get(
                 url,
                 connection_timeout=60,
                 timeout=60,
             )
-        except asks.errors.RequestTimeout:
-            raise BlizzardError("Timeout")
-        except Exception as e:
-            raise BlizzardError("Something went wrong", e)
-        if result.status_code != 200:
-            raise BlizzardError(f"got status code {result.status_code} from Blizz")
-
-
-        document = html.fromstring(result.content)
-    
-    
-        role_divs = document.xpath('(//div[@class="competitive-rank"])[1]/div[@class="competitive-rank-role"]')
-        
-        rank_images = [r.xpath('descendant::img[@class="competitive-rank-tier-icon"]/@src') for r in role_divs]
-        role_descs = [r.xpath('descendant::div[contains(@class, "competitive-rank-tier-tooltip")]/@data-ow-tooltip-text') for r in role_divs]
-        srs = [r.xpath('descendant::div[@class="competitive-rank-level"]/text()') for r in role_divs]
+    except asks.errors.RequestTimeout:
+        metrics.BLIZZARD_RESPONSES_TIMEOUT.inc()
+        raise BlizzardTimeout("Timeout")
+    except Exception as e:
+        metrics.BLIZZARD_RESPONSES_ERROR.inc()
+        raise BlizzardError("Something went wrong", e)
+    finally:
+        metrics.BLIZZARD_REQUEST_SECONDS.observe(time.perf_counter() - started)
+    if result.status_code != 200:
+        # only a handful of different codes happen in practice
+        metrics.BLIZZARD_RESPONSES.labels(result.status_code).inc()
+        error = BlizzardServerError if result.status_code >= 500 else BlizzardError
+        raise error(f"got status code {result.status_code} from Blizz")
+    metrics.BLIZZARD_RESPONSES_OK.inc()
 
 
-        if not any(srs):
-            if "Profile Not Found" in result.text:
-                raise InvalidBattleTag(f"No profile with {handle.desc} {handle.handle} found")
-            raise UnableToFindSR()
+    document = html.fromstring(result.content)
 
-        combined = {
-            desc[0].split()[0]: (sr[0], rank_image[0])
-            for desc, sr, rank_image in zip(role_descs, srs, rank_images)
-        }
-        
-        sr_list = [int(combined[n][0]) if n in combined else None for n in "Tank Damage Support".split()]
-        img_list = [combined[n][1] if n in combined else None for n in "Tank Damage Support".split()]
 
-        res = SR_CACHE[handle.handle] = (TDS(*sr_list), TDS(*img_list))
+    role_divs = document.xpath('(//div[@class="competitive-rank"])[1]/div[@class="competitive-rank-role"]')
+    
+    rank_images = [r.xpath('descendant::img[@class="competitive-rank-tier-icon"]/@src') for r in role_divs]
+    role_descs = [r.xpath('descendant::div[contains(@class, "competitive-rank-tier-tooltip")]/@data-ow-tooltip-text') for r in role_divs]
+    srs = [r.xpath('descendant::div[@class="competitive-rank-level"]/text()') for r in role_divs]
+
+
+    if not any(srs):
+        if "Profile Not Found" in result.text:
+            raise InvalidBattleTag(f"No profile with {handle.desc} {handle.handle} found")
+        if document.xpath('//p[@class="masthead-permission-level-text"][contains(text(), "Private")]'):
+            raise PrivateProfile()
+        raise UnableToFindSR()
+
+    combined = {
+        desc[0].split()[0]: (sr[0], rank_image[0])
+        for desc, sr, rank_image in zip(role_descs, srs, rank_images)
+    }
+    
+    sr_list = [int(combined[n][0]) if n in combined else None for n in "Tank Damage Support".split()]
+    img_list = [combined[n][1] if n in combined else None for n in "Tank Damage Support".split()]
 
-        return res
-    finally:
-        lock.release()
+    return (TDS(*sr_list), TDS(*img_list))
 
 
 def sort_secondaries(user):
@@ -16,15 +16,18 @@ import datetime as dt
 import json
 import logging
 import re
+import time
 
+from dataclasses import dataclass
 from operator import attrgetter
+from typing import List
 
 import asks
+import trio
 
 from itsdangerous.url_safe import URLSafeTimedSerializer
 from itsdangerous.exc import BadSignature, SignatureExpired
 from oauthlib.oauth2 import WebApplicationClient
-from trio.to_thread import run_sync
 from quart_trio import QuartTrio
 from quart import Quart, request, render_template, jsonify, Response
 
@@ -38,9 +41,9 @@ from .config import (
     OAUTH_REDIRECT_PATH,
     OAUTH_REDIRECT_HOST,
 )
-from .config_classes import GuildConfig
+from . import metrics
+from .config_classes import GuildConfig, diff_guild_configs
 from .i18n import _, ngettext, CurrentLocale
-from .models import User, GuildConfigJson, HighscoreCron
 
 logger = logging.getLogger(__name__)
 
@@ -69,6 +72,45 @@ async def render_message(message, is_error=False):
     )
 
 
+@app.route("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# timeout for a guild config request forwarded to another process
+FORWARD_TIMEOUT = 30
+
+_FORWARD_SESSION = asks.Session(headers={"Connection": "keep-alive"}, connections=10)
+
+
+async def forward_to_owner(guild_id):
+    """Answers the current request for a guild of another process with the answer of
+    that process's internal web server. Only the token is needed to authorize there."""
+    address = await orisa.guild_api_address(guild_id)
+    if address is None:
+        logger.error("No process for guild %d is running", guild_id)
+        return "guild is handled by a process that is not running", 503
+
+    headers = {name: request.headers[name] for name in ("Authorization", "Content-Type") if name in request.headers}
+    try:
+        response = await _FORWARD_SESSION.request(
+            request.method,
+            f"http://{address}{request.path}",
+            headers=headers,
+            data=await request.data,
+            timeout=FORWARD_TIMEOUT,
+        )
+    except Exception:
+        logger.exception("Unable to forward request for guild %d to %s", guild_id, address)
+        return "guild is handled by a process that is not reachable", 503
+
+    return Response(
+        response.content,
+        status=response.status_code,
+        content_type=response.headers.get("content-type", "text/plain"),
+    )
+
+
 def create_token(guild_id):
     return serializer.dumps({"g": guild_id})
 
@@ -84,6 +126,10 @@ async def channels(token):
 
     guild_id = state["g"]
 
+    if not orisa.shards.owns_guild(guild_id):
+        # only the guilds of our own shards are known
+        return await forward_to_owner(guild_id)
+
     guild_info = orisa.guild_config[guild_id]
 
     guild = client.guilds[guild_id]
@@ -247,6 +293,7 @@ def validate_config(guild, guild_config):
 
 @app.route(OAUTH_REDIRECT_PATH + "guild_config/<int:guild_id>", methods=["PUT"])
 async def save(guild_id):
+    started = time.monotonic()
 
     try:
         token = request.headers["authorization"].split(" ")[1]
@@ -260,6 +307,9 @@ async def save(guild_id):
     except BadSignature:
         return "Invalid token", 401, {"WWW-Authenticate": "Bearer"}
 
+    if not orisa.shards.owns_guild(guild_id):
+        return await forward_to_owner(guild_id)
+
     new_gi = GuildConfig.from_json2(await request.data)
     logger.debug(f"old info: {orisa.guild_config[guild_id]}")
     logger.debug(f"new info: {new_gi}")
@@ -272,39 +322,17 @@ async def save(guild_id):
     if errors:
         return jsonify(errors), 400
 
-    orisa.guild_config[guild_id] = new_gi
-
-    async with orisa.database.session() as session:
-
-        gc = await run_sync(session.query(GuildConfigJson).filter_by(id=guild_id).one_or_none)
-        if not gc:
-            gc = GuildConfigJson(id=guild_id)
-            session.add(gc)
-
-        new_config = json.dumps(new_gi.to_js_json())
-        gc.config = new_config
-        logger.info("New config for guild %d is %s", guild_id, new_config)
-
-        cron = await run_sync(session.query(HighscoreCron).filter_by(id=guild_id).one_or_none)
-
-        if new_gi.post_highscores:
-            if not cron:
-                cron = HighscoreCron(id=guild_id)
-                await run_sync(session.add, cron)
-            ts = dt.datetime.strptime(new_gi.post_highscore_time, "%H:%M")
-            now = dt.datetime.today()
-            ts = ts.replace(year=now.year, month=now.month, day=now.day)
-            if ts < now:
-                ts += dt.timedelta(days=1)
-            cron.next_run = ts
-        else:
-            if cron:
-                await run_sync(session.delete, cron)
-
-        await run_sync(session.commit)
+    changes = diff_guild_configs(orisa.guild_config[guild_id], new_gi)
+    logger.info("New config for guild %d is %s", guild_id, json.dumps(new_gi.to_js_json()))
+    # active right away, but only written to the database a little later
+    orisa.queue_config_write(guild_id, new_gi)
+    logger.info(
+        "New config for guild %d accepted in %.3fs", guild_id, time.monotonic() - started
+    )
 
     async def update():
-        for vc in new_gi.managed_voice_categories:
+        started = time.monotonic()
+        for vc in changes.changed_categories:
             try:
                 await orisa._adjust_voice_channels(
                     client.find_channel(vc.category_id), adjust_user_limits=True
@@ -312,22 +340,115 @@ async def save(guild_id):
             except Exception:
                 logger.exception("Cannot initialize voice channels")
 
-        async with orisa.database.session() as session:
-            for user in await run_sync(
-                session.query(User)
-                .filter(User.discord_id.in_(guild.members.keys()))
-                .all
-            ):
-                try:
-                    await orisa._update_nick(user)
-                except Exception:
-                    logger.error("Exception during update", exc_info=True)
+        if changes.all_nicks:
+            member_ids = guild.members.keys()
+        else:
+            member_ids = set()
+            for category_id in changes.nick_category_ids:
+                category = client.find_channel(category_id)
+                if not category:
+                    continue
+                for chan in category.children:
+                    member_ids.update(member.id for member in chan.voice_members if member)
+
+        if member_ids:
+            async with orisa.database.session() as session:
+                for user in await orisa.database.users_by_discord_ids(session, member_ids):
+                    try:
+                        await orisa._update_nick(user)
+                    except Exception:
+                        logger.error("Exception during update", exc_info=True)
+        logger.info(
+            "New config for guild %d applied in %.3fs (%d categories, %d nicks checked)",
+            guild_id,
+            time.monotonic() - started,
+            len(changes.changed_categories),
+            len(member_ids),
+        )
 
     await orisa.spawn(update)
 
     return "", 204
 
 
+@dataclass
+class OAuthProvider:
+    token_url: str
+    endpoint: str
+    client_id: str
+    client_secret: str
+    scope: List[str]
+    # keep-alive connection pool, only used for this provider
+    session: asks.Session
+
+
+# timeout for a single request to the OAuth provider
+OAUTH_TIMEOUT = 15
+# maximum number of (keep-alive) connections per provider
+OAUTH_CONNECTIONS = 20
+
+OAUTH_PROVIDERS = {
+    "pc": OAuthProvider(
+        token_url="https://eu.battle.net/oauth/token",
+        endpoint="https://eu.battle.net/oauth/userinfo",
+        client_id=OAUTH_BLIZZARD_CLIENT_ID,
+        client_secret=OAUTH_BLIZZARD_CLIENT_SECRET,
+        scope=[],
+        session=asks.Session(headers={"Connection": "keep-alive"}, connections=OAUTH_CONNECTIONS),
+    ),
+    "xbox": OAuthProvider(
+        token_url="https://discordapp.com/api/oauth2/token",
+        endpoint="https://discordapp.com/api/v6/users/@me/connections",
+        client_id=OAUTH_DISCORD_CLIENT_ID,
+        client_secret=OAUTH_DISCORD_CLIENT_SECRET,
+        scope=["connections"],
+        session=asks.Session(headers={"Connection": "keep-alive"}, connections=OAUTH_CONNECTIONS),
+    ),
+}
+
+
+async def fetch_oauth_data(provider, request_url):
+    "exchanges the authorization code in request_url for a token and returns the user data"
+    client = WebApplicationClient(provider.client_id)
+
+    url, headers, body = client.prepare_token_request(
+        provider.token_url,
+        authorization_response=request_url,
+        scope=provider.scope,
+        redirect_url=f"{OAUTH_REDIRECT_HOST}{OAUTH_REDIRECT_PATH}",
+        client_secret=provider.client_secret,
+    )
+
+    logger.debug(f"got data {(url, headers, body)}")
+
+    resp = await provider.session.post(
+        url,
+        headers=headers,
+        data=body,
+        connection_timeout=OAUTH_TIMEOUT,
+        timeout=OAUTH_TIMEOUT,
+    )
+
+    logger.debug("got response %s", resp.text)
+
+    client.parse_request_body_response(resp.text, scope=provider.scope)
+
+    logger.debug("token is %s", client.token)
+
+    url, headers, body = client.add_token(provider.endpoint)
+
+    logger.debug("requesting data")
+
+    resp = await provider.session.get(
+        url, headers=headers, connection_timeout=OAUTH_TIMEOUT, timeout=OAUTH_TIMEOUT
+    )
+    data = resp.json()
+
+    logger.debug("data received: %s", data)
+
+    return data
+
+
 @app.route(OAUTH_REDIRECT_PATH)
 async def handle_oauth():
 
@@ -354,22 +475,11 @@ async def handle_oauth():
             is_error=True,
         )
 
-    if type == "pc":
-        token_url = "https://eu.battle.net/oauth/token"
-        endpoint = "https://eu.battle.net/oauth/userinfo"
-        client_id = OAUTH_BLIZZARD_CLIENT_ID
-        client_secret = OAUTH_BLIZZARD_CLIENT_SECRET
-        scope = []
-    elif type == "xbox":
-        token_url = "https://discordapp.com/api/oauth2/token"
-        endpoint = "https://discordapp.com/api/v6/users/@me/connections"
-        scope = ["connections"]
-        client_id = OAUTH_DISCORD_CLIENT_ID
-        client_secret = OAUTH_DISCORD_CLIENT_SECRET
-    else:
+    try:
+        provider = OAUTH_PROVIDERS[type]
+    except KeyError:
         return await render_message(_("I got invalid data. Please try registering again."), is_error=True)
 
-    client = WebApplicationClient(client_id)
     logger.debug(f"got OAuth auth URL {request.url}")
 
     # we are behind a proxy, and hypercorn doesn't support
@@ -383,35 +493,7 @@ async def handle_oauth():
         )
 
     try:
-        url, headers, body = client.prepare_token_request(
-            token_url,
-            authorization_response=request_url,
-            scope=scope,
-            redirect_url=f"{OAUTH_REDIRECT_HOST}{OAUTH_REDIRECT_PATH}",
-            client_secret=client_secret,
-        )
-
-        logger.debug(f"got data {(url, headers, body)}")
-
-        resp = await asks.post(
-            url,
-            headers=headers,
-            data=body,
-        )
-
-        logger.debug("got response %s", resp.text)
-
-        client.parse_request_body_response(resp.text, scope=scope)
-
-        logger.debug("token is %s", client.token)
-
-        url, headers, body = client.add_token(endpoint)
-
-        logger.debug("requesting data")
-
-        data = (await asks.get(url, headers=headers)).json()
-
-        logger.debug("data received: %s", data)
+        data = await fetch_oauth_data(provider, request_url)
     except Exception:
         logger.error(
             f"Something went wrong while getting OAuth data for {uid} {request_url}",
@@ -421,9 +503,16 @@ async def handle_oauth():
             _('I\'m sorry. Something went wrong on my side. Try to reissue {register}.').format(register=register_msg),
             is_error=True,
         )
-    logger.debug("sending to channel %s", send_ch)
-    await send_ch.send((uid, type, data))
-    logger.debug("sent to channel %s", send_ch)
+    try:
+        send_ch.send_nowait((uid, type, data))
+    except trio.WouldBlock:
+        logger.warning(
+            "registration queue is full (%d entries), waiting", send_ch.statistics().current_buffer_used
+        )
+        await send_ch.send((uid, type, data))
+    logger.debug(
+        "queued registration, %d registrations waiting", send_ch.statistics().current_buffer_used
+    )
 
     return await render_message(_("Thank you! I have sent you a DM."))
 